@@ -9,10 +9,12 @@ from __future__ import print_function
 
 import sys, os, shutil, fileinput
 import distutils.util
+import json
 import re
 import subprocess as sp
 import unittest
 import logging
+import xml.etree.ElementTree as ET
 from argparse import Namespace
 
 builddir = os.getcwd()
@@ -110,7 +112,71 @@ class TestSourceSet(unittest.TestCase):
         self.assertRegexpMatches(capturedOutput.getvalue(), 'Ignoring already included setup file')
 
 
-class TestUpdateReleaseLocal(unittest.TestCase):
+class TestLoadSetup(unittest.TestCase):
+    setdir = os.path.join(builddir, 'setupcache')
+    cache_file = os.path.join(cue.cachedir, 'setups.json')
+
+    def setUp(self):
+        os.makedirs(self.setdir)
+        os.environ['SETUP_PATH'] = self.setdir + ':.'
+        os.environ['SET'] = 'test02'
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+        cue.clear_lists()
+        os.chdir(builddir)
+
+    def tearDown(self):
+        shutil.rmtree(self.setdir)
+        for var in ['SET', 'SNCSEQ']:
+            os.environ.pop(var, None)
+        cue.clear_lists()
+
+    def load(self):
+        cue.clear_lists()
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.load_setup()
+        sys.stdout = sys.__stdout__
+        return capturedOutput.getvalue()
+
+    def test_IncludeGraph(self):
+        output = self.load()
+        self.assertRegexpMatches(output, r'Setup file includes:\n  ./test02.set\n    ./test01.set\n  ./defaults.set')
+        self.assertEqual(cue.setup['SNCSEQ_DIRNAME'], 'seq', 'complete_setup() defaults missing')
+
+    def test_CacheUsedUntilInputChanges(self):
+        self.load()
+        first = dict(cue.setup)
+        output = self.load()
+        self.assertRegexpMatches(output, 'Using cached setup from 3 files')
+        self.assertEqual(cue.setup, first, 'Cached setup differs')
+        self.assertRegexpMatches(output, r'  ./test02.set\n    ./test01.set', 'Include graph not cached')
+
+        os.environ['SNCSEQ'] = 'R2-2-9'
+        output = self.load()
+        self.assertFalse('Using cached setup' in output, 'Cached setup used after environment change')
+        self.assertEqual(cue.setup['SNCSEQ'], 'R2-2-9', 'Environment override not applied')
+
+        with open(os.path.join(self.setdir, 'test01.set'), 'w') as f:
+            f.write('SNCSEQ=R2-2-7\n')
+        output = self.load()
+        self.assertFalse('Using cached setup' in output, 'Cached setup used after a setup file appeared')
+        self.assertRegexpMatches(output, 'setupcache/test01.set')
+
+    def test_CacheKeepsOtherSettings(self):
+        self.load()
+        os.environ['SNCSEQ'] = 'R2-2-9'
+        self.load()
+        os.environ.pop('SNCSEQ')
+        output = self.load()
+        self.assertRegexpMatches(output, 'Using cached setup', 'Cached setup replaced by other settings')
+        os.environ['SNCSEQ'] = 'R2-2-9'
+        output = self.load()
+        self.assertRegexpMatches(output, 'Using cached setup', 'Cached setup of other settings not kept')
+        self.assertEqual(cue.setup['SNCSEQ'], 'R2-2-9', 'Wrong cached setup used')
+
+
+class TestWriteReleaseLocal(unittest.TestCase):
     release_local = os.path.join(cue.cachedir, 'RELEASE.local')
 
     def setUp(self):
@@ -118,8 +184,19 @@ class TestUpdateReleaseLocal(unittest.TestCase):
             os.remove(self.release_local)
         os.chdir(builddir)
 
+    def tearDown(self):
+        cue.clear_lists()
+
+    def write_release_local(self, deps):
+        cue.clear_lists()
+        cue.setup['BASE_VARNAME'] = 'EPICS_BASE'
+        for (mod, place) in deps:
+            cue.complete_setup(mod)
+            cue.places[cue.setup[mod + '_VARNAME']] = place
+        return cue.write_release_local([mod for (mod, place) in deps])
+
     def test_SetModule(self):
-        cue.update_release_local('MOD1', '/foo/bar')
+        self.write_release_local([('MOD1', '/foo/bar')])
         found = 0
         for line in fileinput.input(self.release_local, inplace=1):
             if 'MOD1=' in line:
@@ -129,10 +206,8 @@ class TestUpdateReleaseLocal(unittest.TestCase):
         self.assertEqual(found, 1, 'MOD1 not written once to RELEASE.local (found {0})'.format(found))
 
     def test_SetBaseAndMultipleModules(self):
-        cue.update_release_local('EPICS_BASE', '/bar/foo')
-        cue.update_release_local('MOD1', '/foo/bar')
-        cue.update_release_local('MOD2', '/foo/bar2')
-        cue.update_release_local('MOD1', '/foo/bar1')
+        self.write_release_local([('BASE', '/bar/foo'), ('MOD1', '/foo/bar'), ('MOD2', '/foo/bar2'),
+                                  ('MOD1', '/foo/bar1')])
         found = {}
         foundat = {}
         for line in fileinput.input(self.release_local, inplace=1):
@@ -176,6 +251,20 @@ class TestUpdateReleaseLocal(unittest.TestCase):
         self.assertGreater(foundat['mod2'], foundat['mod1'],
                            'MOD2 (line {0}) appears before MOD1 (line {1})'.format(foundat['mod2'], foundat['mod1']))
 
+    def test_WriteOnce(self):
+        with open(self.release_local, 'w') as f:
+            f.write('OLDMOD=/foo/old\n')
+        text = self.write_release_local([('BASE', '/bar/foo'), ('MOD1', '/foo/bar1'), ('MOD2', '/foo/bar2'),
+                                         ('MOD1', '/foo/bar1')])
+        self.assertEqual(text, 'MOD1=/foo/bar1\nMOD2=/foo/bar2\nEPICS_BASE=/bar/foo\n',
+                         'Unexpected RELEASE.local content {0!r}'.format(text))
+        with open(self.release_local) as f:
+            self.assertEqual(f.read(), text, 'RELEASE.local not written')
+        os.utime(self.release_local, (1000000000, 1000000000))
+        cue.write_release_local(['BASE', 'MOD1', 'MOD2'])
+        self.assertEqual(os.path.getmtime(self.release_local), 1000000000,
+                         'Unchanged RELEASE.local was written again')
+
 
 class TestAddDependencyUpToDateCheck(unittest.TestCase):
     hash_3_15_6 = "ce7943fb44beb22b453ddcc0bda5398fadf72096"
@@ -231,6 +320,759 @@ class TestAddDependencyUpToDateCheck(unittest.TestCase):
                          .format(self.hash_3_15_6, checked_out))
 
 
+class TestResolveRef(unittest.TestCase):
+    repo = os.path.join(cue.cachedir, 'refs-test-repo')
+    url = 'file://' + repo.replace('\\', '/')
+    ref_file = os.path.join(cue.cachedir, 'refs.json')
+
+    def git(self, args):
+        sp.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + args, cwd=self.repo)
+
+    def setUp(self):
+        cue.clear_lists()
+        for path in [self.repo, self.ref_file]:
+            if os.path.isdir(path):
+                shutil.rmtree(path, onerror=cue.remove_readonly)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.makedirs(self.repo)
+        self.git(['init', '--quiet'])
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'initial'])
+        self.git(['tag', 'R1.0'])
+        self.git(['branch', 'devel'])
+
+    def next_run(self):
+        cue.ref_cache.clear()
+        cue.resolved_refs.clear()
+
+    def test_TagIsNeverLookedUpAgain(self):
+        entry = cue.resolve_ref(self.url, 'R1.0')
+        self.assertEqual(entry['kind'], 'tags', 'R1.0 not resolved as a tag (found {0})'.format(entry))
+        self.git(['tag', '-d', 'R1.0'])
+        self.next_run()
+        self.assertTrue(cue.resolve_ref(self.url, 'R1.0'), 'Tag R1.0 was looked up again')
+
+    def test_BranchIsLookedUpAgain(self):
+        entry = cue.resolve_ref(self.url, 'devel')
+        self.assertEqual(entry['kind'], 'heads', 'devel not resolved as a branch (found {0})'.format(entry))
+        self.git(['branch', '-D', 'devel'])
+        self.assertTrue(cue.resolve_ref(self.url, 'devel'), 'Branch devel was looked up again in the same run')
+        self.next_run()
+        self.assertFalse(cue.resolve_ref(self.url, 'devel'), 'Branch devel was not looked up again')
+
+    def test_BranchWithinTtl(self):
+        cue.ci['ref_ttl'] = 3600
+        cue.resolve_ref(self.url, 'devel')
+        self.git(['branch', '-D', 'devel'])
+        self.next_run()
+        self.assertTrue(cue.resolve_ref(self.url, 'devel'), 'Branch devel was looked up again within ttl')
+        self.next_run()
+        cue.ci['refresh_refs'] = True
+        self.assertFalse(cue.resolve_ref(self.url, 'devel'), 'Branch devel was not looked up with refresh forced')
+
+    def test_InvalidRef(self):
+        self.assertIsNone(cue.resolve_ref(self.url, 'xxdoesnotexistxx'), 'Invalid ref was resolved')
+
+
+class TestGitMirror(unittest.TestCase):
+    repo = os.path.join(cue.cachedir, 'mirror-test-repo')
+    url = 'file://' + repo.replace('\\', '/')
+
+    def git(self, args):
+        sp.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + args, cwd=self.repo)
+
+    def setUp(self):
+        cue.clear_lists()
+        for path in [self.repo, os.path.join(cue.cachedir, 'mirrors')] \
+                + [os.path.join(cue.cachedir, 'mirrortest-' + tag) for tag in ['R1.0', 'R1.1']]:
+            if os.path.exists(path):
+                shutil.rmtree(path, onerror=cue.remove_readonly)
+        os.makedirs(self.repo)
+        self.git(['init', '--quiet'])
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'initial'])
+        self.git(['tag', 'R1.0'])
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'second'])
+        self.git(['tag', 'R1.1'])
+        cue.ci['git_mirror'] = True
+        cue.setup['MIRRORTEST_REPOURL'] = self.url
+        cue.complete_setup('MIRRORTEST')
+
+    def test_ClonesShareMirror(self):
+        for tag in ['R1.0', 'R1.1']:
+            cue.setup['MIRRORTEST'] = tag
+            cue.add_dependency('MIRRORTEST')
+            place = os.path.join(cue.cachedir, 'mirrortest-' + tag)
+            self.assertTrue(os.path.exists(os.path.join(place, 'checked_out')),
+                            'Dependency tag {0} was not checked out'.format(tag))
+            self.assertTrue(os.path.exists(os.path.join(place, '.git', 'objects', 'info', 'alternates')),
+                            'Checkout of tag {0} does not borrow objects from the mirror'.format(tag))
+            remote = sp.check_output(['git', 'config', 'remote.origin.url'], cwd=place).decode().strip()
+            self.assertEqual(remote, self.url, 'Remote of tag {0} is {1} (expected {2})'
+                             .format(tag, remote, self.url))
+        self.assertEqual(len(os.listdir(os.path.join(cue.cachedir, 'mirrors'))), 1,
+                         'Not exactly one mirror for two tags of the same repository')
+
+
+class TestUpdateDependency(unittest.TestCase):
+    repo = os.path.join(cue.cachedir, 'update-test-repo')
+    place = os.path.join(cue.cachedir, 'updatetest-master')
+
+    def git(self, args):
+        sp.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + args, cwd=self.repo)
+
+    def setUp(self):
+        cue.clear_lists()
+        for path in [self.repo, self.place]:
+            if os.path.exists(path):
+                shutil.rmtree(path, onerror=cue.remove_readonly)
+        os.makedirs(self.repo)
+        self.git(['init', '--quiet'])
+        self.git(['checkout', '--quiet', '-b', 'master'])
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'initial'])
+        cue.setup['UPDATETEST_REPOURL'] = 'file://' + self.repo.replace('\\', '/')
+        cue.setup['UPDATETEST'] = 'master'
+        cue.complete_setup('UPDATETEST')
+        self.assertTrue(cue.fetch_dependency('UPDATETEST'), 'Dependency was not cloned')
+        with open(os.path.join(self.place, 'O.product'), 'w') as f:
+            f.write('built')
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'second'])
+        # the branch moved after the run that cloned it
+        cue.resolved_refs.clear()
+
+    def test_BranchUpdatedInPlace(self):
+        cue.ci['update_deps'] = True
+        self.assertFalse(cue.fetch_dependency('UPDATETEST'), 'Dependency was cloned again')
+        self.assertEqual(cue.get_git_hash(self.place), cue.get_git_hash(self.repo),
+                         'Dependency was not updated to the new commit of its branch')
+        self.assertTrue(os.path.exists(os.path.join(self.place, 'O.product')),
+                        'Build products were removed when updating the dependency')
+        self.assertEqual(cue.read_marker(self.place, 'checked_out'), cue.get_git_hash(self.repo),
+                         'checked_out marker was not updated')
+
+    def test_NoUpdateByDefault(self):
+        head = cue.get_git_hash(self.place)
+        self.assertFalse(cue.fetch_dependency('UPDATETEST'), 'Dependency was cloned again')
+        self.assertEqual(cue.get_git_hash(self.place), head, 'Dependency was updated without UPDATE_DEPS')
+
+
+class LocalDependencyTest(unittest.TestCase):
+    modules = ['BASE', 'ASYN']
+    repo = os.path.join(cue.cachedir, 'plan-test-repo')
+    places = [os.path.join(cue.cachedir, name) for name in ['planbase-R1.0', 'planasyn-R1.0']]
+    env = {'BASE': 'R1.0', 'BASE_DIRNAME': 'planbase', 'ASYN': 'R1.0', 'ASYN_DIRNAME': 'planasyn',
+           'MODULES': 'asyn', 'SETUP_PATH': '.'}
+
+    def git(self, args):
+        sp.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + args, cwd=self.repo)
+
+    def setUp(self):
+        cue.clear_lists()
+        for path in [self.repo] + self.places:
+            if os.path.exists(path):
+                shutil.rmtree(path, onerror=cue.remove_readonly)
+        for name in ['refs.json', 'setups.json', 'history.db', 'RELEASE.local']:
+            if os.path.exists(os.path.join(cue.cachedir, name)):
+                os.remove(os.path.join(cue.cachedir, name))
+        lockdir = os.path.join(cue.cachedir, 'locks')
+        for name in os.listdir(lockdir) if os.path.isdir(lockdir) else []:
+            if name.endswith('.lease'):
+                os.remove(os.path.join(lockdir, name))
+        os.makedirs(self.repo)
+        self.git(['init', '--quiet'])
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'initial'])
+        self.git(['tag', 'R1.0'])
+        url = 'file://' + self.repo.replace('\\', '/')
+        os.environ.update(self.env)
+        os.environ.update((mod + '_REPOURL', url) for mod in self.modules)
+        os.chdir(builddir)
+        self.building_base = cue.building_base
+        cue.building_base = False
+
+    def tearDown(self):
+        for var in list(self.env) + [mod + '_REPOURL' for mod in self.modules]:
+            os.environ.pop(var, None)
+        cue.building_base = self.building_base
+        cue.clear_lists()
+
+    def add_dependencies(self):
+        cue.clear_lists()
+        cue.load_setup()
+        cue.add_dependencies(cue.modlist())
+        cue.check_build_keys(cue.modlist())
+        [cue.write_built_key(mod) for mod in self.modules]
+        cue.write_release_local(cue.modlist())
+
+
+class TestPlan(LocalDependencyTest):
+    def plan(self, **settings):
+        cue.clear_lists()
+        cue.ci.update(settings)
+        before = dict((name, os.path.getmtime(os.path.join(cue.cachedir, name))) for name in os.listdir(cue.cachedir))
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            cue.plan(None)
+        finally:
+            sys.stdout = sys.__stdout__
+        after = dict((name, os.path.getmtime(os.path.join(cue.cachedir, name))) for name in os.listdir(cue.cachedir))
+        self.assertEqual(after, before, 'plan changed the cache directory')
+        return capturedOutput.getvalue()
+
+    def test_EmptyCache(self):
+        output = self.plan()
+        self.assertRegexpMatches(output, r'BASE +R1.0 +clone \(depth 5, recursive\) +rebuild +\? +not in cache')
+        self.assertRegexpMatches(output, r'ASYN +R1.0 +clone')
+        self.assertRegexpMatches(output, r'no history for 2 of them')
+
+        cue.ci['history'] = os.path.join(cue.cachedir, 'history.db')
+        now = cue.time.time()
+        cue.record_history('clone', 'BASE', now - 30, 'cloned')
+        cue.record_history('dependency', 'BASE', now - 90, 'built')
+        cue.write_history('prepare')
+        output = self.plan()
+        self.assertRegexpMatches(output, r'BASE +R1.0 +clone \(depth 5, recursive\) +rebuild +2m00s')
+        self.assertRegexpMatches(output, r'dependencies: 2m00s \(no history for 1 of them\)')
+
+    def test_CachedAndRebuild(self):
+        self.add_dependencies()
+        output = self.plan()
+        self.assertRegexpMatches(output, r'BASE +R1.0 +current +current +0m00s')
+        self.assertRegexpMatches(output, r'ASYN +R1.0 +current +current +0m00s')
+
+        os.environ['USR_CFLAGS'] = '-O1'
+        try:
+            output = self.plan()
+        finally:
+            os.environ.pop('USR_CFLAGS')
+        self.assertRegexpMatches(output, r'BASE +R1.0 +current +rebuild +\? +config_site changed\n')
+        self.assertRegexpMatches(output, r'ASYN +R1.0 +current +rebuild +\? +config_site changed, BASE changed')
+
+        with open(os.path.join(self.places[0], 'checked_out'), 'w') as f:
+            f.write('modified')
+        output = self.plan()
+        self.assertRegexpMatches(output, r'BASE +R1.0 +clone \(depth 5, recursive\) +rebuild +\? +checkout out of date')
+        output = self.plan(update_deps=True)
+        self.assertRegexpMatches(output, r'BASE +R1.0 +update +rebuild +\? +checkout modified, commit changed')
+        self.assertRegexpMatches(output, r'ASYN +R1.0 +current +rebuild +\? +BASE changed')
+
+
+class TestParallelClone(LocalDependencyTest):
+    modules = ['BASE', 'ASYN', 'SSCAN']
+    places = [os.path.join(cue.cachedir, name) for name in ['planbase-R1.0', 'planasyn-R1.0', 'plansscan-R1.0']]
+    env = dict(LocalDependencyTest.env, SSCAN='R1.0', SSCAN_DIRNAME='plansscan', MODULES='asyn sscan')
+
+    def setUp(self):
+        LocalDependencyTest.setUp(self)
+        self.fetch_dependency = cue.fetch_dependency
+        self.finished = []
+
+        # the clones finish in the reverse order of MODULES
+        def fetch_dependency(dep):
+            cue.time.sleep({'BASE': 0.6, 'ASYN': 0.3}.get(dep, 0))
+            cloned = self.fetch_dependency(dep)
+            self.finished.append(dep)
+            return cloned
+        cue.fetch_dependency = fetch_dependency
+
+    def tearDown(self):
+        cue.fetch_dependency = self.fetch_dependency
+        LocalDependencyTest.tearDown(self)
+
+    def test_KeepsModuleOrder(self):
+        cue.ci['parallel_clone'] = 3
+        cue.load_setup()
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            cue.add_dependencies(cue.modlist())
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(self.finished, ['SSCAN', 'ASYN', 'BASE'], 'Clones did not run at the same time')
+        output = capturedOutput.getvalue()
+        self.assertEqual(re.findall(r'Cloning R1.0 of dependency (\w+)', output), ['BASE', 'ASYN', 'SSCAN'],
+                         'Output of the clones not in the order of MODULES:\n{0}'.format(output))
+        self.assertEqual(len(re.findall(r'Cloning R1.0 of dependency \w+ into \S+\ncommit ', output)), 3,
+                         'Output of the clones mixed:\n{0}'.format(output))
+        self.assertEqual(cue.modules_to_compile, ['BASE', 'ASYN', 'SSCAN'],
+                         'Modules not compiled in the order of MODULES ({0})'.format(cue.modules_to_compile))
+        text = cue.write_release_local(cue.modlist())
+        self.assertEqual([line.split('=')[0] for line in text.splitlines()], ['ASYN', 'SSCAN', 'EPICS_BASE'],
+                         'RELEASE.local not in the order of MODULES:\n{0}'.format(text))
+
+
+class TestConfigurationSwitch(LocalDependencyTest):
+    store = os.path.join(cue.cachedir, 'switch-artifacts')
+
+    def check_build_keys(self, configuration):
+        cue.clear_lists()
+        cue.ci['artifact_store'] = self.store
+        cue.ci['configuration'] = configuration
+        cue.load_setup()
+        cue.add_dependencies(cue.modlist())
+        cue.check_build_keys(cue.modlist())
+
+    def test_OtherConfigurationKept(self):
+        if os.path.exists(self.store):
+            shutil.rmtree(self.store)
+        built = os.path.join(self.places[1], 'lib', 'libasyn.a')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            self.check_build_keys('default')
+            os.makedirs(os.path.dirname(built))
+            with open(built, 'w') as fout:
+                print('library', file=fout)
+            [cue.write_built_key(mod) for mod in self.modules]
+            self.check_build_keys('static')
+            self.assertFalse(os.path.exists(built), 'Checkout not reset for the other configuration')
+            [cue.write_built_key(mod) for mod in self.modules]
+            self.check_build_keys('default')
+            self.assertEqual(cue.modules_to_compile, ['BASE', 'ASYN'],
+                             'Switching back did not set the modules to compile ({0})'.format(cue.modules_to_compile))
+            self.assertTrue(cue.restore_artifacts('ASYN'), 'Build of the other configuration not kept')
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertTrue(os.path.exists(built), 'Build products of the other configuration not restored')
+
+
+@unittest.skipIf(not cue.fcntl, 'No file locks on this platform')
+class TestCacheLocks(LocalDependencyTest):
+    def locked(self, name, exclusive):
+        with open(os.path.join(cue.cachedir, 'locks', name + '.lock'), 'a') as f:
+            try:
+                cue.fcntl.flock(f, (cue.fcntl.LOCK_SH if exclusive else cue.fcntl.LOCK_EX) | cue.fcntl.LOCK_NB)
+                return False
+            except (IOError, OSError):
+                return True
+
+    def lock_dependencies(self, **settings):
+        cue.clear_lists()
+        cue.ci.update(settings)
+        cue.load_setup()
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            cue.lock_dependencies(cue.modlist())
+        finally:
+            sys.stdout = sys.__stdout__
+        return capturedOutput.getvalue()
+
+    def test_ExclusiveForChanges(self):
+        output = self.lock_dependencies()
+        self.assertRegexpMatches(output, 'Locked RELEASE.local, planasyn-R1.0, planbase-R1.0 for changes')
+        for name in ['RELEASE.local', 'planasyn-R1.0', 'planbase-R1.0']:
+            self.assertTrue(self.locked(name, True), 'No exclusive lock on {0}'.format(name))
+
+    def test_SharedForCachedDependencies(self):
+        self.add_dependencies()
+        self.assertEqual([name for name in os.listdir(cue.cachedir) if name.endswith('.tmp')], [],
+                         'Temporary clones left in the cache')
+        output = self.lock_dependencies()
+        self.assertFalse('for changes' in output, 'Exclusive locks taken for cached dependencies')
+        for name in ['RELEASE.local', 'planasyn-R1.0', 'planbase-R1.0']:
+            self.assertTrue(self.locked(name, False), 'No shared lock on {0}'.format(name))
+            self.assertFalse(self.locked(name, True), 'Exclusive lock on {0}'.format(name))
+        cue.clear_lists()
+        self.assertFalse(self.locked('planbase-R1.0', False), 'Locks not released by clear_lists()')
+
+        with open(os.path.join(self.places[1], 'checked_out'), 'w') as f:
+            f.write('modified')
+        output = self.lock_dependencies()
+        self.assertRegexpMatches(output, 'Locked planasyn-R1.0 for changes')
+        self.assertTrue(self.locked('planasyn-R1.0', True), 'No exclusive lock on the modified dependency')
+        self.assertFalse(self.locked('planbase-R1.0', True), 'Exclusive lock on the unchanged dependency')
+
+    def test_LeaseForLaterPhases(self):
+        self.add_dependencies()
+        cue.clear_lists()
+        cue.lock_used_dependencies()
+        for name in ['RELEASE.local', 'planasyn-R1.0', 'planbase-R1.0']:
+            self.assertTrue(self.locked(name, False), 'No shared lock on {0} in a later phase'.format(name))
+        cue.write_lease()
+        cue.clear_lists()
+        # the lease of this job, as seen by another job with a modified ASYN
+        os.rename(cue.lease_file(), os.path.join(cue.cachedir, 'locks', 'otherjob.lease'))
+        with open(os.path.join(self.places[1], 'checked_out'), 'w') as f:
+            f.write('modified')
+        interval = cue.lease_poll_interval
+        cue.lease_poll_interval = 0.2
+        try:
+            start = cue.time.time()
+            output = self.lock_dependencies(cache_lease=1)
+        finally:
+            cue.lease_poll_interval = interval
+        self.assertRegexpMatches(output, r'Waiting for .* to finish using planasyn-R1.0\n')
+        self.assertRegexpMatches(output, 'Locked planasyn-R1.0 for changes')
+        self.assertTrue(cue.time.time() - start >= 0.5, 'Lease of the other job not respected')
+
+    def test_BranchMovingAfterLocking(self):
+        place = os.path.join(cue.cachedir, 'planasyn-devel')
+        if os.path.exists(place):
+            shutil.rmtree(place, onerror=cue.remove_readonly)
+        self.git(['checkout', '--quiet', '-b', 'devel'])
+        os.environ['ASYN'] = 'devel'
+        self.add_dependencies()
+        head = cue.get_git_hash(place)
+        output = self.lock_dependencies(update_deps=True)
+        self.assertFalse('for changes' in output, 'Exclusive locks taken for the current branch')
+        self.git(['commit', '--quiet', '--allow-empty', '-m', 'second'])
+        self.assertFalse(cue.fetch_dependency('ASYN'), 'Dependency was cloned again')
+        self.assertEqual(cue.get_git_hash(place), head, 'Dependency updated under a shared lock')
+        shutil.rmtree(place, onerror=cue.remove_readonly)
+
+
+class TestDependencyGraph(unittest.TestCase):
+    modules = ['BASE', 'ASYN', 'SSCAN', 'CALC']
+
+    def setUp(self):
+        cue.clear_lists()
+        cue.setup['BASE_VARNAME'] = 'EPICS_BASE'
+        for mod in self.modules:
+            cue.complete_setup(mod)
+            place = os.path.join(cue.cachedir, 'graph-' + mod.lower())
+            if os.path.exists(place):
+                shutil.rmtree(place, onerror=cue.remove_readonly)
+            os.makedirs(place)
+            cue.places[cue.setup[mod + '_VARNAME']] = place
+
+    def write_release_vars(self, mod, names):
+        with open(os.path.join(cue.places[cue.setup[mod + '_VARNAME']], 'release_vars'), 'w') as fout:
+            print('\n'.join(names), file=fout)
+
+    def test_ReleaseVars(self):
+        self.write_release_vars('ASYN', ['EPICS_BASE'])
+        self.write_release_vars('SSCAN', ['SUPPORT', 'EPICS_BASE'])
+        self.write_release_vars('CALC', ['SUPPORT', 'SSCAN', 'EPICS_BASE'])
+        graph = cue.dependency_graph(self.modules)
+        self.assertEqual(graph['BASE'], [], 'BASE depends on {0}'.format(graph['BASE']))
+        self.assertEqual(graph['ASYN'], ['BASE'], 'ASYN depends on {0} (expected [BASE])'.format(graph['ASYN']))
+        self.assertEqual(graph['CALC'], ['BASE', 'SSCAN'],
+                         'CALC depends on {0} (expected [BASE, SSCAN])'.format(graph['CALC']))
+
+    def test_MissingReleaseVars(self):
+        self.write_release_vars('ASYN', ['EPICS_BASE'])
+        graph = cue.dependency_graph(self.modules)
+        self.assertEqual(graph['CALC'], ['BASE', 'ASYN', 'SSCAN'],
+                         'CALC without release_vars depends on {0} (expected all modules before it)'
+                         .format(graph['CALC']))
+
+    def build(self, failing=None):
+        events = []
+        running = {'jobs': 0, 'max': 0}
+        lock = cue.threading.Lock()
+        names = dict((place, mod) for (mod, place) in
+                     [(mod, cue.places[cue.setup[mod + '_VARNAME']]) for mod in self.modules])
+
+        def call_make(args=[], cwd=None, parallel=0, **kws):
+            mod = names[cwd]
+            with lock:
+                events.append(('start', mod, parallel))
+                running['jobs'] += parallel
+                running['max'] = max(running['max'], running['jobs'])
+            cue.time.sleep(0.2)
+            with lock:
+                events.append(('finish', mod, parallel))
+                running['jobs'] -= parallel
+            if mod == failing:
+                sys.exit(2)
+
+        building_base = cue.building_base
+        make = cue.call_make
+        cue.building_base = False
+        cue.call_make = call_make
+        cue.setup['MODULES'] = 'asyn sscan calc'
+        cue.ci['clean_deps'] = False
+        cue.ci['parallel_make'] = 4
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            cue.build_dependencies(self.modules)
+            exitcode = 0
+        except SystemExit as e:
+            exitcode = e.code
+        finally:
+            sys.stdout = sys.__stdout__
+            cue.call_make = make
+            cue.building_base = building_base
+        return (events, running['max'], exitcode)
+
+    def test_BuildSchedule(self):
+        for mod in ['ASYN', 'SSCAN']:
+            self.write_release_vars(mod, ['EPICS_BASE'])
+        self.write_release_vars('CALC', ['SSCAN', 'EPICS_BASE'])
+        (events, most, exitcode) = self.build()
+        self.assertEqual(exitcode, 0, 'Build failed')
+        order = [(event, mod) for (event, mod, jobs) in events]
+        self.assertEqual(order[:2], [('start', 'BASE'), ('finish', 'BASE')], 'BASE not built first ({0})'.format(order))
+        self.assertTrue(order.index(('start', 'SSCAN')) < order.index(('finish', 'ASYN'))
+                        and order.index(('start', 'ASYN')) < order.index(('finish', 'SSCAN')),
+                        'Independent modules not built at the same time ({0})'.format(order))
+        self.assertTrue(order.index(('finish', 'SSCAN')) < order.index(('start', 'CALC')),
+                        'CALC started before SSCAN was built ({0})'.format(order))
+        self.assertEqual(events[0][2], 4, 'BASE alone did not get all make jobs ({0})'.format(events))
+        self.assertTrue(most <= 4, 'Builds used {0} make jobs at the same time (budget 4)'.format(most))
+
+    def test_FailureStopsDependents(self):
+        for mod in ['ASYN', 'SSCAN']:
+            self.write_release_vars(mod, ['EPICS_BASE'])
+        self.write_release_vars('CALC', ['SSCAN', 'EPICS_BASE'])
+        (events, most, exitcode) = self.build(failing='SSCAN')
+        self.assertEqual(exitcode, 2, 'Failed build did not fail the phase')
+        self.assertFalse([event for event in events if event[1] == 'CALC'],
+                         'Dependent of a failed module was built ({0})'.format(events))
+
+    def test_CycleBuiltInModuleOrder(self):
+        self.write_release_vars('ASYN', ['EPICS_BASE', 'CALC'])
+        self.write_release_vars('SSCAN', ['EPICS_BASE'])
+        self.write_release_vars('CALC', ['EPICS_BASE', 'ASYN'])
+        (events, most, exitcode) = self.build()
+        self.assertEqual(exitcode, 0, 'Build failed')
+        order = [(event, mod) for (event, mod, jobs) in events]
+        self.assertTrue(order.index(('finish', 'ASYN')) < order.index(('start', 'CALC')),
+                        'Modules in a dependency loop not built one after the other ({0})'.format(order))
+        self.assertEqual(sorted(mod for (event, mod) in order if event == 'finish'), sorted(self.modules),
+                         'Not all modules built ({0})'.format(order))
+
+
+class TestBuildKey(unittest.TestCase):
+    modules = ['BASE', 'ASYN', 'SSCAN']
+
+    def setUp(self):
+        cue.clear_lists()
+        for mod in self.modules:
+            cue.complete_setup(mod)
+            place = os.path.join(cue.cachedir, 'key-' + mod.lower())
+            if os.path.exists(place):
+                shutil.rmtree(place, onerror=cue.remove_readonly)
+            os.makedirs(place)
+            cue.places[cue.setup[mod + '_VARNAME']] = place
+            self.set_commit(mod, 'commit-of-' + mod)
+            if mod != 'BASE':
+                with open(os.path.join(place, 'release_vars'), 'w') as fout:
+                    print('EPICS_BASE', file=fout)
+        # pretend fresh clones, so that nothing gets reset
+        cue.cloned_modules.extend(self.modules)
+        cue.check_build_keys(self.modules)
+        [cue.write_built_key(mod) for mod in self.modules]
+        del cue.modules_to_compile[:]
+
+    def set_commit(self, mod, commit):
+        with open(os.path.join(cue.places[cue.setup[mod + '_VARNAME']], 'checked_out'), 'w') as fout:
+            print(commit, file=fout)
+
+    def test_UnchangedKey(self):
+        cue.check_build_keys(self.modules)
+        self.assertEqual(cue.modules_to_compile, [],
+                         'Modules with unchanged build key set to compile ({0})'.format(cue.modules_to_compile))
+
+    def test_ConfigurationChange(self):
+        cue.ci['configuration'] = 'static-debug'
+        cue.check_build_keys(self.modules)
+        self.assertEqual(cue.modules_to_compile, self.modules,
+                         'Changed configuration did not set all modules to compile ({0})'
+                         .format(cue.modules_to_compile))
+
+    def test_UpstreamChange(self):
+        self.set_commit('BASE', 'another-commit')
+        cue.check_build_keys(self.modules)
+        self.assertEqual(cue.modules_to_compile, self.modules,
+                         'Changed BASE commit did not set all modules to compile ({0})'
+                         .format(cue.modules_to_compile))
+
+    def test_IndependentModuleChange(self):
+        self.set_commit('ASYN', 'another-commit')
+        cue.check_build_keys(self.modules)
+        self.assertEqual(cue.modules_to_compile, ['ASYN'],
+                         'Changed ASYN commit did not set only ASYN to compile ({0})'
+                         .format(cue.modules_to_compile))
+
+    def test_UpstreamRemoved(self):
+        with open(os.path.join(cue.places['SSCAN'], 'release_vars'), 'w') as fout:
+            print('EPICS_BASE ASYN', file=fout)
+        cue.check_build_keys(self.modules)
+        [cue.write_built_key(mod) for mod in self.modules]
+        del cue.modules_to_compile[:]
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.check_build_keys(['BASE', 'SSCAN'])
+        sys.stdout = sys.__stdout__
+        self.assertEqual(cue.modules_to_compile, ['SSCAN'],
+                         'Removing ASYN did not set SSCAN to compile ({0})'.format(cue.modules_to_compile))
+        self.assertRegexpMatches(capturedOutput.getvalue(), r'SSCAN needs to be rebuilt \(ASYN removed\)')
+
+
+class TestCompilerCache(unittest.TestCase):
+    bindir = os.path.join(builddir, 'fakeccache')
+    stats = 'direct_cache_hit\t30\npreprocessed_cache_hit\t10\ncache_miss\t10\ncache_size_kibibyte\t524288\n'
+
+    def setUp(self):
+        cue.clear_lists()
+        os.makedirs(self.bindir)
+        ccache = os.path.join(self.bindir, 'ccache')
+        with open(ccache, 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = "--print-stats" ] && printf "{0}"\nexit 0\n'.format(self.stats))
+        os.chmod(ccache, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.bindir + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        for var in ['CCACHE_DIR', 'CCACHE_MAXSIZE']:
+            os.environ.pop(var, None)
+        shutil.rmtree(self.bindir)
+        cue.clear_lists()
+
+    def test_MissingLauncherDisablesCache(self):
+        cue.ci['ccache'] = 'xxdoesnotexistxx'
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.setup_ccache()
+        sys.stdout = sys.__stdout__
+        self.assertEqual(cue.ci['ccache'], None, 'Missing compiler cache launcher not disabled')
+
+    def test_MissingLauncherRemovedFromBase(self):
+        base = os.path.join(self.bindir, 'base')
+        os.makedirs(os.path.join(base, 'configure', 'os'))
+        config = os.path.join(base, 'configure', 'os', 'CONFIG_SITE.Common.linux-test')
+        with open(config, 'w') as f:
+            f.write('\nCC          = /usr/bin/ccache gcc\nCCC         = /usr/bin/ccache g++\nUSR_CFLAGS += -O1\n')
+        cue.places['EPICS_BASE'] = base
+        host_arch = os.environ.get('EPICS_HOST_ARCH')
+        os.environ['EPICS_HOST_ARCH'] = 'linux-test'
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            cue.remove_ccache_launcher()
+        finally:
+            sys.stdout = sys.__stdout__
+            if host_arch is None:
+                os.environ.pop('EPICS_HOST_ARCH')
+            else:
+                os.environ['EPICS_HOST_ARCH'] = host_arch
+        with open(config) as f:
+            self.assertEqual(f.read(), '\nCC          = gcc\nCCC         = g++\nUSR_CFLAGS += -O1\n',
+                             'Compiler cache launcher not removed from the configuration of Base')
+
+    @unittest.skipIf(ci_os == 'windows', 'Fake ccache is a shell script')
+    def test_CacheInCachedirAndStats(self):
+        cue.ci['ccache'] = 'ccache'
+        cue.ci['ccache_size'] = '2G'
+        cue.setup_ccache()
+        self.assertEqual(os.environ['CCACHE_DIR'], os.path.join(cue.cachedir, 'ccache'), 'Cache not in cachedir')
+        self.assertEqual(os.environ['CCACHE_MAXSIZE'], '2G', 'Cache size limit not set')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.print_ccache_stats()
+        sys.stdout = sys.__stdout__
+        self.assertRegexpMatches(capturedOutput.getvalue(), r'40 hits, 10 misses \(80% hit rate\), 0.50 GB used')
+
+    def test_CompilerCacheChange(self):
+        modules = ['BASE', 'ASYN']
+        for mod in modules:
+            cue.complete_setup(mod)
+            place = os.path.join(cue.cachedir, 'ccache-' + mod.lower())
+            if os.path.exists(place):
+                shutil.rmtree(place, onerror=cue.remove_readonly)
+            os.makedirs(place)
+            cue.places[cue.setup[mod + '_VARNAME']] = place
+            with open(os.path.join(place, 'checked_out'), 'w') as fout:
+                print('commit-of-' + mod, file=fout)
+        # pretend fresh clones, so that nothing gets reset
+        cue.cloned_modules.extend(modules)
+        cue.check_build_keys(modules)
+        for ccache in ['ccache', None]:
+            [cue.write_built_key(mod) for mod in modules]
+            del cue.modules_to_compile[:]
+            cue.ci['ccache'] = ccache
+            capturedOutput = getStringIO()
+            sys.stdout = capturedOutput
+            cue.check_build_keys(modules)
+            sys.stdout = sys.__stdout__
+            self.assertEqual(cue.modules_to_compile, modules,
+                             'Changing the compiler cache to {0} did not set all modules to compile ({1})'
+                             .format(ccache, cue.modules_to_compile))
+            self.assertRegexpMatches(capturedOutput.getvalue(), r'BASE needs to be rebuilt \(ccache changed\)')
+
+
+class TestParallelMake(unittest.TestCase):
+    top = os.path.join(builddir, 'parallelmake')
+
+    def setUp(self):
+        cue.clear_lists()
+        os.makedirs(os.path.join(self.top, 'src', 'O.linux-x86_64'))
+        for name in ['a.cpp', 'b.cpp', 'c.c', os.path.join('O.linux-x86_64', 'd.c'), os.path.join('O.linux-x86_64', 'e.c')]:
+            open(os.path.join(self.top, 'src', name), 'w').close()
+        self.commands = []
+        self.run = cue.run
+        cue.run = lambda cmd, **kws: self.commands.append(cmd) or (0, None)
+
+    def tearDown(self):
+        cue.run = self.run
+        os.environ.pop('PARALLEL_MAKE', None)
+        shutil.rmtree(self.top)
+        cue.clear_lists()
+
+    def test_SetNumber(self):
+        os.environ['PARALLEL_MAKE'] = '3'
+        cue.detect_context()
+        self.assertEqual(cue.ci['parallel_make'], 3, "ci['parallel_make'] is {0!r} (expected: 3)"
+                         .format(cue.ci['parallel_make']))
+        self.assertEqual(cue.ci['make_load'], None, 'Load limit set for explicit PARALLEL_MAKE')
+
+    def test_Auto(self):
+        cue.detect_context()
+        self.assertTrue(1 <= cue.ci['parallel_make'] <= cue.cpu_count(),
+                        "ci['parallel_make'] is {0!r}".format(cue.ci['parallel_make']))
+        self.assertEqual(cue.ci['make_load'], cue.usable_cpus(), 'Load limit not set to the number of CPUs')
+
+    def test_ModuleJobMemory(self):
+        self.assertEqual(cue.module_job_memory(self.top), cue.make_job_memory['c++'],
+                         'C++ module (ignoring build directories) not detected')
+        open(os.path.join(self.top, 'src', 'f.c'), 'w').close()
+        self.assertEqual(cue.module_job_memory(self.top), cue.make_job_memory['c++'],
+                         'Sources of the module counted again')
+        cue.clear_lists()
+        self.assertEqual(cue.module_job_memory(self.top), cue.make_job_memory['c'], 'C module not detected')
+
+    def test_JobsLimitedByMemory(self):
+        cue.ci['memory'] = 3 * 1024 * 1024 * 1024
+        cue.ci['make_load'] = 8
+        cue.call_make(['all'], parallel=8, cwd=self.top)
+        self.assertEqual(self.commands, [['make', '-j3', '-l8', '-Otarget', 'all']],
+                         'Unexpected make command {0}'.format(self.commands))
+
+
+class TestArtifactStore(unittest.TestCase):
+    place = os.path.join(cue.cachedir, 'artifact-asyn')
+    built = os.path.join(place, 'lib', 'linux-x86_64', 'libasyn.a')
+
+    def setUp(self):
+        cue.clear_lists()
+        cue.ci['artifact_store'] = os.path.join(cue.cachedir, 'artifact-store')
+        for path in [self.place, cue.ci['artifact_store']]:
+            if os.path.exists(path):
+                shutil.rmtree(path, onerror=cue.remove_readonly)
+        os.makedirs(os.path.dirname(self.built))
+        with open(self.built, 'w') as fout:
+            print('library', file=fout)
+        os.utime(self.built, (1000000000, 1000000000))
+        cue.complete_setup('ASYN')
+        cue.places['ASYN'] = self.place
+        cue.build_keys['ASYN'] = {'key': 'key-of-asyn', 'inputs': {}}
+        cue.save_artifacts('ASYN')
+        shutil.rmtree(os.path.join(self.place, 'lib'), onerror=cue.remove_readonly)
+
+    def test_RestoreKeepsMtime(self):
+        self.assertTrue(cue.restore_artifacts('ASYN'), 'Build products were not restored')
+        self.assertTrue(os.path.exists(self.built), 'Restored build products do not contain {0}'.format(self.built))
+        self.assertEqual(int(os.path.getmtime(self.built)), 1000000000,
+                         'Restored build product does not have its original mtime')
+
+    def test_OtherKeyNotRestored(self):
+        cue.build_keys['ASYN']['key'] = 'another-key'
+        self.assertFalse(cue.restore_artifacts('ASYN'), 'Build products for a different build key were restored')
+
+
 def is_shallow_repo(place):
     check = sp.check_output(['git', 'rev-parse', '--is-shallow-repository'], cwd=place).strip().decode('ascii')
     if check == '--is-shallow-repository':
@@ -672,6 +1514,571 @@ class TestAppveyorDetectContext(unittest.TestCase):
         self.assertRegexpMatches(capturedOutput.getvalue(), "Unrecognized build configuration setting")
 
 
+class TestHostArch(unittest.TestCase):
+    base = os.path.join(cue.cachedir, 'hostarch-base')
+    memo_file = os.path.join(cue.cachedir, 'host_arch.json')
+
+    def setUp(self):
+        cue.clear_lists()
+        if os.path.exists(self.base):
+            shutil.rmtree(self.base, onerror=cue.remove_readonly)
+        if os.path.exists(self.memo_file):
+            os.remove(self.memo_file)
+        os.makedirs(os.path.join(self.base, 'configure', 'os'))
+        os.makedirs(os.path.join(self.base, 'startup'))
+        self.setScriptResult('fake-arch')
+
+    def setScriptResult(self, arch):
+        with open(os.path.join(self.base, 'startup', 'EpicsHostArch.pl'), 'w') as fout:
+            print('print "{0}\\n";'.format(arch), file=fout)
+
+    def test_NativeDetection(self):
+        archs = [arch for system in cue.host_arch_map.values() for pattern, arch in system]
+        for arch in archs:
+            open(os.path.join(self.base, 'configure', 'os', 'CONFIG.Common.' + arch), 'w').close()
+        native = cue.native_host_arch(self.base)
+        if native is None:
+            self.skipTest('No native mapping for this host')
+        self.assertTrue(native in archs, 'Unexpected native host architecture {0}'.format(native))
+
+    def test_UnsupportedArchUsesPerl(self):
+        self.assertEqual(cue.native_host_arch(self.base), None,
+                         'Native host architecture returned although not supported by Base')
+        self.assertEqual(cue.perl_host_arch(self.base), 'fake-arch', 'EpicsHostArch.pl result not used')
+
+    def test_PerlResultMemoizedPerCommit(self):
+        with open(os.path.join(self.base, 'checked_out'), 'w') as fout:
+            print('commit-of-base', file=fout)
+        cue.perl_host_arch(self.base)
+        self.setScriptResult('other-arch')
+        self.assertEqual(cue.perl_host_arch(self.base), 'fake-arch', 'EpicsHostArch.pl run again for same commit')
+        with open(os.path.join(self.base, 'checked_out'), 'w') as fout:
+            print('another-commit', file=fout)
+        self.assertEqual(cue.perl_host_arch(self.base), 'other-arch', 'EpicsHostArch.pl not run for new commit')
+
+
+class TestProbes(unittest.TestCase):
+    tool = os.path.join(cue.cachedir, 'probe-tool')
+    probe_file = os.path.join(cue.cachedir, 'probes.json')
+
+    def setUp(self):
+        cue.clear_lists()
+        if os.path.exists(self.probe_file):
+            os.remove(self.probe_file)
+        with open(self.tool, 'w') as fout:
+            print('#!/bin/sh\necho version 1', file=fout)
+        os.chmod(self.tool, 0o755)
+        os.utime(self.tool, (1000000000, 1000000000))
+
+    @unittest.skipIf(ci_os == 'windows', 'Probe test uses a shell script')
+    def test_ProbeCachedByMtime(self):
+        self.assertEqual(cue.probe_result([self.tool]), [0, 'version 1\n'], 'Unexpected probe result')
+        with open(self.tool, 'w') as fout:
+            print('#!/bin/sh\necho version 2', file=fout)
+        os.utime(self.tool, (1000000000, 1000000000))
+        cue.clear_lists()
+        self.assertEqual(cue.probe_result([self.tool])[1], 'version 1\n', 'Probe with unchanged mtime run again')
+        os.utime(self.tool, (1000000100, 1000000100))
+        self.assertEqual(cue.probe_result([self.tool])[1], 'version 2\n', 'Probe with changed mtime not run again')
+
+    @unittest.skipIf(ci_os == 'windows', 'Probe test uses a shell script')
+    def test_StartedProbeUsed(self):
+        cue.start_probes([[self.tool]])
+        self.assertEqual(cue.probe_result([self.tool])[1], 'version 1\n', 'Unexpected result of started probe')
+        self.assertEqual(cue.pending_probes, {}, 'Started probe still pending after its result was used')
+
+
+class TestRun(unittest.TestCase):
+    python = [sys.executable, '-c']
+
+    def setUp(self):
+        cue.clear_lists()
+
+    def test_CaptureTail(self):
+        (exitcode, output) = cue.run(self.python + ['for i in range(1000): print(i)'], capture=3)
+        self.assertEqual(exitcode, 0, 'Unexpected exit code {0}'.format(exitcode))
+        self.assertEqual(output.split(), ['997', '998', '999'], 'Captured tail is not the last 3 lines')
+
+    def test_OnLine(self):
+        lines = []
+        cue.run(self.python + ['print("one"); print("two")'], on_line=lines.append)
+        self.assertEqual([line.strip() for line in lines], ['one', 'two'], 'Lines not passed to on_line')
+
+    def test_Timeout(self):
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        (exitcode, output) = cue.run(self.python + ['import time; time.sleep(30)'], timeout=1)
+        sys.stdout = sys.__stdout__
+        self.assertNotEqual(exitcode, 0, 'Command killed after timeout returned success')
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'killed after 1 seconds')
+
+    def test_IdleTimeout(self):
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        (exitcode, output) = cue.run(self.python + ['import sys, time; print("alive"); sys.stdout.flush(); '
+                                                    'time.sleep(30)'], capture=True, idle_timeout=1)
+        sys.stdout = sys.__stdout__
+        self.assertNotEqual(exitcode, 0, 'Command killed after idle timeout returned success')
+        self.assertEqual(output.strip(), 'alive', 'Output before the idle timeout not collected')
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'killed after 1 seconds without output')
+
+    def test_RetriesAndHooks(self):
+        infos = []
+        cue.run_hooks.append(infos.append)
+        sleep = cue.time.sleep
+        cue.time.sleep = lambda seconds: None
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            (exitcode, output) = cue.run(self.python + ['import sys; sys.exit(3)'], retries=2)
+            self.assertEqual(exitcode, 3, 'Unexpected exit code {0}'.format(exitcode))
+            self.assertEqual([info['attempt'] for info in infos], [0, 1, 2], 'Failed command not retried twice')
+            del infos[:]
+            cue.run(self.python + ['import sys; sys.exit(3)'], retries=2, retry_codes=[128])
+            self.assertEqual(len(infos), 1, 'Command retried for an exit code not in retry_codes')
+        finally:
+            sys.stdout = sys.__stdout__
+            cue.time.sleep = sleep
+            cue.run_hooks.remove(infos.append)
+
+
+class TestMakeOutputProcessor(unittest.TestCase):
+
+    def feed(self, on_line, lines):
+        [on_line(line + '\n') for line in lines]
+
+    def test_WarningsDeduplicated(self):
+        (on_line, report) = cue.make_output_processor()
+        self.feed(on_line, ["make[1]: Entering directory '/top/src'"]
+                  + 3 * ["foo.c:3:4: warning: unused variable 'x' [-Wunused-variable]"]
+                  + ["bar.c(12): warning C4996: 'strcpy': This function may be unsafe",
+                     "make[1]: Leaving directory '/top/src'"])
+        text = report(False)
+        self.assertRegexpMatches(text, r"4 warning\(s\), 0 error\(s\)")
+        self.assertRegexpMatches(text, r"foo\.c:3:4: warning: unused variable 'x' \[-Wunused-variable\] \[3x\]")
+        self.assertRegexpMatches(text, r"bar\.c\(12\): warning: C4996: 'strcpy'")
+        self.assertFalse('Last lines' in text, 'Output shown although make succeeded')
+
+    def test_FailureShowsTailOfFailingDirectory(self):
+        (on_line, report) = cue.make_output_processor(tail_lines=10)
+        self.feed(on_line, ["make[1]: Entering directory '/top/good'"]
+                  + ['good line {0}'.format(i) for i in range(1000)]
+                  + ["make[1]: Leaving directory '/top/good'",
+                     "make[1]: Entering directory '/top/bad'"]
+                  + ['bad line {0}'.format(i) for i in range(1000)]
+                  + ["bad.c:1:2: error: boom",
+                     "make[1]: *** [../RULES:10: bad.o] Error 1",
+                     "make[1]: Leaving directory '/top/bad'"])
+        text = report(True)
+        self.assertRegexpMatches(text, 'Last lines of output in /top/bad')
+        self.assertFalse('/top/good' in text or 'good line' in text, 'Output of successful directory shown')
+        self.assertFalse('bad line 991' in text, 'More than the last 10 lines shown')
+        self.assertTrue('bad line 992' in text and 'Error 1' in text, 'Last lines before the error not shown')
+
+
+class TestTrace(unittest.TestCase):
+    trace_file = os.path.join(cue.cachedir, 'trace.json')
+
+    def setUp(self):
+        cue.clear_lists()
+        cue.ci['trace_file'] = self.trace_file
+        if os.path.exists(self.trace_file):
+            os.remove(self.trace_file)
+
+    def tearDown(self):
+        cue.clear_lists()
+
+    def test_TraceFileAccumulates(self):
+        cue.fold_start('test.fold', 'Test fold')
+        cue.run(['git', '--version'])
+        self.assertRaises(sp.CalledProcessError, cue.run,
+                          ['git', 'rev-parse', '--verify', '--quiet', 'refs/heads/xxdoesnotexistxx'], check=True)
+        cue.fold_end('test.fold', 'Test fold')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.write_trace('test')
+        cue.write_trace('test')
+        sys.stdout = sys.__stdout__
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'Timing summary for test')
+        with open(self.trace_file) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(len(events), 8, 'Trace file does not contain both sets of events ({0})'.format(events))
+        exitcodes = dict((event['name'], event['args'].get('exitcode')) for event in events if event['ph'] == 'X')
+        self.assertEqual(exitcodes['git --version'], 0, 'Exit code of successful command not recorded')
+        self.assertNotEqual(exitcodes['git rev-parse --verify --quiet refs/heads/xxdoesnotexistxx'], 0,
+                            'Exit code of failing command not recorded')
+        self.assertTrue('Test fold' in exitcodes, 'Fold not recorded')
+
+    @unittest.skipIf(not hasattr(os, 'wait4'), 'Needs os.wait4 for the CPU time of each command')
+    def test_CommandCpuTimeOwnOnly(self):
+        busy = [sys.executable, '-c', 'import time\nend = time.time() + 1\nwhile time.time() < end: pass']
+        idle = [sys.executable, '-c', 'import time; time.sleep(2)']
+        worker = cue.threading.Thread(target=cue.run, args=(busy,))
+        worker.start()
+        cue.run(idle)
+        worker.join()
+        cpu = dict(('sleep' in event['name'], event['args']) for event in cue.trace_events)
+        self.assertTrue(cpu[False]['user'] > 0.5, 'CPU time of busy command not recorded')
+        self.assertTrue(cpu[True]['user'] < 0.5,
+                        'CPU time of command running in parallel counted ({0})'.format(cpu[True]))
+
+
+class TestTestRunner(unittest.TestCase):
+    top = os.path.join(builddir, 'testrunner')
+    arch = 'linux-test'
+    scripts = {
+        'ok': 'print "1..2\\nok 1 - one\\nok 2 - two\\n"; exit 0;',
+        'failing': 'print "1..1\\nnot ok 1 - one\\n"; exit 1;',
+        'hanging': '$| = 1; print "1..1\\n"; sleep 30;',
+    }
+
+    def setUp(self):
+        cue.clear_lists()
+        cue.ci['test_idle_timeout'] = 1
+        os.environ['EPICS_HOST_ARCH'] = self.arch
+        for arch in [self.arch, 'other-arch']:
+            testdir = os.path.join(self.top, 'src', 'O.' + arch)
+            os.makedirs(testdir)
+            for name, script in self.scripts.items():
+                with open(os.path.join(testdir, name + 'Test.t'), 'w') as f:
+                    f.write(script)
+        durations_file = os.path.join(cue.cachedir, 'test_durations.json')
+        if os.path.exists(durations_file):
+            os.remove(durations_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+        cue.clear_lists()
+
+    def test_FindsTestsOfHostArch(self):
+        tests = cue.find_tests(self.top, self.arch)
+        self.assertEqual(tests, [os.path.join('src', 'O.' + self.arch, name + 'Test.t')
+                                 for name in sorted(self.scripts)],
+                         'Unexpected test scripts found ({0})'.format(tests))
+
+    def test_RunWritesTapFiles(self):
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        failed = cue.run_tests(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 2, 'Unexpected number of failed tests ({0})'.format(failed))
+        testdir = os.path.join(self.top, 'src', 'O.' + self.arch)
+        with open(os.path.join(testdir, 'okTest.tap')) as f:
+            self.assertEqual(f.read(), '1..2\nok 1 - one\nok 2 - two\n', 'Wrong contents of .tap file')
+        with open(os.path.join(testdir, 'hangingTest.tap')) as f:
+            self.assertRegexpMatches(f.read(), '^1..1\nBail out! Killed', 'Hanging test not marked as killed')
+        self.assertFalse(os.path.exists(os.path.join(self.top, 'src', 'O.other-arch', 'okTest.tap')),
+                         'Test of other architecture was run')
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'KILLED .*hangingTest.t')
+
+    def test_StderrNotInTapFile(self):
+        testdir = os.path.join(self.top, 'src', 'O.' + self.arch)
+        os.remove(os.path.join(testdir, 'hangingTest.t'))
+        with open(os.path.join(testdir, 'noisyTest.t'), 'w') as f:
+            f.write('print STDERR "some warning\\n"; print "1..1\\nok 1\\n"; exit 0;')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        failed = cue.run_tests(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 1, 'Unexpected number of failed tests ({0})'.format(failed))
+        with open(os.path.join(testdir, 'noisyTest.tap')) as f:
+            self.assertEqual(f.read(), '1..1\nok 1\n', 'Stderr of the test written to the .tap file')
+
+    def test_FailuresFailTestAction(self):
+        os.remove(os.path.join(self.top, 'src', 'O.' + self.arch, 'hangingTest.t'))
+        cue.ci['test_runner'] = 'native'
+        (curdir, setup_for_build) = (cue.curdir, cue.setup_for_build)
+        cue.curdir = self.top
+        cue.setup_for_build = lambda args: None
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        try:
+            self.assertRaises(SystemExit, cue.test, Namespace(shard=None))
+            cue.ci['defer_test_failures'] = True
+            cue.test(Namespace(shard=None))
+        finally:
+            sys.stdout = sys.__stdout__
+            (cue.curdir, cue.setup_for_build) = (curdir, setup_for_build)
+
+    def test_HistoryNamesIncludeModule(self):
+        testdir = os.path.join(self.top, 'src', 'O.' + self.arch)
+        os.remove(os.path.join(testdir, 'hangingTest.t'))
+        cue.ci['history'] = os.path.join(cue.cachedir, 'history.db')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.run_tests(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(sorted(record[2] for record in cue.history_records if record[1] == 'test'),
+                         ['testrunner/src/O.linux-test/failingTest.t', 'testrunner/src/O.linux-test/okTest.t'],
+                         'Test history not recorded by module ({0})'.format(cue.history_records))
+
+    def test_LongestTestsFirst(self):
+        testdir = os.path.abspath(os.path.join(self.top, 'src', 'O.' + self.arch))
+        with open(os.path.join(cue.cachedir, 'test_durations.json'), 'w') as f:
+            json.dump({'testrunner/src/O.linux-test/okTest.t': 0.1,
+                       'testrunner/src/O.linux-test/failingTest.t': 5.0}, f)
+        cue.ci['test_jobs'] = 1
+        os.remove(os.path.join(testdir, 'hangingTest.t'))
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.run_tests(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertRegexpMatches(capturedOutput.getvalue(), r'FAILED .*failingTest.t[^\n]*\n[^\n]*okTest.t',
+                                 'Test that took longest was not run first')
+
+    def test_RetriesFailedTests(self):
+        testdir = os.path.join(self.top, 'src', 'O.' + self.arch)
+        os.remove(os.path.join(testdir, 'hangingTest.t'))
+        with open(os.path.join(testdir, 'flakyTest.t'), 'w') as f:
+            f.write('if (-e "flag") { print "1..1\\nok 1\\n"; exit 0; }\n'
+                    'open(F, ">flag"); close(F); print "1..1\\nnot ok 1\\n"; exit 1;\n')
+        cue.ci['test_retries'] = 2
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        failed = cue.run_tests(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 1, 'Unexpected number of failed tests ({0})'.format(failed))
+        with open(os.path.join(self.top, 'test-flaky.json')) as f:
+            report = json.load(f)
+        self.assertEqual(report['flaky'], [{'test': 'src/O.linux-test/flakyTest.t', 'attempts': ['failed', 'ok']}],
+                         'Flaky test not reported ({0})'.format(report))
+        self.assertEqual(report['failed'], [{'test': 'src/O.linux-test/failingTest.t',
+                                             'attempts': ['failed', 'failed', 'failed']}],
+                         'Failing test not retried twice ({0})'.format(report))
+        self.assertTrue(os.path.exists(os.path.join(testdir, 'flakyTest.tap.1')), 'Output of failed run not kept')
+        with open(os.path.join(testdir, 'flakyTest.tap')) as f:
+            self.assertEqual(f.read(), '1..1\nok 1\n', 'Output of passing retry not in .tap file')
+
+    def test_RunsOnlyShard(self):
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.ci['test_idle_timeout'] = 0
+        cue.ci['test_timeout'] = 1
+        failed = [cue.run_tests(self.top, (index, 2)) for index in [1, 2]]
+        sys.stdout = sys.__stdout__
+        self.assertEqual(sum(failed), 2, 'Failing tests not run in exactly one shard ({0})'.format(failed))
+        self.assertEqual(len(re.findall('OK .*okTest.t', capturedOutput.getvalue())), 1,
+                         'Passing test not run in exactly one shard')
+
+    def test_ShardReportsItsTests(self):
+        testdir = os.path.join(self.top, 'src', 'O.' + self.arch)
+        os.remove(os.path.join(testdir, 'hangingTest.t'))
+        for i in range(8):
+            with open(os.path.join(testdir, 't{0}Test.t'.format(i)), 'w') as f:
+                f.write('print "1..1\\nnot ok 1\\n"; exit 1;' if i == 3 else 'print "1..1\\nok 1\\n"; exit 0;')
+        durations_file = os.path.join(self.top, 'durations.json')
+        with open(durations_file, 'w') as f:
+            json.dump(dict(('testrunner/src/O.linux-test/t{0}Test.t'.format(i), float(10 - i)) for i in range(8)), f)
+        cue.ci['test_durations'] = durations_file
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.run_tests(self.top, (1, 2))
+        sys.stdout = sys.__stdout__
+        ran = sorted(os.path.join('src', 'O.' + self.arch, name[:-4] + '.t')
+                     for name in os.listdir(testdir) if name.endswith('.tap'))
+        # the job of this shard has no .tap files of the other shard, but one left over from an earlier run
+        with open(os.path.join(testdir, 'oldTest.tap'), 'w') as f:
+            f.write('1..1\nnot ok 1\n')
+        sys.stdout = capturedOutput
+        cue.report_test_results(self.top, (1, 2))
+        sys.stdout = sys.__stdout__
+        with open(os.path.join(self.top, 'test-results-1of2.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['totals']['files'], len(ran),
+                         'Shard reported {0} files, ran {1}'.format(summary['totals']['files'], ran))
+        self.assertEqual(summary['totals']['failed_files'],
+                         len([test for test in ran if 'failing' in test or 't3Test' in test]),
+                         'Failures of the shard not reported as they ran')
+
+
+class TestTestShards(unittest.TestCase):
+    top = os.path.join(builddir, 'testshards')
+    tests = [os.path.join('src', 'O.linux-test', 'test{0}.t'.format(i)) for i in range(20)]
+    durations_file = os.path.join(builddir, 'test_durations.json')
+
+    def setUp(self):
+        cue.clear_lists()
+
+    def tearDown(self):
+        if os.path.exists(self.top):
+            shutil.rmtree(self.top)
+        if os.path.exists(self.durations_file):
+            os.remove(self.durations_file)
+        cue.clear_lists()
+
+    def test_ParseShard(self):
+        self.assertEqual(cue.parse_shard('2/4'), (2, 4), 'Shard not parsed')
+        for text in ['0/4', '5/4', '4', 'a/b']:
+            self.assertRaises(ValueError, cue.parse_shard, text)
+
+    def test_HashSplit(self):
+        shards = [cue.select_shard(self.top, self.tests, (index, 3)) for index in [1, 2, 3]]
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.tests), 'Shards do not contain every test once')
+        self.assertEqual(shards, [cue.select_shard(self.top, self.tests, (index, 3)) for index in [1, 2, 3]],
+                         'Split is not deterministic')
+
+    def test_DurationSplit(self):
+        durations = dict(('testshards/' + test.replace(os.sep, '/'), float(i)) for (i, test) in enumerate(self.tests))
+        with open(self.durations_file, 'w') as f:
+            json.dump(durations, f)
+        cue.ci['test_durations'] = self.durations_file
+        shards = [cue.select_shard(self.top, self.tests, (index, 3)) for index in [1, 2, 3]]
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.tests), 'Shards do not contain every test once')
+        totals = [sum(durations['testshards/' + test.replace(os.sep, '/')] for test in shard) for shard in shards]
+        self.assertTrue(max(totals) - min(totals) <= 2, 'Shards not balanced by duration ({0})'.format(totals))
+
+    def test_MergeShardResults(self):
+        tapdir = os.path.join(self.top, 'src', 'O.linux-test')
+        os.makedirs(tapdir)
+        for i in range(10):
+            with open(os.path.join(tapdir, 'test{0}.tap'.format(i)), 'w') as f:
+                f.write('1..2\nok 1\nnot ok 2\n' if i == 3 else '1..1\nok 1\n')
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        for index in [1, 2]:
+            cue.report_test_results(self.top, (index, 2))
+        sys.stdout = sys.__stdout__
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        failed = cue.merge_test_results(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 1, 'Unexpected number of failed files ({0})'.format(failed))
+        with open(os.path.join(self.top, 'test-results.json')) as f:
+            summary = json.load(f)
+        self.assertEqual((summary['totals']['files'], summary['totals']['run']), (10, 11), 'Shard totals not merged')
+        junit = ET.parse(os.path.join(self.top, 'test-results.xml')).getroot()
+        self.assertEqual(len(junit), 10, 'Test suites of shards not merged')
+        # remove the report of the shard without the failing test
+        other = 2 if cue.select_shard(self.top, [os.path.join('src', 'O.linux-test', 'test3.t')], (1, 2)) else 1
+        os.remove(os.path.join(self.top, 'test-results-{0}of2.json'.format(other)))
+        sys.stdout = capturedOutput
+        failed = cue.merge_test_results(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 2, 'Missing shard not reported as failure')
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'missing [12]')
+
+
+class TestTestResults(unittest.TestCase):
+    top = os.path.join(builddir, 'testresults')
+    tapfiles = {
+        os.path.join('src', 'O.linux-test', 'okTest.tap'):
+            '1..3\nok 1 - one\n# diagnostic\nok 2 # SKIP no network\nnot ok 3 - three # TODO later\n',
+        os.path.join('src', 'O.linux-test', 'failingTest.tap'):
+            '1..2\nok 1 - one\nnot ok 2 - two\n',
+        os.path.join('test', 'O.linux-test', 'noPlanTest.tap'):
+            'ok 1 - one\n',
+        os.path.join('test', 'O.linux-test', 'bailedTest.tap'):
+            '1..5\nok 1\nBail out! Killed by the test runner after 10 seconds\n',
+        os.path.join('test', 'O.linux-test', 'manyTest.tap'):
+            '1..5000\n' + ''.join('ok {0} - point {0}\n'.format(i) for i in range(1, 5001)),
+    }
+
+    def setUp(self):
+        cue.clear_lists()
+        for (tapfile, text) in self.tapfiles.items():
+            filename = os.path.join(self.top, tapfile)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+        cue.clear_lists()
+
+    def test_ParseTap(self):
+        result = cue.parse_tap(os.path.join(self.top, 'src', 'O.linux-test', 'okTest.tap'))
+        self.assertEqual((result['planned'], result['run'], result['passed'], result['skipped'], result['todo']),
+                         (3, 3, 1, 1, 1), 'Unexpected counts ({0})'.format(result))
+        self.assertEqual(result['problems'], [], 'Passing TAP file has problems ({0})'.format(result['problems']))
+        result = cue.parse_tap(os.path.join(self.top, 'src', 'O.linux-test', 'failingTest.tap'))
+        self.assertEqual(result['problems'], ['not ok 2 - two'], 'Failed test point not found')
+        result = cue.parse_tap(os.path.join(self.top, 'test', 'O.linux-test', 'noPlanTest.tap'))
+        self.assertEqual(result['problems'], ['No plan'], 'Missing plan not detected')
+        result = cue.parse_tap(os.path.join(self.top, 'test', 'O.linux-test', 'bailedTest.tap'))
+        self.assertEqual(len(result['problems']), 2, 'Bail out and short run not detected ({0})'
+                         .format(result['problems']))
+
+    def test_HashInDescription(self):
+        tapfile = os.path.join(self.top, 'hashTest.tap')
+        with open(tapfile, 'w') as f:
+            f.write('1..4\nok 1 - channel #3 connected\nnot ok 2 - value # 5 wrong\nok 3 # SKIP\n'
+                    'not ok 4 - is # todo: later\n')
+        result = cue.parse_tap(tapfile)
+        self.assertEqual((result['run'], result['passed'], result['failed'], result['skipped'], result['todo']),
+                         (4, 1, 1, 1, 1), 'Unexpected counts ({0})'.format(result))
+        self.assertEqual(result['problems'], ['not ok 2 - value # 5 wrong'], 'Failed test point not found')
+        self.assertEqual(result['points'][0][1], 'channel #3 connected', 'Description cut at #')
+        self.assertEqual(result['points'][3], (4, 'is', 'todo', 'later'), 'TODO directive not parsed')
+
+    def test_Reports(self):
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        failed = cue.report_test_results(self.top)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(failed, 3, 'Unexpected number of failed TAP files ({0})'.format(failed))
+        self.assertRegexpMatches(capturedOutput.getvalue(), 'FAILED src/O.linux-test/failingTest.tap')
+        with open(os.path.join(self.top, 'test-results.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['totals']['run'], 5007, 'Wrong total ({0})'.format(summary['totals']))
+        self.assertEqual(summary['directories']['test/O.linux-test']['failed_files'], 2,
+                         'Wrong directory totals ({0})'.format(summary['directories']))
+        junit = ET.parse(os.path.join(self.top, 'test-results.xml')).getroot()
+        suites = dict((suite.get('name'), suite) for suite in junit)
+        self.assertEqual(len(suites), 5, 'Not one test suite per TAP file')
+        self.assertEqual(suites['src/O.linux-test/failingTest'].get('failures'), '1', 'Failure not counted')
+        self.assertEqual(len(suites['test/O.linux-test/manyTest'].findall('testcase')), 5000,
+                         'Not one test case per test point')
+
+    def test_NoTapFiles(self):
+        shutil.rmtree(self.top)
+        os.makedirs(self.top)
+        self.assertEqual(cue.report_test_results(self.top), None, 'Results reported without TAP files')
+
+
+class TestHistory(unittest.TestCase):
+    history_file = os.path.join(cue.cachedir, 'history.db')
+    args = Namespace(kind=None, name=None, days=0, window=3, threshold=20)
+
+    def setUp(self):
+        cue.clear_lists()
+        cue.ci['history'] = self.history_file
+        if os.path.exists(self.history_file):
+            os.remove(self.history_file)
+
+    def tearDown(self):
+        cue.clear_lists()
+
+    def test_RecordsAreWritten(self):
+        cue.record_history('clone', 'BASE', cue.time.time() - 2, 'cached')
+        cue.record_history('test', 'src/O.linux-x86_64/fooTest.t', cue.time.time() - 5, 'ok')
+        cue.write_history('test')
+        db = cue.open_history(self.history_file)
+        rows = list(db.execute('SELECT kind, name, outcome, phase, duration FROM history ORDER BY kind'))
+        db.close()
+        self.assertEqual([row[:4] for row in rows],
+                         [('clone', 'BASE', 'cached', 'test'), ('test', 'src/O.linux-x86_64/fooTest.t', 'ok', 'test')],
+                         'Unexpected history records ({0})'.format(rows))
+        self.assertTrue(4.9 < rows[1][4] < 6, 'Wrong duration recorded ({0})'.format(rows[1][4]))
+
+    def test_ReportsRegressions(self):
+        db = cue.open_history(self.history_file)
+        with db:
+            for (index, duration) in enumerate([10, 11, 10, 9, 10, 20, 21, 19]):
+                db.execute('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (1000 + index, 'dependency', 'ASYN', duration, 'built', 'mod', 'prepare', 'cfg', 'host'))
+                db.execute('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (1000 + index, 'test', 'fooTest.t', 5, 'ok', 'mod', 'test', 'cfg', 'host'))
+        db.close()
+        capturedOutput = getStringIO()
+        sys.stdout = capturedOutput
+        cue.history(self.args)
+        sys.stdout = sys.__stdout__
+        self.assertRegexpMatches(capturedOutput.getvalue(), r'dependency\s+8\s+11.0 .*\+100%\s+0%  ASYN')
+        self.assertRegexpMatches(capturedOutput.getvalue(), r'dependency ASYN: 10.0s -> 20.0s')
+        self.assertFalse('test fooTest.t:' in capturedOutput.getvalue(), 'Unchanged test reported as slower')
+
+
 class TestSetupForBuild(unittest.TestCase):
     args = Namespace(paths=[])
     cue.building_base = True
@@ -806,6 +2213,47 @@ class TestSetupForBuild(unittest.TestCase):
         cue.setup_for_build(self.args)
         self.assertTrue(cue.has_test_results, 'Target test-results not detected')
 
+    def test_SnapshotReusedUntilInputChanges(self):
+        self.setBase314('YES')
+        cue.setup_for_build(self.args)
+        resolve_build_env = cue.resolve_build_env
+        calls = []
+        cue.resolve_build_env = lambda args: calls.append(args) or resolve_build_env(args)
+        try:
+            os.environ.pop('EPICS_HOST_ARCH', None)
+            cue.clear_lists()
+            cue.detect_context()
+            cue.setup_for_build(self.args)
+            self.assertEqual(len(calls), 0, 'Build environment detected again with unchanged inputs')
+            self.assertTrue(cue.is_base314, 'Base 3.14 = YES not restored from snapshot')
+            os.environ.pop('EPICS_HOST_ARCH', None)
+            cue.clear_lists()
+            cue.detect_context()
+            self.setBase314('NO')
+            cue.setup_for_build(self.args)
+            self.assertEqual(len(calls), 1, 'Build environment not detected again after CONFIG_BASE_VERSION changed')
+            self.assertFalse(cue.is_base314, 'Falsely detected Base 3.14')
+        finally:
+            cue.resolve_build_env = resolve_build_env
+
+    def test_SnapshotsOfOtherSettingsKept(self):
+        self.setBase314('NO')
+        resolve_build_env = cue.resolve_build_env
+        calls = []
+        cue.resolve_build_env = lambda args: calls.append(args) or resolve_build_env(args)
+        try:
+            for extra in ['a', 'b', 'a', 'b']:
+                os.environ['EXTRA'] = extra
+                os.environ.pop('EPICS_HOST_ARCH', None)
+                cue.clear_lists()
+                cue.detect_context()
+                cue.setup_for_build(self.args)
+                self.assertEqual(cue.extra_makeargs[0], extra, 'Snapshot of other settings used')
+            self.assertEqual(len(calls), 2, 'Snapshot replaced by one with other settings')
+        finally:
+            cue.resolve_build_env = resolve_build_env
+            os.environ.pop('EXTRA', None)
+
     def test_ExtraMakeArgs(self):
         os.environ['EXTRA'] = 'bla'
         for ind in range(1,5):
@@ -5,11 +5,32 @@
 from __future__ import print_function
 
 import sys, os, stat, shutil
-import fileinput
+import collections
+import hashlib
+import io
+import json
 import logging
+import platform
 import re
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
+try:
+    import sqlite3
+except ImportError:
+    # Python built without SQLite: no build history
+    sqlite3 = None
+try:
+    import fcntl
+except ImportError:
+    # Windows: no locks on the cache
+    fcntl = None
 import subprocess as sp
+import tarfile
 import distutils.util
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
@@ -78,48 +99,237 @@ def detect_context():
     if 'TEST' in os.environ and os.environ['TEST'].lower() == 'no':
         ci['test'] = False
 
-    ci['parallel_make'] = 2
-    if 'PARALLEL_MAKE' in os.environ:
-        ci['parallel_make'] = os.environ['PARALLEL_MAKE']
+    if 'TEST_RUNNER' in os.environ and os.environ['TEST_RUNNER'].lower() == 'native':
+        ci['test_runner'] = 'native'
+    if 'TEST_JOBS' in os.environ:
+        ci['test_jobs'] = int(os.environ['TEST_JOBS'])
+    if 'TEST_TIMEOUT' in os.environ:
+        ci['test_timeout'] = int(os.environ['TEST_TIMEOUT'])
+    if 'TEST_IDLE_TIMEOUT' in os.environ:
+        ci['test_idle_timeout'] = int(os.environ['TEST_IDLE_TIMEOUT'])
+    if 'TEST_RETRIES' in os.environ:
+        ci['test_retries'] = int(os.environ['TEST_RETRIES'])
+    if 'DEFER_TEST_FAILURES' in os.environ and os.environ['DEFER_TEST_FAILURES'].lower() == 'yes':
+        ci['defer_test_failures'] = True
+    if 'TEST_SHARD' in os.environ and os.environ['TEST_SHARD']:
+        ci['test_shard'] = parse_shard(os.environ['TEST_SHARD'])
+    if 'TEST_DURATIONS' in os.environ and os.environ['TEST_DURATIONS']:
+        ci['test_durations'] = os.path.abspath(os.environ['TEST_DURATIONS'])
+    if 'TEST_REPORT_DIR' in os.environ and os.environ['TEST_REPORT_DIR']:
+        ci['test_report_dir'] = os.path.abspath(os.environ['TEST_REPORT_DIR'])
+
+    ci['make_load'] = None
+    if 'PARALLEL_MAKE' in os.environ and os.environ['PARALLEL_MAKE'].lower() not in ['', 'auto']:
+        ci['parallel_make'] = int(os.environ['PARALLEL_MAKE'])
+    else:
+        # as many jobs as there are usable CPUs and memory for (at least 512 MiB per job), limit load
+        ci['memory'] = memory_limit()
+        ci['parallel_make'] = usable_cpus()
+        if ci['memory']:
+            ci['parallel_make'] = max(1, min(ci['parallel_make'], ci['memory'] // make_job_memory['c']))
+        ci['make_load'] = usable_cpus()
+
+    ci['parallel_clone'] = 4
+    if 'PARALLEL_CLONE' in os.environ:
+        ci['parallel_clone'] = int(os.environ['PARALLEL_CLONE'])
+
+    if 'GIT_MIRROR' in os.environ and os.environ['GIT_MIRROR'].lower() in ['1', 'yes']:
+        ci['git_mirror'] = True
+
+    if 'UPDATE_DEPS' in os.environ and os.environ['UPDATE_DEPS'].lower() in ['1', 'yes']:
+        ci['update_deps'] = True
+
+    # by default, only builds of other configurations are kept (when their checkout is reset)
+    ci['artifact_store'] = os.path.join(cachedir, 'artifacts')
+    if 'ARTIFACT_STORE' in os.environ and os.environ['ARTIFACT_STORE'].lower() in ['0', 'no']:
+        ci['artifact_store'] = None
+    elif 'ARTIFACT_STORE' in os.environ and os.environ['ARTIFACT_STORE']:
+        ci['save_artifacts'] = True
+        if os.environ['ARTIFACT_STORE'].lower() not in ['1', 'yes']:
+            ci['artifact_store'] = os.path.abspath(os.environ['ARTIFACT_STORE'])
+
+    if 'LOG_TIMESTAMPS' in os.environ and os.environ['LOG_TIMESTAMPS'].lower() in ['1', 'yes']:
+        ci['timestamps'] = True
+    if 'NET_RETRIES' in os.environ:
+        ci['net_retries'] = int(os.environ['NET_RETRIES'])
+    if 'NET_TIMEOUT' in os.environ and os.environ['NET_TIMEOUT']:
+        ci['net_timeout'] = int(os.environ['NET_TIMEOUT'])
+
+    if 'CCACHE' in os.environ and os.environ['CCACHE'].lower() not in ['', '0', 'no'] \
+            and re.match(r'^(gcc|clang)', ci['compiler']):
+        if os.environ['CCACHE'].lower() in ['1', 'yes']:
+            ci['ccache'] = 'ccache'
+        else:
+            ci['ccache'] = os.environ['CCACHE']
+    if 'CCACHE_SIZE' in os.environ and os.environ['CCACHE_SIZE']:
+        ci['ccache_size'] = os.environ['CCACHE_SIZE']
+
+    if 'HISTORY' in os.environ and os.environ['HISTORY'].lower() in ['1', 'yes']:
+        ci['history'] = os.path.join(cachedir, 'history.db')
+
+    if 'TRACE_FILE' in os.environ and os.environ['TRACE_FILE']:
+        ci['trace_file'] = os.path.abspath(os.environ['TRACE_FILE'])
+
+    if 'REF_CACHE_TTL' in os.environ:
+        ci['ref_ttl'] = int(os.environ['REF_CACHE_TTL'])
+    if 'CACHE_LEASE' in os.environ:
+        ci['cache_lease'] = int(os.environ['CACHE_LEASE'])
+    if 'REFRESH_REFS' in os.environ and os.environ['REFRESH_REFS'].lower() in ['1', 'yes']:
+        ci['refresh_refs'] = True
 
     ci['clean_deps'] = True
     if 'CLEAN_DEPS' in os.environ and os.environ['CLEAN_DEPS'].lower() == 'no':
         ci['clean_deps'] = False
 
     logger.debug('Detected a build hosted on %s, using %s on %s (%s) configured as %s '
-                 + '(test: %s, clean_deps: %s)',
+                 + '(test: %s, clean_deps: %s, parallel_make: %s, make_load: %s)',
                  ci['service'], ci['compiler'], ci['os'], ci['platform'], ci['configuration'],
-                 ci['test'], ci['clean_deps'])
+                 ci['test'], ci['clean_deps'], ci['parallel_make'], ci['make_load'])
+
+
+# Memory (bytes) that a make job needs for compiling C resp. C++ code
+make_job_memory = {'c': 512 * 1024 * 1024, 'c++': 1024 * 1024 * 1024}
+
+
+# usable_cpus()
+#
+# Return the number of CPUs that this process may use: the smaller of affinity mask (where available)
+# and cgroup (v2 or v1) CPU quota
+def usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = cpu_count()
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            fields = f.read().split()
+        if fields[0] != 'max':
+            quota = float(fields[0]) / float(fields[1])
+    except (IOError, OSError, IndexError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                us = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if us > 0 and period > 0:
+                quota = float(us) / period
+        except (IOError, OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, int(quota + 0.5))
+    return max(1, cpus)
+
+
+# memory_limit()
+#
+# Return the memory (bytes) that this process may use: the smaller of physical memory and
+# cgroup (v2 or v1) memory limit, or None if it cannot be determined
+def memory_limit():
+    limits = []
+    try:
+        limits.append(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        pass
+    for limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_file) as f:
+                limits.append(int(f.read()))
+            break
+        except (IOError, OSError, ValueError):
+            # no such file, or 'max' (no limit)
+            pass
+    limits = [limit for limit in limits if limit > 0]
+    return min(limits) if limits else None
+
+
+# module_job_memory(top)
+#
+# Return the memory a make job needs for the module in top: more if it has more C++ than C sources
+# (counted once per directory and run)
+def module_job_memory(top):
+    top = os.path.abspath(top)
+    if top in job_memory_cache:
+        return job_memory_cache[top]
+    counts = {'c': 0, 'c++': 0}
+    for root, dirs, files in os.walk(top):
+        dirs[:] = [name for name in dirs if not name.startswith('.') and not name.startswith('O.')]
+        for name in files:
+            ext = os.path.splitext(name)[1]
+            if ext == '.c':
+                counts['c'] += 1
+            elif ext in ['.cpp', '.cc', '.cxx']:
+                counts['c++'] += 1
+    job_memory_cache[top] = make_job_memory['c++' if counts['c++'] > counts['c'] else 'c']
+    return job_memory_cache[top]
 
 
 curdir = os.getcwd()
 
 ci = {}
-seen_setups = []
+seen_setups = set()
+setup_files = {}
+setup_env = set()
+setup_includes = []
 modules_to_compile = []
 setup = {}
 places = {}
+ref_cache = {}
+resolved_refs = {}
+ref_cache_lock = threading.Lock()
+cloned_modules = []
+build_keys = {}
+mirror_locks = {}
+cache_locks = {}
+mirrors_updated = []
+restored_modules = []
+detected_host_arch = None
+probe_cache = {}
+pending_probes = {}
+job_memory_cache = {}
+trace_events = []
+trace_lock = threading.Lock()
+output_lock = threading.Lock()
+thread_output = threading.local()
+fold_starts = {}
+history_records = []
 extra_makeargs = []
 
 is_base314 = False
 is_make3 = False
 has_test_results = False
 silent_dep_builds = True
-do_recompile = False
 
 
 def clear_lists():
-    global is_base314, has_test_results, silent_dep_builds, is_make3
-    del seen_setups[:]
+    global is_base314, has_test_results, silent_dep_builds, is_make3, detected_host_arch
+    seen_setups.clear()
+    setup_files.clear()
+    setup_env.clear()
+    del setup_includes[:]
     del modules_to_compile[:]
     del extra_makeargs[:]
     setup.clear()
     places.clear()
+    ref_cache.clear()
+    resolved_refs.clear()
+    del cloned_modules[:]
+    build_keys.clear()
+    [lock.close() for lock in cache_locks.values()]
+    cache_locks.clear()
+    del mirrors_updated[:]
+    del restored_modules[:]
+    probe_cache.clear()
+    pending_probes.clear()
+    job_memory_cache.clear()
+    del trace_events[:]
+    fold_starts.clear()
+    del history_records[:]
     is_base314 = False
     is_make3 = False
     has_test_results = False
+    detected_host_arch = None
     silent_dep_builds = True
-    do_recompile = False
     ci['service'] = '<none>'
     ci['os'] = '<unknown>'
     ci['platform'] = '<unknown>'
@@ -130,6 +340,33 @@ def clear_lists():
     ci['scriptsdir'] = ''
     ci['choco'] = ['make']
     ci['apt'] = []
+    ci['ref_ttl'] = 0
+    ci['cache_lease'] = 600
+    ci['refresh_refs'] = False
+    ci['git_mirror'] = False
+    ci['update_deps'] = False
+    ci['artifact_store'] = None
+    ci['save_artifacts'] = False
+    ci['trace_file'] = None
+    ci['timestamps'] = False
+    ci['net_retries'] = 0
+    ci['net_timeout'] = None
+    ci['test_runner'] = 'make'
+    ci['test_jobs'] = 0
+    ci['test_timeout'] = 1800
+    ci['test_idle_timeout'] = 600
+    ci['test_report_dir'] = None
+    ci['history'] = None
+    ci['test_shard'] = None
+    ci['test_retries'] = 0
+    ci['defer_test_failures'] = False
+    ci['ccache'] = None
+    ci['ccache_size'] = '1G'
+    ci['memory'] = None
+    ci['test_durations'] = None
+    ci['parallel_make'] = 2
+    ci['make_load'] = None
+    ci['parallel_clone'] = 4
 
 
 clear_lists()
@@ -155,6 +392,7 @@ ANSI_CLEAR = "\033[0K"
 # from https://github.com/travis-ci/travis-rubies/blob/build/build.sh
 
 def fold_start(tag, title):
+    fold_starts[tag] = (time.time(), os.times())
     if ci['service'] == 'travis':
         print('travis_fold:start:{0}{1}{2}{3}'
               .format(tag, ANSI_YELLOW, title, ANSI_RESET))
@@ -165,6 +403,10 @@ def fold_start(tag, title):
 
 
 def fold_end(tag, title):
+    if tag in fold_starts:
+        (start, cpu_start) = fold_starts.pop(tag)
+        cpu_end = os.times()
+        add_trace_event(title, 'fold', start, (cpu_end[2] - cpu_start[2], cpu_end[3] - cpu_start[3]))
     if ci['service'] == 'travis':
         print('\ntravis_fold:end:{0}\r'
               .format(tag), end='')
@@ -174,6 +416,126 @@ def fold_end(tag, title):
     sys.stdout.flush()
 
 
+# add_trace_event(name, category, start, cpu=None, args={})
+#
+# Record a (completed) trace event that started at time start
+# cpu is the (user, system) CPU time in seconds, the event has no CPU times if it is None
+# (for folds it is that of all child processes that ended in the meantime, also those of other threads)
+def add_trace_event(name, category, start, cpu=None, args={}):
+    if not ci['trace_file']:
+        return
+    end = time.time()
+    if cpu is not None:
+        args = dict(args, user=round(cpu[0], 3), system=round(cpu[1], 3))
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start * 1000000),
+        'dur': int((end - start) * 1000000),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args,
+    }
+    with trace_lock:
+        trace_events.append(event)
+
+
+# trace_run(info)
+#
+# Hook for run(): record every command as trace event
+def trace_run(info):
+    name = info['cmd']
+    add_trace_event(name if len(name) <= 80 else name[:77] + '...', 'subprocess', info['start'], info['cpu'],
+                    {'exitcode': info['exitcode'], 'cwd': info['cwd'], 'attempt': info['attempt']})
+
+
+# write_trace(phase)
+#
+# Print a summary of the trace events of this phase (sorted by wall time)
+# and add them to the Chrome trace file ci['trace_file'] (which accumulates all phases)
+def write_trace(phase):
+    if not ci['trace_file'] or not trace_events:
+        return
+    print('{0}Timing summary for {1}{2}'.format(ANSI_CYAN, phase, ANSI_RESET))
+    print('   Wall[s]  User[s]   Sys[s]  Exit  Name')
+    print(100 * '-')
+    for event in sorted(trace_events, key=lambda e: e['dur'], reverse=True)[:30]:
+        exitcode = event['args'].get('exitcode', '')
+        cpu = ['%8.3f' % event['args'][key] if key in event['args'] else '       -' for key in ('user', 'system')]
+        print('%10.3f %s %s  %4s  %s%s' % (event['dur'] / 1000000., cpu[0], cpu[1],
+                                          '-' if exitcode is None else exitcode,
+                                          '[{0}] '.format(event['cat']) if event['cat'] == 'fold' else '',
+                                          event['name']))
+    sys.stdout.flush()
+
+    trace = {'traceEvents': []}
+    if os.path.exists(ci['trace_file']):
+        try:
+            with open(ci['trace_file']) as f:
+                trace = json.load(f)
+        except ValueError:
+            logger.debug('Overwriting corrupt trace file %s', ci['trace_file'])
+    trace['traceEvents'].append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                                 'args': {'name': 'cue {0}'.format(phase)}})
+    trace['traceEvents'].extend(trace_events)
+    try:
+        write_file_atomic(ci['trace_file'], json.dumps(trace))
+    except (IOError, OSError) as e:
+        print('{0}Cannot write trace file {1} ({2}){3}'.format(ANSI_RED, ci['trace_file'], e, ANSI_RESET))
+        sys.stdout.flush()
+
+
+# record_history(kind, name, start, outcome)
+#
+# Remember the duration (since start) and outcome of a step for the history database
+# kind is one of 'clone', 'dependency', 'test', 'phase'
+def record_history(kind, name, start, outcome):
+    if ci['history']:
+        with trace_lock:
+            history_records.append((start, kind, name, time.time() - start, outcome))
+
+
+history_schema = '''CREATE TABLE IF NOT EXISTS history (
+    time REAL, kind TEXT, name TEXT, duration REAL, outcome TEXT,
+    project TEXT, phase TEXT, config TEXT, runner TEXT)'''
+
+
+# open_history(filename)
+#
+# Open (creating it if needed) the history database in filename
+def open_history(filename):
+    db = sqlite3.connect(filename, timeout=60)
+    db.execute(history_schema)
+    db.execute('CREATE INDEX IF NOT EXISTS history_kind_name ON history (kind, name, time)')
+    return db
+
+
+# write_history(phase)
+#
+# Add the records of this phase to the history database ci['history']
+def write_history(phase):
+    if not ci['history'] or not history_records:
+        return
+    if not sqlite3:
+        print('{0}Python has no sqlite3 module, not recording history{1}'.format(ANSI_YELLOW, ANSI_RESET))
+        sys.stdout.flush()
+        return
+    project = os.path.basename(curdir)
+    config = '{0}-{1}-{2}'.format(ci['os'], ci['compiler'], ci['configuration'])
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        db = open_history(ci['history'])
+        with db:
+            db.executemany('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [record + (project, phase, config, platform.node()) for record in history_records])
+        db.close()
+    except (sqlite3.Error, OSError) as e:
+        print('{0}Cannot write history database {1} ({2}){3}'.format(ANSI_RED, ci['history'], e, ANSI_RESET))
+        sys.stdout.flush()
+
+
 homedir = curdir
 if 'HomeDrive' in os.environ:
     homedir = os.path.join(os.getenv('HomeDrive'), os.getenv('HomePath'))
@@ -211,6 +573,7 @@ def modlist():
         ret = []
     else:
         for var in ['ADD_MODULES', 'MODULES']:
+            setup_env.add(var)
             setup.setdefault(var, '')
             if var in os.environ:
                 setup[var] = os.environ[var]
@@ -248,8 +611,9 @@ def remove_readonly(func, path, excinfo):
 #
 # Source a settings file (extension .set) found in the setup_dirs path
 # May be called recursively (from within a setup file)
-def source_set(name):
+def source_set(name, parent=None):
     # allowed separators: colon or whitespace
+    setup_env.add('SETUP_PATH')
     setup_dirs = os.getenv('SETUP_PATH', "").replace(':', ' ').split()
     if len(setup_dirs) == 0:
         raise NameError("{0}Search path for setup files (SETUP_PATH) is empty{1}".format(ANSI_RED, ANSI_RESET))
@@ -261,8 +625,10 @@ def source_set(name):
             print("Ignoring already included setup file {0}".format(set_file))
             return
 
+        setup_files[set_file] = file_state(set_file)
         if os.path.isfile(set_file):
-            seen_setups.append(set_file)
+            seen_setups.add(set_file)
+            setup_includes.append((parent, set_file))
             print("Opening setup file {0}".format(set_file))
             sys.stdout.flush()
             with open(set_file) as fp:
@@ -272,9 +638,10 @@ def source_set(name):
                     if line.startswith("include"):
                         logger.debug('%s: Found include directive, reading %s next',
                                      set_file, line.split()[1])
-                        source_set(line.split()[1])
+                        source_set(line.split()[1], set_file)
                         continue
                     assign = line.replace('"', '').strip().split("=", 1)
+                    setup_env.add(assign[0])
                     setup.setdefault(assign[0], os.getenv(assign[0], ""))
                     if not setup[assign[0]].strip():
                         logger.debug('%s: setup[%s] = %s', set_file, assign[0], assign[1])
@@ -286,51 +653,160 @@ def source_set(name):
                         .format(ANSI_RED, name, setup_dirs, ANSI_RESET))
 
 
-# update_release_local(var, location)
-#   var       name of the variable to set in RELEASE.local
-#   location  location (absolute path) of where variable should point to
+# load_setup(save=True)
 #
-# Manipulate RELEASE.local in the cache location:
-# - replace "$var=$location" line if it exists and has changed
-# - otherwise add "$var=$location" line and possibly move EPICS_BASE=... line to the end
-# Set places[var] = location
-def update_release_local(var, location):
-    release_local = os.path.join(cachedir, 'RELEASE.local')
-    updated_line = '{0}={1}'.format(var, location.replace('\\', '/'))
-    places[var] = location
+# Load the setup: the SET file (if any) and defaults with their includes, environment overrides
+# and the complete_setup() defaults of all modules
+# The result is cached in $CACHEDIR/setups.json (unless save is False, one entry per directory and consulted
+# environment), and used from there while all contributing files (and the files in SETUP_PATH that would take
+# precedence) and environment variables are unchanged
+def load_setup(save=True):
+    cache_file = os.path.join(cachedir, 'setups.json')
+    cached = None
+    for entry in read_keyed_cache(cache_file).values():
+        if entry['cwd'] == os.getcwd() \
+                and all(os.environ.get(var) == value for var, value in entry['env'].items()) \
+                and all(file_state(path) == state for path, state in entry['files'].items()):
+            cached = entry
+            break
+    if cached:
+        logger.debug('Using setup from %s', cache_file)
+        setup.update(cached['setup'])
+        seen_setups.update(path for parent, path in cached['includes'])
+        setup_includes.extend(tuple(edge) for edge in cached['includes'])
+        print('Using cached setup from {0} files'.format(len(cached['includes'])))
+    else:
+        setup_env.add('SET')
+        if 'SET' in os.environ:
+            source_set(os.environ['SET'])
+        source_set('defaults')
+        for mod in modlist():
+            setup_env.update(mod + postf for postf in ['', '_DIRNAME', '_REPONAME', '_REPOOWNER', '_REPOURL',
+                                                       '_VARNAME', '_RECURSIVE', '_DEPTH', '_HOOK'])
+            complete_setup(mod)
+        if save:
+            env = dict((var, os.environ.get(var)) for var in setup_env)
+            write_keyed_cache(cache_file, input_hash([os.getcwd(), env]), {
+                'cwd': os.getcwd(),
+                'env': env,
+                'files': setup_files,
+                'includes': setup_includes,
+                'setup': setup,
+            })
+
+    print('Setup file includes:')
+    depth = {None: 0}
+    for (parent, path) in setup_includes:
+        depth[path] = depth[parent] + 1
+        print('{0}{1}'.format('  ' * depth[path], path))
+    sys.stdout.flush()
+
+
+# write_file_atomic(filename, text)
+#
+# Write text to a temporary file next to filename, then rename it into place,
+# so that readers (and crashes) never see a partially written file
+def write_file_atomic(filename, text):
+    tmpfile = '{0}.tmp-{1}-{2}'.format(filename, os.getpid(), threading.current_thread().ident)
+    with open(tmpfile, 'w') as fout:
+        fout.write(text)
+    replace_file(tmpfile, filename)
+
+
+def replace_file(tmpfile, filename):
+    if hasattr(os, 'replace'):
+        os.replace(tmpfile, filename)
+    else:
+        if os.path.exists(filename) and os.name == 'nt':
+            os.remove(filename)
+        os.rename(tmpfile, filename)
+
+
+# input_hash(inputs)
+#
+# Return the hash of inputs (anything JSON serializable) that keys an entry in a shared cache file
+def input_hash(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
 
-    if not os.path.exists(release_local):
-        logger.debug('RELEASE.local does not exist, creating it')
+
+# read_keyed_cache(filename)
+#
+# Return the entries (by input_hash()) of the cache file filename, {} if it does not exist or is corrupt
+def read_keyed_cache(filename):
+    entries = {}
+    if os.path.exists(filename):
         try:
+            with open(filename) as f:
+                entries = json.load(f)
+        except ValueError:
+            logger.debug('Ignoring corrupt cache %s', filename)
+    return entries
+
+
+# write_keyed_cache(filename, key, entry)
+#
+# Add entry with key to the cache file filename, keeping the entries of other jobs sharing the cache
+# (an entry lost to a concurrent write is just computed again)
+def write_keyed_cache(filename, key, entry):
+    entries = read_keyed_cache(filename)
+    entries[key] = entry
+    try:
+        if not os.path.isdir(cachedir):
             os.makedirs(cachedir)
-        except:
-            pass
-        touch = open(release_local, 'w')
-        touch.close()
-    base_line = ''
-    found = False
-    logger.debug("Opening RELEASE.local for adding '%s'", updated_line)
-    for line in fileinput.input(release_local, inplace=1):
-        output_line = line.strip()
-        if 'EPICS_BASE=' in line:
-            base_line = line.strip()
-            logger.debug("Found EPICS_BASE line '%s', not writing it", base_line)
-            continue
-        elif '{0}='.format(var) in line:
-            logger.debug("Found '%s=' line, replacing", var)
-            found = True
-            output_line = updated_line
-        logger.debug("Writing line to RELEASE.local: '%s'", output_line)
-        print(output_line)
-    fileinput.close()
-    release_local = open(release_local, "a")
-    if not found:
-        logger.debug("Adding new definition: '%s'", updated_line)
-        print(updated_line, file=release_local)
-    if base_line:
-        logger.debug("Writing EPICS_BASE line: '%s'", base_line)
-        print(base_line, file=release_local)
-    release_local.close()
+        write_file_atomic(filename, json.dumps(entries, indent=1, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug('Could not write cache %s: %s', filename, e)
+
+
+# release_local_text(entries)
+#
+# Return the content of a RELEASE.local file that sets the variables in entries (a list of (var, location)),
+# in the order of the list, but with the EPICS_BASE line at the end
+def release_local_text(entries):
+    return ''.join('{0}={1}\n'.format(var, location.replace('\\', '/'))
+                   for (var, location) in sorted(entries, key=lambda entry: entry[0] == 'EPICS_BASE'))
+
+
+# write_if_changed(filename, text)
+#
+# Atomically replace the content of filename with text, unless it already has that content
+# (keeping its modification time, so that make does not see a change)
+# Returns True if the file has been written
+def write_if_changed(filename, text):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == text:
+                logger.debug('%s is unchanged', filename)
+                return False
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    write_file_atomic(filename, text)
+    return True
+
+
+# release_local_entries(mods)
+#
+# Return the (var, location) entries of RELEASE.local for the dependencies in mods
+def release_local_entries(mods):
+    entries = []
+    for dep in mods:
+        var = setup[dep + '_VARNAME']
+        if var not in [entry[0] for entry in entries]:
+            entries.append((var, places[var]))
+    return entries
+
+
+# write_release_local(mods)
+#
+# Write RELEASE.local in the cache location, setting $dep_VARNAME to the location of each dependency in mods
+# (in one go, after all of them have been added)
+# Returns the content of the file
+def write_release_local(mods):
+    text = release_local_text(release_local_entries(mods))
+    if write_if_changed(os.path.join(cachedir, 'RELEASE.local'), text):
+        logger.debug('Wrote RELEASE.local for %s', ', '.join(mods))
+    return text
 
 
 def set_setup_from_env(dep):
@@ -341,20 +817,204 @@ def set_setup_from_env(dep):
             logger.debug('ENV assignment: %s = %s', dep + postf, setup[dep + postf])
 
 
-def call_git(args, **kws):
-    if 'cwd' in kws:
-        place = kws['cwd']
-    else:
-        place = os.getcwd()
-    logger.debug("EXEC '%s' in %s", ' '.join(['git'] + args), place)
+# Functions called with a dict (cmd, cwd, start, cpu, attempt, exitcode) after each command that run() runs
+run_hooks = [trace_run]
+script_start = time.time()
+
+
+# run(cmd, cwd=None, shell=False, capture=False, stdout=None, stderr=None, on_line=None, pipe=None,
+#     timeout=None, idle_timeout=None, on_kill=None, retries=0, retry_codes=None, check=False)
+#
+# Run the command cmd (a list, or a string for shell=True); all commands are started here
+# - capture: collect the output instead of printing it (True: all of it, a number: only that many last lines)
+# - stdout, stderr: redirection as for subprocess (stderr=sp.STDOUT to also collect stderr);
+#   stdout disables piping, stderr of collected output (capture, on_line) goes to the log directly by default
+# - on_line: function that is called with every line of output instead of printing it
+# - pipe: False to let the command write to the log directly (no timestamps, nothing collected)
+# - timeout: kill the command (and on POSIX its children) after that many seconds
+# - idle_timeout: kill the command if it has not printed a line for that many seconds (needs pipe)
+# - on_kill: function that is called with the reason if the command has been killed for a timeout
+# - retries: run a failed command again up to that many times (only for exit codes in retry_codes, if given)
+# - check: raise sp.CalledProcessError if the command fails
+# Printed output lines get a timestamp if ci['timestamps'] is set
+# Returns the exit code and the collected output (None if not captured)
+def run(cmd, cwd=None, shell=False, capture=False, stdout=None, stderr=None, on_line=None, pipe=None,
+        timeout=None, idle_timeout=None, on_kill=None, retries=0, retry_codes=None, check=False):
+    if stdout is not None:
+        pipe = False
+    elif pipe is None:
+        pipe = bool(capture or on_line or idle_timeout or ci['timestamps'] or collecting_output())
+    if cwd is None:
+        cwd = os.getcwd()
+    name = cmd if shell else ' '.join(cmd)
+    attempt = 0
+    while True:
+        logger.debug("EXEC '%s' in %s", name, cwd)
+        sys.stdout.flush()
+        info = {'cmd': name, 'cwd': cwd, 'start': time.time(), 'cpu': None, 'attempt': attempt, 'exitcode': None}
+        try:
+            (exitcode, output, info['cpu']) = run_process(cmd, cwd, shell, capture, stdout, stderr, on_line, pipe,
+                                                          timeout, idle_timeout, on_kill)
+            info['exitcode'] = exitcode
+        finally:
+            logger.debug('EXEC DONE')
+            for hook in run_hooks:
+                hook(info)
+        if not exitcode or attempt >= retries or (retry_codes and exitcode not in retry_codes):
+            break
+        attempt += 1
+        print_message('{0}Command {1} failed (exit code {2}), trying again in {3} seconds{4}'
+                      .format(ANSI_YELLOW, name, exitcode, 5 * attempt, ANSI_RESET))
+        time.sleep(5 * attempt)
+    if check and exitcode:
+        raise sp.CalledProcessError(exitcode, cmd, output)
+    return exitcode, output
+
+
+# run_process(cmd, cwd, shell, capture, stdout, stderr, on_line, pipe, timeout, idle_timeout, on_kill)
+#
+# Run cmd once for run()
+# Returns the exit code, the collected output (None if not captured) and the (user, system) CPU time
+# of the command and its waited-for children (None where os.wait4 is not available)
+def run_process(cmd, cwd, shell, capture, stdout, stderr, on_line, pipe, timeout, idle_timeout, on_kill):
+    kws = {'cwd': cwd, 'shell': shell, 'stdout': stdout, 'stderr': stderr}
+    if pipe:
+        kws['stdout'] = sp.PIPE
+        if not capture and not on_line and stderr is None:
+            kws['stderr'] = sp.STDOUT
+    if (timeout or idle_timeout) and os.name != 'nt':
+        # own process group, so that the children can be killed as well
+        # (preexec_fn is not safe while other threads are running, Python 2 has nothing else)
+        if sys.version_info[0] >= 3:
+            kws['start_new_session'] = True
+        else:
+            kws['preexec_fn'] = os.setsid
+    proc = sp.Popen(cmd, **kws)
+
+    timed_out = []
+    last_output = [time.time()]
+    finished = threading.Event()
+    if timeout or idle_timeout:
+        def watch():
+            start = time.time()
+            while not finished.wait(0.2):
+                if timeout and time.time() - start > timeout:
+                    timed_out.append('after {0} seconds'.format(timeout))
+                elif idle_timeout and time.time() - last_output[0] > idle_timeout:
+                    timed_out.append('after {0} seconds without output'.format(idle_timeout))
+                else:
+                    continue
+                try:
+                    if os.name == 'nt':
+                        sp.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)])
+                    else:
+                        os.killpg(proc.pid, 9)
+                except OSError:
+                    # ended in the meantime
+                    pass
+                return
+        watchdog = threading.Thread(target=watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+    lines = None
+    try:
+        if pipe:
+            if capture:
+                lines = collections.deque(maxlen=None if capture is True else capture)
+            for raw in iter(proc.stdout.readline, b''):
+                line = raw.decode('utf-8', 'replace')
+                last_output[0] = time.time()
+                if capture:
+                    lines.append(line)
+                if on_line:
+                    on_line(line)
+                elif not capture:
+                    print_line(line)
+            proc.stdout.close()
+        cpu = None
+        if hasattr(os, 'wait4'):
+            # the resource usage of this child only (os.times() also counts those of other threads)
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+            proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            cpu = (usage.ru_utime, usage.ru_stime)
+        exitcode = proc.wait()
+    finally:
+        finished.set()
+    if timed_out:
+        print_message('{0}Command {1} killed {2}{3}'
+                      .format(ANSI_RED, cmd if shell else ' '.join(cmd), timed_out[0], ANSI_RESET))
+        if on_kill:
+            on_kill(timed_out[0])
+    if lines is not None:
+        return exitcode, ''.join(lines), cpu
+    return exitcode, None, cpu
+
+
+# print_line(line)
+#
+# Print a line of command output (with a timestamp if ci['timestamps'] is set)
+def print_line(line):
+    if ci['timestamps']:
+        line = '[{0:8.1f}] {1}'.format(time.time() - script_start, line)
+    if sys.version_info[0] < 3:
+        line = line.encode('utf-8')
+    if collecting_output():
+        thread_output.lines.append(line)
+        return
+    sys.stdout.write(line)
     sys.stdout.flush()
-    exitcode = sp.call(['git'] + args, **kws)
-    logger.debug('EXEC DONE')
-    return exitcode
+
+
+# collecting_output()
+#
+# Return True if the current thread runs collect_output()
+def collecting_output():
+    return getattr(thread_output, 'lines', None) is not None
+
+
+# print_message(text)
+#
+# Print a line of text (or add it to the output that the current thread collects)
+def print_message(text):
+    if collecting_output():
+        thread_output.lines.append(text + '\n')
+    else:
+        print(text)
+        sys.stdout.flush()
+
+
+# collect_output(func, *args)
+#
+# Call func(*args) with the output of print_message(), print_line() and the commands that run() runs
+# collected instead of printed, so that parallel workers do not mix their output
+# Returns the result of func and the collected output; if func raises, the output is printed right away
+def collect_output(func, *args):
+    thread_output.lines = []
+    try:
+        result = func(*args)
+    except BaseException:
+        with output_lock:
+            sys.stdout.write(''.join(thread_output.lines))
+            sys.stdout.flush()
+        raise
+    finally:
+        output = ''.join(thread_output.lines)
+        thread_output.lines = None
+    return result, output
+
+
+# call_git(args, **kws)
+#
+# Run git with args (using run() with kws), returns the exit code
+# net=True applies the retries and timeout for network operations
+def call_git(args, **kws):
+    if kws.pop('net', False):
+        kws.update(retries=ci['net_retries'], retry_codes=[128], timeout=ci['net_timeout'])
+    return run(['git'] + args, **kws)[0]
 
 
 def call_make(args=[], **kws):
-    place = kws.get('cwd', os.getcwd())
     parallel = kws.pop('parallel', ci['parallel_make'])
     silent = kws.pop('silent', False)
     use_extra = kws.pop('use_extra', False)
@@ -362,25 +1022,349 @@ def call_make(args=[], **kws):
     if parallel <= 0 or is_base314:
         makeargs = []
     else:
+        if ci['memory'] and parallel > 1:
+            # automatic setting: fewer jobs for modules that need more memory per job
+            parallel = max(1, min(parallel, ci['memory'] // module_job_memory(kws.get('cwd') or os.getcwd())))
         makeargs = ['-j{0}'.format(parallel)]
+        if ci['make_load']:
+            makeargs += ['-l{0}'.format(ci['make_load'])]
         if not is_make3:
             makeargs += ['-Otarget']
     if silent:
         makeargs += ['-s']
     if use_extra:
         makeargs += extra_makeargs
-    logger.debug("EXEC '%s' in %s", ' '.join(['make'] + makeargs + args), place)
-    sys.stdout.flush()
-    exitcode = sp.call(['make'] + makeargs + args, **kws)
-    logger.debug('EXEC DONE')
+    exitcode = run(['make'] + makeargs + args, **kws)[0]
     if exitcode != 0:
         sys.exit(exitcode)
 
 
+# find_executable(name)
+#
+# Return the location of the executable name in PATH, or None if it is not found
+def find_executable(name):
+    exts = ['']
+    if os.name == 'nt':
+        exts += os.environ.get('PATHEXT', '.EXE').split(os.pathsep)
+    for bindir in os.environ.get('PATH', '').split(os.pathsep):
+        for ext in exts:
+            exe = os.path.join(bindir, name + ext)
+            if os.path.isfile(exe) and os.access(exe, os.X_OK):
+                return exe
+    return None
+
+
+# probe_id(cmd)
+#
+# Return the identity of the executable that the version query cmd runs (location and mtime)
+def probe_id(cmd):
+    exe = find_executable(cmd[0])
+    if not exe:
+        return None
+    return '{0} {1} {2}'.format(exe, os.path.getmtime(exe), ' '.join(cmd[1:]))
+
+
+# probe(cmd)
+#
+# Run the version query cmd and return its exit status and output
+# Results are cached in $CACHEDIR/probes.json by location and mtime of the executable
+def probe(cmd):
+    probe_file = os.path.join(cachedir, 'probes.json')
+    key = probe_id(cmd)
+    with ref_cache_lock:
+        if not probe_cache and os.path.exists(probe_file):
+            try:
+                with open(probe_file) as f:
+                    probe_cache.update(json.load(f))
+            except ValueError:
+                logger.debug('Ignoring corrupt probe cache %s', probe_file)
+        if key in probe_cache:
+            logger.debug("Found '%s' in probe cache", key)
+            return probe_cache[key]
+
+    result = list(run(cmd, capture=True, stderr=sp.STDOUT))
+    if key:
+        with ref_cache_lock:
+            probe_cache[key] = result
+            try:
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir)
+                write_file_atomic(probe_file, json.dumps(probe_cache, indent=1, sort_keys=True))
+            except (IOError, OSError) as e:
+                logger.debug('Could not write probe cache %s: %s', probe_file, e)
+    return result
+
+
+# start_probes(cmds)
+#
+# Start running the version queries cmds in the background
+def start_probes(cmds):
+    pool = ThreadPool(len(cmds))
+    for cmd in cmds:
+        pending_probes[tuple(cmd)] = (probe_id(cmd), pool.apply_async(probe, (cmd,)))
+    pool.close()
+
+
+# probe_result(cmd)
+#
+# Return exit status and output of the version query cmd,
+# using the result of start_probes() if it ran the same executable
+def probe_result(cmd):
+    started = pending_probes.pop(tuple(cmd), None)
+    if started and started[0] == probe_id(cmd):
+        return started[1].get()
+    return probe(cmd)
+
+
+# toolchain_probes()
+#
+# Return the version queries for the tools used in the build
+def toolchain_probes():
+    if re.match(r'^vs', ci['compiler']):
+        compiler = ['cl']
+    else:
+        compiler = [ci['compiler'], '--version']
+    return [['make', '--version'], ['perl', '--version'], compiler]
+
+
+# setup_ccache()
+#
+# Set up the compiler cache launcher ci['ccache'] (ccache or sccache):
+# cache in $CACHEDIR/<launcher> limited to ci['ccache_size'], statistics zeroed for print_ccache_stats()
+# Disables the compiler cache if the launcher is not installed
+def setup_ccache():
+    if not find_executable(ci['ccache']):
+        print('{0}Compiler cache {1} not found, building without it{2}'.format(ANSI_YELLOW, ci['ccache'], ANSI_RESET))
+        sys.stdout.flush()
+        ci['ccache'] = None
+        return
+    name = os.path.basename(ci['ccache'])
+    if name.startswith('sccache'):
+        os.environ['SCCACHE_DIR'] = os.path.join(cachedir, name)
+        os.environ['SCCACHE_CACHE_SIZE'] = ci['ccache_size']
+    else:
+        os.environ['CCACHE_DIR'] = os.path.join(cachedir, name)
+        os.environ['CCACHE_MAXSIZE'] = ci['ccache_size']
+    run([ci['ccache'], '--zero-stats'], capture=True)
+
+
+# print_ccache_stats()
+#
+# Print the hit rate of the compiler cache during this phase
+def print_ccache_stats():
+    (exitcode, output) = run([ci['ccache'], '--print-stats'], capture=True)
+    if exitcode or not os.path.basename(ci['ccache']).startswith('ccache'):
+        # sccache, or ccache before 3.7: human readable statistics
+        output = run([ci['ccache'], '--show-stats'], capture=True)[1]
+        print('{0}Compiler cache statistics{1}'.format(ANSI_CYAN, ANSI_RESET))
+        print(output.rstrip())
+    else:
+        stats = dict(line.split('\t', 1) for line in output.splitlines() if '\t' in line)
+        hits = sum(int(stats.get(stat, 0)) for stat in ['direct_cache_hit', 'preprocessed_cache_hit'])
+        misses = int(stats.get('cache_miss', 0))
+        print('{0}Compiler cache: {1} hits, {2} misses ({3:.0f}% hit rate), {4:.2f} GB used (limit {5}){6}'
+              .format(ANSI_CYAN, hits, misses, 100. * hits / (hits + misses) if hits + misses else 0,
+                      int(stats.get('cache_size_kibibyte', 0)) / 1048576., ci['ccache_size'], ANSI_RESET))
+    sys.stdout.flush()
+
+
+# lock_file(name, exclusive)
+#
+# Take a shared (reader) or exclusive (writer) lock on $CACHEDIR/locks/<name>.lock, so that jobs
+# sharing the cache do not change what another job is using, waiting for the other jobs as needed
+# Returns the open lock file (closing it releases the lock), or None if locks are not available (Windows)
+def lock_file(name, exclusive):
+    if not fcntl:
+        return None
+    lockdir = os.path.join(cachedir, 'locks')
+    try:
+        os.makedirs(lockdir)
+    except OSError:
+        if not os.path.isdir(lockdir):
+            raise
+    lock = open(os.path.join(lockdir, name + '.lock'), 'a')
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(lock, mode | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        print('Waiting for {0} lock on {1} (in use by another job)'
+              .format('exclusive' if exclusive else 'shared', name))
+        sys.stdout.flush()
+        fcntl.flock(lock, mode)
+    logger.debug('Locked %s (%s)', name, 'exclusive' if exclusive else 'shared')
+    return lock
+
+
+# Seconds between the checks for leases of other jobs to expire
+lease_poll_interval = 10
+
+
+# lease_file()
+#
+# Return the name of the lease file of this job (by host and module directory, which stay the same
+# for all phases of a job)
+def lease_file():
+    job = hashlib.sha1('{0} {1}'.format(platform.node(), curdir).encode()).hexdigest()[:16]
+    return os.path.join(cachedir, 'locks', job + '.lease')
+
+
+# write_lease()
+#
+# Record that this job goes on using what it has locked (cache_locks) in its next phases,
+# for ci['cache_lease'] seconds after the end of this phase
+def write_lease():
+    if not fcntl or not cache_locks or not ci['cache_lease']:
+        return
+    try:
+        write_file_atomic(lease_file(), json.dumps({
+            'names': sorted(cache_locks),
+            'time': time.time(),
+            'host': platform.node(),
+            'dir': curdir,
+        }, indent=1, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug('Could not write lease %s: %s', lease_file(), e)
+
+
+# leased_by_others(names)
+#
+# Return the current leases (as written by write_lease()) of other jobs on any of names
+def leased_by_others(names):
+    lockdir = os.path.join(cachedir, 'locks')
+    leases = []
+    for filename in sorted(os.listdir(lockdir)) if ci['cache_lease'] else []:
+        path = os.path.join(lockdir, filename)
+        if not filename.endswith('.lease') or path == lease_file():
+            continue
+        try:
+            with open(path) as f:
+                lease = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if time.time() - lease['time'] < ci['cache_lease'] and set(lease['names']) & set(names):
+            leases.append(lease)
+    return leases
+
+
+# resolve_ref(url, tag, save=True)
+#
+# Look up tag (a tag or branch name) in the remote repository at url
+# Returns a dict with 'kind' ('tags' or 'heads') and 'sha' of the ref, or None if it does not exist
+# Results are cached in $CACHEDIR/refs.json (new results only in memory if save is False):
+# - tags never expire
+# - branches are looked up again after ci['ref_ttl'] seconds
+# - ci['refresh_refs'] forces looking up all refs again
+# Within a run, a ref is resolved only once: what the cache locks were chosen for is what gets checked out
+def resolve_ref(url, tag, save=True):
+    ref_file = os.path.join(cachedir, 'refs.json')
+    key = '{0} {1}'.format(url, tag)
+    with ref_cache_lock:
+        if key in resolved_refs:
+            return resolved_refs[key]
+        if not ref_cache and os.path.exists(ref_file):
+            try:
+                with open(ref_file) as f:
+                    ref_cache.update(json.load(f))
+            except ValueError:
+                logger.debug('Ignoring corrupt ref cache %s', ref_file)
+        entry = ref_cache.get(key)
+
+    if entry and not ci['refresh_refs']:
+        if entry['kind'] == 'tags' or time.time() - entry['time'] < ci['ref_ttl']:
+            logger.debug('Found %s of %s in ref cache (%s %s)', tag, url, entry['kind'], entry['sha'])
+            with ref_cache_lock:
+                resolved_refs[key] = entry
+            return entry
+
+    (exitcode, output) = run(['git', 'ls-remote', '--quiet', '--exit-code', '--refs', url, tag], capture=True,
+                             retries=ci['net_retries'], retry_codes=[128], timeout=ci['net_timeout'])
+    if exitcode:
+        return None
+
+    refs = dict(reversed(line.split('\t', 1)) for line in output.splitlines() if '\t' in line)
+    for kind in ['heads', 'tags']:
+        if 'refs/{0}/{1}'.format(kind, tag) in refs:
+            entry = {'kind': kind, 'sha': refs['refs/{0}/{1}'.format(kind, tag)]}
+            break
+    else:
+        # only partial matches: treat like a branch, i.e. check again next time
+        entry = {'kind': 'heads', 'sha': sorted(refs.values())[0] if refs else ''}
+    entry['time'] = time.time()
+
+    with ref_cache_lock:
+        ref_cache[key] = entry
+        resolved_refs[key] = entry
+        if not save:
+            return entry
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            write_file_atomic(ref_file, json.dumps(ref_cache, indent=1, sort_keys=True))
+        except (IOError, OSError) as e:
+            logger.debug('Could not write ref cache %s: %s', ref_file, e)
+    return entry
+
+
+# update_mirror(url, tag)
+#
+# Make sure the bare mirror of the repository at url in $CACHEDIR/mirrors contains tag
+# - create the mirror if it does not exist
+# - otherwise fetch new objects incrementally (once per run, not needed for tags already in the mirror)
+# Returns the location of the mirror
+def update_mirror(url, tag):
+    mirror = os.path.join(cachedir, 'mirrors',
+                          re.sub(r'[^A-Za-z0-9._-]+', '_', re.sub(r'^[a-z]+://', '', url)).strip('_'))
+    if not mirror.endswith('.git'):
+        mirror += '.git'
+    with ref_cache_lock:
+        lock = mirror_locks.setdefault(mirror, threading.Lock())
+    with lock:
+        if mirror in mirrors_updated:
+            return mirror
+        # other jobs sharing the cache may be creating or updating the same mirror
+        jobs_lock = lock_file('mirror-' + os.path.basename(mirror), True)
+        try:
+            if not os.path.isdir(mirror):
+                print_message('Creating mirror of {0} in {1}'.format(url, mirror))
+                if call_git(['clone', '--quiet', '--mirror', url, mirror], net=True):
+                    raise RuntimeError("{0}Could not create mirror of {1}{2}".format(ANSI_RED, url, ANSI_RESET))
+                # checkouts borrow objects from the mirror: never prune them
+                call_git(['config', 'gc.pruneExpire', 'never'], cwd=mirror)
+                call_git(['config', 'gc.reflogExpireUnreachable', 'never'], cwd=mirror)
+                mirrors_updated.append(mirror)
+            else:
+                have_tag = call_git(['rev-parse', '--verify', '--quiet', 'refs/tags/{0}'.format(tag)],
+                                    cwd=mirror, capture=True) == 0
+                if not have_tag:
+                    logger.debug('Updating mirror %s', mirror)
+                    if call_git(['fetch', '--quiet', 'origin'], cwd=mirror, net=True):
+                        raise RuntimeError("{0}Could not update mirror of {1}{2}"
+                                           .format(ANSI_RED, url, ANSI_RESET))
+                    mirrors_updated.append(mirror)
+        finally:
+            if jobs_lock:
+                jobs_lock.close()
+    return mirror
+
+
+# clone_from_mirror(dep, args, dirname)
+#
+# Clone dependency dep into $CACHEDIR/dirname, borrowing all objects from the local mirror
+# (git alternates), so that only new objects are transferred and history is not duplicated
+def clone_from_mirror(dep, args, dirname):
+    url = setup[dep + '_REPOURL']
+    mirror = update_mirror(url, setup[dep])
+    place = os.path.join(cachedir, dirname)
+    call_git(['clone', '--quiet', '--shared', '--branch', setup[dep], mirror, dirname], cwd=cachedir)
+    call_git(['remote', 'set-url', 'origin', url], cwd=place)
+    if '--recursive' in args:
+        call_git(['submodule', '--quiet', 'update', '--init', '--recursive'], cwd=place, net=True)
+
+
 def get_git_hash(place):
     logger.debug("EXEC 'git log -n1 --pretty=format:%%H' in %s", place)
     sys.stdout.flush()
-    head = sp.check_output(['git', 'log', '-n1', '--pretty=format:%H'], cwd=place).decode()
+    head = run(['git', 'log', '-n1', '--pretty=format:%H'], cwd=place, capture=True, check=True)[1]
     logger.debug('EXEC DONE')
     return head
 
@@ -399,22 +1383,27 @@ def complete_setup(dep):
     setup.setdefault(dep + "_DEPTH", -1)
 
 
-# add_dependency(dep, tag)
+# read_release_vars(place)
 #
-# Add a dependency to the cache area:
-# - check out (recursive if configured) in the CACHE area unless it already exists and the
-#   required commit has been built
-# - Defaults:
-#   $dep_DIRNAME = lower case ($dep)
-#   $dep_REPONAME = lower case ($dep)
-#   $dep_REPOURL = GitHub / $dep_REPOOWNER (or $REPOOWNER or epics-modules) / $dep_REPONAME .git
-#   $dep_VARNAME = $dep
-#   $dep_DEPTH = 5
-#   $dep_RECURSIVE = 1/YES (0/NO to for a flat clone)
-# - Add $dep_VARNAME line to the RELEASE.local file in the cache area (unless already there)
-# - Add full path to $modules_to_compile
-def add_dependency(dep):
-    global do_recompile
+# Return the names of all variables set in configure/RELEASE and configure/RELEASE.local
+# of the module in place, i.e. the names of the modules it depends on
+def read_release_vars(place):
+    names = []
+    for name in ['RELEASE', 'RELEASE.local']:
+        release = os.path.join(place, 'configure', name)
+        if os.path.exists(release):
+            with open(release) as f:
+                for line in f:
+                    match = re.match(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*:?=', line)
+                    if match and match.group(1) not in names:
+                        names.append(match.group(1))
+    return names
+
+
+# clone_args(dep)
+#
+# Return the git arguments for the depth and recursion of the clone of dependency dep
+def clone_args(dep):
     recurse = setup[dep + '_RECURSIVE'].lower()
     if recurse not in ['0', 'no']:
         recursearg = ["--recursive"]
@@ -426,13 +1415,37 @@ def add_dependency(dep):
         '-1': ['--depth', '5'],
         '0': [],
     }.get(str(setup[dep + '_DEPTH']), ['--depth', str(setup[dep + '_DEPTH'])])
+    return (deptharg, recursearg)
+
+
+# fetch_dependency(dep)
+#
+# Check out a dependency into the cache area:
+# - check out (recursive if configured) in the CACHE area unless it already exists and the
+#   required commit has been built
+# - Defaults:
+#   $dep_DIRNAME = lower case ($dep)
+#   $dep_REPONAME = lower case ($dep)
+#   $dep_REPOURL = GitHub / $dep_REPOOWNER (or $REPOOWNER or epics-modules) / $dep_REPONAME .git
+#   $dep_VARNAME = $dep
+#   $dep_DEPTH = 5
+#   $dep_RECURSIVE = 1/YES (0/NO to for a flat clone)
+# - with ci['update_deps'], update an outdated checkout (or a branch that has moved) in place,
+#   keeping the build products for an incremental rebuild
+# Only changes the shared ref cache, mirrors and trace/history records (which are locked),
+# so it may run for several dependencies in parallel (using collect_output() for its output)
+# Returns True if the dependency has been (re-)cloned
+def fetch_dependency(dep):
+    (deptharg, recursearg) = clone_args(dep)
 
     tag = setup[dep]
+    start = time.time()
 
     logger.debug('Adding dependency %s with tag %s', dep, setup[dep])
 
     # determine if dep points to a valid release or branch
-    if call_git(['ls-remote', '--quiet', '--exit-code', '--refs', setup[dep + '_REPOURL'], tag]):
+    ref = resolve_ref(setup[dep + '_REPOURL'], tag)
+    if not ref:
         raise RuntimeError("{0}{1} is neither a tag nor a branch name for {2} ({3}){4}"
                            .format(ANSI_RED, tag, dep, setup[dep + '_REPOURL'], ANSI_RESET))
 
@@ -451,65 +1464,770 @@ def add_dependency(dep):
             checked_out = 'never'
         head = get_git_hash(place)
         logger.debug('Found checked_out commit %s, git head is %s', checked_out, head)
+        if ci['update_deps'] and (head != checked_out or (ref['kind'] == 'heads' and ref['sha'] != head)):
+            if update_checkout(dep, place, deptharg, recursearg):
+                record_history('clone', dep, start, 'updated')
+                return False
+            logger.debug('Updating dependency %s failed', dep)
+            head = None
         if head != checked_out:
-            logger.debug('Dependency %s out of date - removing', dep)
-            shutil.rmtree(place, onerror=remove_readonly)
+            logger.debug('Dependency %s out of date - replacing it', dep)
         else:
-            print('Found {0} of dependency {1} up-to-date in {2}'.format(tag, dep, place))
-            sys.stdout.flush()
-
-    if not os.path.isdir(place):
+            print_message('Found {0} of dependency {1} up-to-date in {2}'.format(tag, dep, place))
+            record_history('clone', dep, start, 'cached')
+            return False
+
+    try:
+        os.makedirs(cachedir)
+    except OSError:
+        # another worker may have created it in the meantime
         if not os.path.isdir(cachedir):
-            os.makedirs(cachedir)
-        # clone dependency
-        print('Cloning {0} of dependency {1} into {2}'
-              .format(tag, dep, place))
+            raise
+    # clone dependency next to its place, then move it there,
+    # so that other jobs sharing the cache never find a partial clone
+    print_message('Cloning {0} of dependency {1} into {2}'
+                  .format(tag, dep, place))
+    tmpname = dirname + '.tmp'
+    if os.path.exists(os.path.join(cachedir, tmpname)):
+        logger.debug('Removing leftover clone %s', tmpname)
+        shutil.rmtree(os.path.join(cachedir, tmpname), onerror=remove_readonly)
+    if ci['git_mirror']:
+        clone_from_mirror(dep, recursearg, tmpname)
+    else:
+        call_git(['clone', '--quiet'] + deptharg + recursearg + ['--branch', tag, setup[dep + '_REPOURL'], tmpname],
+                 cwd=cachedir, net=True)
+
+    run(['git', 'log', '-n1'], cwd=os.path.join(cachedir, tmpname), check=True)
+    if os.path.isdir(place):
+        shutil.rmtree(place, onerror=remove_readonly)
+    os.rename(os.path.join(cachedir, tmpname), place)
+
+    setup_checkout(dep, place)
+    record_history('clone', dep, start, 'cloned')
+    return True
+
+
+# update_checkout(dep, place, deptharg, recursearg)
+#
+# Update the existing checkout of dependency dep in place to the current commit of its tag/branch,
+# leaving untracked files (i.e. build products) alone, and prepare it for building again
+# Returns False if the checkout cannot be updated and has to be cloned again
+def update_checkout(dep, place, deptharg, recursearg):
+    if dep == 'BASE':
+        # the MSI patch for Base 3.14 cannot be applied on top of an earlier one
+        versionfile = os.path.join(place, 'configure', 'CONFIG_BASE_VERSION')
+        if os.path.exists(versionfile):
+            with open(versionfile) as f:
+                if 'BASE_3_14=YES' in f.read():
+                    return False
+    tag = setup[dep]
+    if ci['git_mirror']:
+        source = update_mirror(setup[dep + '_REPOURL'], tag)
+    else:
+        source = 'origin'
+    print_message('Updating {0} of dependency {1} in {2}'.format(tag, dep, place))
+    if call_git(['fetch', '--quiet'] + deptharg + [source, tag], cwd=place, net=True) \
+            or call_git(['reset', '--quiet', '--hard', 'FETCH_HEAD'], cwd=place):
+        return False
+    if recursearg and call_git(['submodule', '--quiet', 'update', '--init', '--recursive'], cwd=place, net=True):
+        return False
+
+    run(['git', 'log', '-n1'], cwd=place, check=True)
+
+    setup_checkout(dep, place)
+    return True
+
+
+# setup_checkout(dep, place)
+#
+# Prepare a fresh checkout of dependency dep in place for building:
+# - add MSI to Base 3.14
+# - record the dependencies from configure/RELEASE, then make it include RELEASE.local
+# - run the hook (if defined)
+# - write the checked-out commit to the 'checked_out' marker file
+def setup_checkout(dep, place):
+    if dep == 'BASE':
+        # add MSI 1.7 to Base 3.14
+        versionfile = os.path.join(place, 'configure', 'CONFIG_BASE_VERSION')
+        if os.path.exists(versionfile):
+            with open(versionfile) as f:
+                if 'BASE_3_14=YES' in f.read():
+                    print_message('Adding MSI 1.7 to {0}'.format(place))
+                    run(['patch', '-p1', '-i', os.path.join(ci['scriptsdir'], 'add-msi-to-314.patch')],
+                        cwd=place, check=True)
+    else:
+        # remember the module dependencies before overwriting configure/RELEASE
+        with open(os.path.join(place, 'release_vars'), 'w') as fout:
+            print('\n'.join(read_release_vars(place)), file=fout)
+        # force including RELEASE.local for non-base modules by overwriting their configure/RELEASE
+        release = os.path.join(place, "configure", "RELEASE")
+        if os.path.exists(release):
+            with open(release, 'w') as fout:
+                print('-include $(TOP)/../RELEASE.local', file=fout)
+
+    # run hook if defined
+    if dep + '_HOOK' in setup:
+        hook = os.path.join(place, setup[dep + '_HOOK'])
+        if os.path.exists(hook):
+            print_message('Running hook {0} in {1}'.format(setup[dep + '_HOOK'], place))
+            run(hook, shell=True, cwd=place, check=True)
+
+    # write checked out commit hash to marker file
+    head = get_git_hash(place)
+    logger.debug('Writing hash of checked-out dependency (%s) to marker file', head)
+    with open(os.path.join(place, "checked_out"), "w") as fout:
+        print(head, file=fout)
+    fout.close()
+
+
+# reset_dependency(dep)
+#
+# Bring the checkout of dependency dep back to the state of a fresh clone
+# (removing all changes and build products) without accessing the network
+def reset_dependency(dep):
+    place = places[setup[dep + '_VARNAME']]
+    print('Resetting {0} of dependency {1} in {2}'.format(setup[dep], dep, place))
+    sys.stdout.flush()
+    call_git(['reset', '--quiet', '--hard'], cwd=place)
+    call_git(['clean', '--quiet', '-fdx'], cwd=place)
+    call_git(['submodule', '--quiet', 'foreach', '--recursive',
+              'git reset --quiet --hard && git clean --quiet -fdx'], cwd=place)
+    setup_checkout(dep, place)
+
+
+# merge_dependency(dep, cloned)
+#
+# Add a dependency that fetch_dependency() has checked out to the build:
+# - Set places[$dep_VARNAME] to its location (written to RELEASE.local by write_release_local())
+# - Add $dep to $modules_to_compile if it has been cloned
+#   (modules depending on it are added by check_build_keys())
+def merge_dependency(dep, cloned):
+    if cloned and dep not in cloned_modules:
+        logger.debug('Dependency %s has been cloned and will be compiled', dep)
+        cloned_modules.append(dep)
+        modules_to_compile.append(dep)
+    places[setup[dep + "_VARNAME"]] = os.path.join(cachedir, setup[dep + '_DIRNAME'] + '-{0}'.format(setup[dep]))
+
+
+# add_dependency(dep)
+#
+# Add a dependency to the cache area and to the build
+def add_dependency(dep):
+    merge_dependency(dep, fetch_dependency(dep))
+
+
+# add_dependencies(deps)
+#
+# Add a list of dependencies:
+# - run the checks and clones for up to ci['parallel_clone'] dependencies at the same time
+#   (printing the output of each one when all are done)
+# - merge the results into the build in the order of the list
+def add_dependencies(deps):
+    unique = []
+    [unique.append(dep) for dep in deps if dep not in unique]
+    workers = min(ci['parallel_clone'], len(unique))
+    if workers > 1:
+        logger.debug('Checking/cloning %d dependencies using %d workers', len(unique), workers)
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(lambda dep: collect_output(fetch_dependency, dep), unique)
+        finally:
+            pool.close()
+            pool.join()
+        # print the output of the workers in module order
+        for (cloned, output) in results:
+            sys.stdout.write(output)
         sys.stdout.flush()
-        call_git(['clone', '--quiet'] + deptharg + recursearg + ['--branch', tag, setup[dep + '_REPOURL'], dirname],
-                 cwd=cachedir)
-
-        sp.check_call(['git', 'log', '-n1'], cwd=place)
-        logger.debug('Setting do_recompile = True (all following modules will be recompiled')
-        do_recompile = True
-
-        if dep == 'BASE':
-            # add MSI 1.7 to Base 3.14
-            versionfile = os.path.join(place, 'configure', 'CONFIG_BASE_VERSION')
-            if os.path.exists(versionfile):
-                with open(versionfile) as f:
-                    if 'BASE_3_14=YES' in f.read():
-                        print('Adding MSI 1.7 to {0}'.format(place))
-                        sys.stdout.flush()
-                        sp.check_call(['patch', '-p1', '-i', os.path.join(ci['scriptsdir'], 'add-msi-to-314.patch')],
-                                      cwd=place)
+        cloned = [cloned for (cloned, output) in results]
+    else:
+        cloned = [fetch_dependency(dep) for dep in unique]
+    results = dict(zip(unique, cloned))
+    for dep in deps:
+        merge_dependency(dep, results.pop(dep, False))
+
+
+# dependency_graph(mods)
+#
+# Return a dict with the list of modules (out of mods) that each module in mods depends on:
+# - BASE does not depend on anything, all other modules depend on BASE
+# - modules depend on the modules whose $dep_VARNAME is set in their original configure/RELEASE
+#   (recorded in the marker file 'release_vars' when cloning)
+# - modules without that information (cached by older versions) depend on all modules before them
+def dependency_graph(mods):
+    varnames = dict((setup[mod + '_VARNAME'], mod) for mod in mods)
+    graph = {}
+    for index, mod in enumerate(mods):
+        if mod == 'BASE':
+            graph[mod] = []
+            continue
+        vars_file = os.path.join(places[setup[mod + '_VARNAME']], 'release_vars')
+        if os.path.exists(vars_file):
+            with open(vars_file) as f:
+                deps = [varnames[name] for name in f.read().split() if name in varnames]
+            if 'BASE' in mods:
+                deps.append('BASE')
         else:
-            # force including RELEASE.local for non-base modules by overwriting their configure/RELEASE
-            release = os.path.join(place, "configure", "RELEASE")
-            if os.path.exists(release):
-                with open(release, 'w') as fout:
-                    print('-include $(TOP)/../RELEASE.local', file=fout)
-
-        # run hook if defined
-        if dep + '_HOOK' in setup:
-            hook = os.path.join(place, setup[dep + '_HOOK'])
-            if os.path.exists(hook):
-                print('Running hook {0} in {1}'.format(setup[dep + '_HOOK'], place))
+            deps = mods[:index]
+        graph[mod] = sorted(set(dep for dep in deps if dep != mod), key=mods.index)
+        logger.debug('Module %s depends on %s', mod, graph[mod])
+    return graph
+
+
+# topological_order(graph, mods)
+#
+# Return mods sorted so that every module comes after the modules it depends on,
+# otherwise keeping the order of mods (modules in a dependency loop are added at the end)
+def topological_order(graph, mods):
+    ordered = []
+    pending = [mod for mod in mods if mod in graph]
+    while pending:
+        ready = [mod for mod in pending if all(dep in ordered for dep in graph[mod])]
+        if not ready:
+            ordered.extend(pending)
+            break
+        ordered.append(ready[0])
+        pending.remove(ready[0])
+    return ordered
+
+
+# Environment settings that prepare() writes into the EPICS Base CONFIG_SITE files
+config_site_env = ['USR_CPPFLAGS', 'USR_CFLAGS', 'USR_CXXFLAGS', 'WINE', 'RTEMS']
+
+
+# build_inputs(dep, upstream)
+#
+# Return a dict of everything that goes into building dependency dep:
+# checked-out commit, build configuration, compiler (and compiler cache), host, CONFIG_SITE settings, hook,
+# and the build keys of the dependencies it is built against (upstream: dict module -> key)
+def build_inputs(dep, upstream):
+    place = places[setup[dep + '_VARNAME']]
+    inputs = {
+        'commit': read_marker(place, 'checked_out'),
+        'configuration': ci['configuration'],
+        'compiler': ci['compiler'],
+        'host': '{0}-{1}-{2}'.format(ci['os'], ci['platform'],
+                                     os.getenv('EPICS_HOST_ARCH', distutils.util.get_platform())),
+        'config_site': dict((var, os.getenv(var, '')) for var in config_site_env),
+        'hook': '',
+        'upstream': upstream,
+    }
+    if ci['ccache']:
+        inputs['ccache'] = os.path.basename(ci['ccache'])
+    if dep + '_HOOK' in setup:
+        hook = os.path.join(place, setup[dep + '_HOOK'])
+        if os.path.exists(hook):
+            with open(hook, 'rb') as f:
+                inputs['hook'] = setup[dep + '_HOOK'] + ':' + hashlib.sha1(f.read()).hexdigest()
+    return inputs
+
+
+def read_marker(place, name):
+    marker = os.path.join(place, name)
+    if not os.path.exists(marker):
+        return None
+    with open(marker, 'r') as f:
+        return f.read().strip()
+
+
+# build_key_changes(built, inputs)
+#
+# Return a list of reasons why a build with the recorded inputs 'built' does not match inputs
+def build_key_changes(built, inputs):
+    if not built:
+        return ['no build recorded']
+    changes = []
+    for item in sorted(set(inputs) | set(built)):
+        if item == 'upstream':
+            for dep in sorted(set(inputs[item]) | set(built.get(item, {}))):
+                if dep not in inputs[item]:
+                    changes.append('{0} removed'.format(dep))
+                elif built.get(item, {}).get(dep) != inputs[item][dep]:
+                    changes.append('{0} changed'.format(dep))
+        elif built.get(item) != inputs.get(item):
+            changes.append('{0} changed'.format(item))
+    return changes
+
+
+# build_key_status(mod, upstream)
+#
+# Compute the build key (a hash of the build inputs) of dependency mod and store it in build_keys
+# (upstream: dict module -> key of the dependencies it is built against)
+# Returns the inputs of the build recorded in its 'built_key' marker file (None if there is none)
+# and the list of reasons for rebuilding it (empty if the recorded build has the same key)
+def build_key_status(mod, upstream):
+    inputs = build_inputs(mod, upstream)
+    key = input_hash(inputs)
+    build_keys[mod] = {'key': key, 'inputs': inputs}
+    try:
+        built = json.loads(read_marker(places[setup[mod + '_VARNAME']], 'built_key') or 'null')
+    except ValueError:
+        built = None
+    logger.debug('Build key of %s is %s (built: %s)', mod, key, built and built['key'])
+    if built and built['key'] == key:
+        return (built['inputs'], [])
+    built = built and built['inputs']
+    return (built, build_key_changes(built, inputs) or ['build key changed'])
+
+
+# check_build_keys(mods)
+#
+# Compute the build key of all dependencies in mods.
+# Dependencies whose key differs from the one recorded in their 'built_key' marker file
+# are added to $modules_to_compile. Cached checkouts that were built differently are reset,
+# after saving their build products to the artifact store (if there is one), as there is only one checkout
+# per tag: switching back to the other configuration then restores them instead of building again.
+def check_build_keys(mods):
+    mods = [mod for index, mod in enumerate(mods) if mod not in mods[:index]]
+    graph = dependency_graph(mods)
+    for mod in topological_order(graph, mods):
+        (built, changes) = build_key_status(mod, dict((dep, build_keys[dep]['key']) for dep in graph[mod]))
+        if not changes:
+            continue
+        inputs = build_keys[mod]['inputs']
+        if mod not in modules_to_compile:
+            print('Dependency {0} needs to be rebuilt ({1})'
+                  .format(mod, ', '.join(changes)))
+            modules_to_compile.append(mod)
+        # a checkout built with different settings must not be built on top of
+        if mod not in cloned_modules and (not built or [item for item in set(inputs) | set(built)
+                                                        if item not in ['commit', 'upstream']
+                                                        and built.get(item) != inputs.get(item)]):
+            if built and ci['artifact_store'] and not os.path.exists(artifact_file(mod, input_hash(built))):
+                save_artifacts(mod, input_hash(built))
+            reset_dependency(mod)
+    sys.stdout.flush()
+
+
+# checkout_status(dep, save=True)
+#
+# Return what fetch_dependency() would do with dependency dep, without changing anything:
+# the outcome ('cached', 'cloned' or 'updated'), a description of the checkout and the reason
+# (save: passed to resolve_ref())
+def checkout_status(dep, save=True):
+    (deptharg, recursearg) = clone_args(dep)
+    tag = setup[dep]
+    place = os.path.join(cachedir, setup[dep + '_DIRNAME'] + '-{0}'.format(tag))
+    ref = resolve_ref(setup[dep + '_REPOURL'], tag, save=save)
+    if not ref:
+        raise RuntimeError("{0}{1} is neither a tag nor a branch name for {2} ({3}){4}"
+                           .format(ANSI_RED, tag, dep, setup[dep + '_REPOURL'], ANSI_RESET))
+    clone = 'clone ({0}{1})'.format('depth ' + deptharg[1] if deptharg else 'full',
+                                    ', recursive' if recursearg else '')
+    if not os.path.isdir(place):
+        return ('cloned', clone, 'not in cache')
+    checked_out = read_marker(place, 'checked_out') or 'never'
+    head = get_git_hash(place)
+    if ci['update_deps'] and (head != checked_out or (ref['kind'] == 'heads' and ref['sha'] != head)):
+        return ('updated', 'update', 'branch has moved' if head == checked_out else 'checkout modified')
+    elif head != checked_out:
+        return ('cloned', clone, 'checkout out of date')
+    return ('cached', 'current', '')
+
+
+# dependency_status(mods, save=True)
+#
+# Return what prepare would do with the dependencies in mods, without changing anything in the cache:
+# a list (in build order) of the module, the checkout_status() and the reasons for rebuilding it
+# (empty if its recorded build can be used)
+# Sets places and build_keys like prepare does
+def dependency_status(mods, save=True):
+    mods = [mod for index, mod in enumerate(mods) if mod not in mods[:index]]
+    checkouts = {}
+    for dep in mods:
+        places[setup[dep + '_VARNAME']] = os.path.join(cachedir, setup[dep + '_DIRNAME'] + '-{0}'.format(setup[dep]))
+        checkouts[dep] = checkout_status(dep, save)
+
+    status = []
+    graph = dependency_graph(mods)
+    for mod in topological_order(graph, mods):
+        (built, changes) = build_key_status(mod, dict((dep, build_keys[dep]['key']) for dep in graph[mod]))
+        (outcome, checkout, reason) = checkouts[mod]
+        if outcome != 'cached':
+            # the new commit is not known yet: rebuild, and so will everything built against it
+            build_keys[mod]['key'] = None
+            changes = ['commit changed'] if outcome == 'updated' else ['no build recorded']
+        status.append((mod, outcome, checkout, reason, changes))
+    return status
+
+
+# lock_dependencies(mods)
+#
+# Lock the cached dependencies in mods and the RELEASE.local file in the cache area for this job:
+# shared for what can be used as it is, exclusive for what has to be cloned, updated, reset, rebuilt
+# or (RELEASE.local) rewritten. Jobs sharing the cache thus never change a dependency that another job
+# is using or building, and dependencies that are in use are only reused, never changed.
+# All locks are taken in the same order, without holding any other locks while waiting, so that jobs
+# cannot deadlock: if something turns out to need changes under a shared lock, all locks are released
+# and taken again. The locks are held until the end of the process (the prepare phase).
+# Nothing is changed while another job has a lease on it (is between two of its phases, see write_lease()):
+# all locks are released until the lease has ended.
+def lock_dependencies(mods):
+    if not fcntl or not mods:
+        return
+    names = dict((dep, setup[dep + '_DIRNAME'] + '-{0}'.format(setup[dep])) for dep in mods)
+    release_local = os.path.join(cachedir, 'RELEASE.local')
+    writers = set()
+    while True:
+        [lock.close() for lock in cache_locks.values()]
+        cache_locks.clear()
+        for name in sorted(set(names.values()) | set(['RELEASE.local'])):
+            cache_locks[name] = lock_file(name, name in writers)
+        needed = set(names[mod] for (mod, outcome, checkout, reason, changes) in dependency_status(mods)
+                     if outcome != 'cached' or changes)
+        current = None
+        if os.path.exists(release_local):
+            with open(release_local) as f:
+                current = f.read()
+        if current != release_local_text(release_local_entries(mods)):
+            needed.add('RELEASE.local')
+        if needed <= writers:
+            leases = leased_by_others(writers)
+            if not leases:
+                break
+            [lock.close() for lock in cache_locks.values()]
+            cache_locks.clear()
+            print('Waiting for {0} to finish using {1}'
+                  .format(', '.join('{0}:{1}'.format(lease['host'], lease['dir']) for lease in leases),
+                          ', '.join(sorted(set(name for lease in leases for name in lease['names']
+                                               if name in writers)))))
+            sys.stdout.flush()
+            time.sleep(lease_poll_interval)
+            # things may have changed in the meantime
+            writers = set()
+            continue
+        logger.debug('Exclusive locks needed for %s', ', '.join(sorted(needed)))
+        writers |= needed
+    build_keys.clear()
+    if writers:
+        print('Locked {0} for changes'.format(', '.join(sorted(writers))))
+        sys.stdout.flush()
+
+
+# lock_used_dependencies()
+#
+# Take shared locks on the cached dependencies that the module is built against (as listed in
+# its configure/RELEASE.local, or else in RELEASE.local in the cache area) and on RELEASE.local in the
+# cache area, held until the end of the process (a phase after prepare)
+def lock_used_dependencies():
+    if not fcntl or building_base:
+        return
+    names = set(['RELEASE.local'])
+    for release_local in [os.path.join(curdir, 'configure', 'RELEASE.local'),
+                          os.path.join(cachedir, 'RELEASE.local')]:
+        if os.path.exists(release_local):
+            with open(release_local) as f:
+                for line in f:
+                    place = os.path.normpath(line.strip().split('=', 1)[-1])
+                    if os.path.dirname(place) == os.path.normpath(cachedir):
+                        names.add(os.path.basename(place))
+            break
+    for name in sorted(names):
+        cache_locks[name] = lock_file(name, False)
+
+
+def write_built_key(mod):
+    if mod in build_keys:
+        write_file_atomic(os.path.join(places[setup[mod + '_VARNAME']], 'built_key'),
+                          json.dumps(build_keys[mod], sort_keys=True))
+
+
+# Directories of a built dependency that are stored in the artifact store
+artifact_dirs = ['bin', 'lib', 'include', 'db', 'dbd', 'configure']
+
+
+# artifact_file(mod, key=None)
+#
+# Return the name of the archive of the build products of dependency mod in the artifact store
+# (for build key key, default: the current one)
+# Archives are keyed by build key and location, as built files contain absolute paths
+def artifact_file(mod, key=None):
+    place = places[setup[mod + '_VARNAME']]
+    key = hashlib.sha1('{0} {1}'.format(key or build_keys[mod]['key'], place).encode()).hexdigest()
+    return os.path.join(ci['artifact_store'], '{0}-{1}.tar.gz'.format(os.path.basename(place), key))
+
+
+# save_artifacts(mod, key=None)
+#
+# Pack the build products of dependency mod into an archive in the artifact store
+# (for build key key, default: the current one)
+def save_artifacts(mod, key=None):
+    place = places[setup[mod + '_VARNAME']]
+    archive = artifact_file(mod, key)
+    if not os.path.isdir(ci['artifact_store']):
+        try:
+            os.makedirs(ci['artifact_store'])
+        except OSError:
+            # another worker may have created it in the meantime
+            pass
+    logger.debug('Saving build products of %s to %s', mod, archive)
+    tmpfile = '{0}.tmp-{1}-{2}'.format(archive, os.getpid(), threading.current_thread().ident)
+    try:
+        tar = tarfile.open(tmpfile, 'w:gz')
+        try:
+            for subdir in artifact_dirs:
+                if os.path.isdir(os.path.join(place, subdir)):
+                    tar.add(os.path.join(place, subdir), arcname=subdir)
+        finally:
+            tar.close()
+        replace_file(tmpfile, archive)
+    except (tarfile.TarError, IOError, OSError) as e:
+        # a missing archive only costs a build later on
+        print('{0}Cannot save build products of {1} to {2} ({3}){4}'.format(ANSI_RED, mod, archive, e, ANSI_RESET))
+        sys.stdout.flush()
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+# restore_artifacts(mod)
+#
+# Unpack the build products of dependency mod from the artifact store (keeping their mtimes,
+# so that make sees them as up to date)
+# Returns False if there is no (usable) archive for the current build key
+def restore_artifacts(mod):
+    place = places[setup[mod + '_VARNAME']]
+    archive = artifact_file(mod)
+    if not os.path.exists(archive):
+        logger.debug('No archive %s for %s in artifact store', archive, mod)
+        return False
+    print('Restoring build products of dependency {0} from {1}'.format(mod, archive))
+    sys.stdout.flush()
+    try:
+        tar = tarfile.open(archive, 'r:gz')
+        try:
+            if hasattr(tarfile, 'fully_trusted_filter'):
+                tar.extractall(place, filter='fully_trusted')
+            else:
+                tar.extractall(place)
+        finally:
+            tar.close()
+    except (tarfile.TarError, IOError, OSError) as e:
+        print('{0}Cannot restore from {1} ({2}), building {3}{4}'.format(ANSI_RED, archive, e, mod, ANSI_RESET))
+        sys.stdout.flush()
+        os.remove(archive)
+        return False
+    return True
+
+
+# Lines of make output (GNU make with -w) and compiler diagnostics (GCC/clang and MSVC style)
+make_dir_pattern = re.compile(r'^\S*make(?:\.exe)?(?:\[\d+\])?: (Entering|Leaving) directory [`\'"](.*)[\'"]\s*$')
+make_error_pattern = re.compile(r'^\S*make(?:\.exe)?(?:\[\d+\])?: \*\*\* ')
+diagnostic_patterns = [
+    re.compile(r'^(?P<loc>(?:[A-Za-z]:)?[^\s:][^:]*:\d+(?::\d+)?):\s*(?P<kind>warning|error|fatal error):\s*(?P<msg>.*)$'),
+    re.compile(r'^(?P<loc>.+\(\d+(?:,\d+)?\))\s*:\s*(?P<kind>warning|error|fatal error)\s+(?P<msg>\w+:.*)$'),
+]
+
+
+# make_output_processor(tail_lines=100, max_diagnostics=100)
+#
+# Return a pair of functions to process the output of a (dependency) make run with constant memory:
+# - on_line(line) keeps the last tail_lines lines of each directory (dropping them when make leaves
+#   a directory without errors) and collects de-duplicated compiler warnings and errors
+# - report(failed) returns the text to print afterwards: a summary of the diagnostics and,
+#   if make failed, the kept output of the directories with errors
+def make_output_processor(tail_lines=100, max_diagnostics=100):
+    state = {'dirs': [], 'tails': {}, 'failed': [], 'diagnostics': collections.OrderedDict(),
+             'count': {'warning': 0, 'error': 0}, 'dropped': 0}
+
+    def on_line(line):
+        line = line.rstrip('\r\n')
+        match = make_dir_pattern.match(line)
+        if match:
+            if match.group(1) == 'Entering':
+                state['dirs'].append(match.group(2))
+            elif state['dirs']:
+                left = state['dirs'].pop()
+                if left not in state['failed'] and left not in state['dirs']:
+                    state['tails'].pop(left, None)
+            return
+        current = state['dirs'][-1] if state['dirs'] else '.'
+        if current not in state['tails']:
+            state['tails'][current] = collections.deque(maxlen=tail_lines)
+        state['tails'][current].append(line)
+        if make_error_pattern.match(line) and current not in state['failed']:
+            state['failed'].append(current)
+        for pattern in diagnostic_patterns:
+            match = pattern.match(line)
+            if match:
+                kind = 'warning' if match.group('kind') == 'warning' else 'error'
+                state['count'][kind] += 1
+                key = '{0}: {1}: {2}'.format(match.group('loc'), match.group('kind'), match.group('msg'))
+                if key in state['diagnostics']:
+                    state['diagnostics'][key] += 1
+                elif len(state['diagnostics']) < max_diagnostics:
+                    state['diagnostics'][key] = 1
+                else:
+                    state['dropped'] += 1
+                if kind == 'error' and current not in state['failed']:
+                    state['failed'].append(current)
+                break
+
+    def report(failed):
+        text = []
+        if state['diagnostics']:
+            text.append('{0} warning(s), {1} error(s):'.format(state['count']['warning'], state['count']['error']))
+            for key, count in state['diagnostics'].items():
+                text.append('  {0}{1}'.format(key, ' [{0}x]'.format(count) if count > 1 else ''))
+            if state['dropped']:
+                text.append('  ... and {0} more'.format(state['dropped']))
+        if failed:
+            for place in state['failed'] or list(state['tails'])[-1:]:
+                text.append('{0}Last lines of output in {1}:{2}'.format(ANSI_RED, place, ANSI_RESET))
+                text.extend(state['tails'].get(place, []))
+        return '\n'.join(text)
+
+    return on_line, report
+
+
+# build_dependencies(mods)
+#
+# Build (and clean) the dependencies in mods following the dependency graph:
+# modules that do not depend on each other are built at the same time,
+# with all builds sharing a budget of ci['parallel_make'] make jobs
+# If ci['artifact_store'] is set, build products are restored from the artifact store
+# (and saved to it if ci['save_artifacts'] is set)
+# The make output of each dependency is condensed by make_output_processor()
+def build_dependencies(mods):
+    graph = dependency_graph([mod for index, mod in enumerate(modlist()) if mod not in modlist()[:index]])
+    pending = list(mods)
+    done = set(mod for mod in graph if mod not in mods)
+    budget = ci['parallel_make']
+    state = {'tokens': max(1, budget), 'running': 0, 'exitcode': 0}
+    cond = threading.Condition()
+
+    def build_one(mod, jobs):
+        place = places[setup[mod + "_VARNAME"]]
+        (on_line, report) = make_output_processor()
+        exitcode = 0
+        start = time.time()
+        outcome = 'built'
+        try:
+            if ci['artifact_store'] and restore_artifacts(mod):
+                restored_modules.append(mod)
+                outcome = 'restored'
+            else:
+                call_make(args=['-w'], cwd=place, parallel=jobs, silent=silent_dep_builds,
+                          on_line=on_line, stderr=sp.STDOUT)
+                if ci['clean_deps']:
+                    call_make(args=['-w', 'clean'], cwd=place, parallel=jobs, silent=silent_dep_builds,
+                              on_line=on_line, stderr=sp.STDOUT)
+                if ci['save_artifacts']:
+                    save_artifacts(mod)
+            write_built_key(mod)
+        except SystemExit as e:
+            exitcode = e.code
+        except BaseException:
+            traceback.print_exc()
+            exitcode = 1
+        record_history('dependency', mod, start, 'failed' if exitcode else outcome)
+        with cond:
+            text = report(exitcode)
+            if text:
+                print('{0}Output of building dependency {1}{2}'.format(ANSI_CYAN, mod, ANSI_RESET))
+                print(text)
+            if exitcode:
+                print('{0}Building dependency {1} failed{2}'.format(ANSI_RED, mod, ANSI_RESET))
+                if not state['exitcode']:
+                    state['exitcode'] = exitcode
+            else:
+                done.add(mod)
+            sys.stdout.flush()
+            state['tokens'] += max(1, jobs)
+            state['running'] -= 1
+            cond.notify()
+
+    with cond:
+        while state['running'] or (pending and not state['exitcode']):
+            ready = [mod for mod in pending if all(dep in done for dep in graph[mod])]
+            if pending and not ready and not state['running']:
+                logger.debug('Circular dependency between %s, building in module order', pending)
+                ready = pending[:1]
+            while ready and state['tokens'] > 0 and not state['exitcode']:
+                mod = ready.pop(0)
+                jobs = max(1, state['tokens'] // (len(ready) + 1))
+                state['tokens'] -= jobs
+                state['running'] += 1
+                pending.remove(mod)
+                print('{0}Building dependency {1} in {2}{3}'
+                      .format(ANSI_YELLOW, mod, places[setup[mod + "_VARNAME"]], ANSI_RESET))
                 sys.stdout.flush()
-                sp.check_call(hook, shell=True, cwd=place)
+                logger.debug('Starting build of %s using %d of %d make jobs', mod, jobs, max(1, budget))
+                worker = threading.Thread(target=build_one, args=(mod, jobs if budget > 0 else 0))
+                worker.daemon = True
+                worker.start()
+            cond.wait()
+
+    if state['exitcode']:
+        sys.exit(state['exitcode'])
+
+
+# Native mapping of (system, machine) to EPICS host architecture, following EpicsHostArch.pl
+host_arch_map = {
+    'Linux': [(r'^x86_64$|^amd64$', 'linux-x86_64'), (r'^i[3-6]86$', 'linux-x86'),
+              (r'^aarch64$|^arm64$', 'linux-aarch64'), (r'^arm', 'linux-arm')],
+    'Darwin': [(r'^x86_64$', 'darwin-x86'), (r'^arm64$', 'darwin-aarch64')],
+    'Windows': [(r'^amd64$|^x86_64$', 'windows-x64'), (r'^x86$|^i[3-6]86$', 'win32-x86')],
+    'CYGWIN': [(r'^x86_64$', 'cygwin-x86_64'), (r'^i[3-6]86$', 'cygwin-x86')],
+}
 
-        # write checked out commit hash to marker file
-        head = get_git_hash(place)
-        logger.debug('Writing hash of checked-out dependency (%s) to marker file', head)
-        with open(checked_file, "w") as fout:
-            print(head, file=fout)
-        fout.close()
 
-    if do_recompile:
-        modules_to_compile.append(dep)
-    update_release_local(setup[dep + "_VARNAME"], place)
+# native_host_arch(base)
+#
+# Return the EPICS host architecture of this machine without running EpicsHostArch.pl,
+# or None if it is not known or not supported by the EPICS Base in base
+def native_host_arch(base):
+    system = platform.system()
+    if system.startswith('CYGWIN'):
+        system = 'CYGWIN'
+    machine = platform.machine().lower()
+    for pattern, arch in host_arch_map.get(system, []):
+        if re.match(pattern, machine):
+            if os.path.exists(os.path.join(base, 'configure', 'os', 'CONFIG.Common.' + arch)):
+                return arch
+            logger.debug('Host architecture %s not supported by EPICS Base in %s', arch, base)
+            break
+    return None
+
+
+# perl_host_arch(base)
+#
+# Return the EPICS host architecture that EpicsHostArch.pl of the EPICS Base in base reports
+# Results are memoized per Base commit (and host) in $CACHEDIR/host_arch.json
+def perl_host_arch(base):
+    memo_file = os.path.join(cachedir, 'host_arch.json')
+    commit = read_marker(base, 'checked_out')
+    key = '{0} {1} {2}'.format(commit, platform.system(), platform.machine())
+    memo = {}
+    if commit and os.path.exists(memo_file):
+        try:
+            with open(memo_file) as f:
+                memo = json.load(f)
+        except ValueError:
+            logger.debug('Ignoring corrupt host architecture memo %s', memo_file)
+        if key in memo:
+            logger.debug('Found host architecture %s for %s in %s', memo[key], key, memo_file)
+            return memo[key]
+
+    eha_scripts = [
+        os.path.join(base, 'src', 'tools', 'EpicsHostArch.pl'),
+        os.path.join(base, 'startup', 'EpicsHostArch.pl'),
+    ]
+    for eha in eha_scripts:
+        if os.path.exists(eha):
+            arch = run(['perl', eha], capture=True, check=True)[1].strip()
+            logger.debug('%s returned: %s', eha, arch)
+            if commit:
+                memo[key] = arch
+                try:
+                    write_file_atomic(memo_file, json.dumps(memo, indent=1, sort_keys=True))
+                except (IOError, OSError) as e:
+                    logger.debug('Could not write host architecture memo %s: %s', memo_file, e)
+            return arch
+    return 'unknown'
 
 
 def detect_epics_host_arch():
+    global detected_host_arch
+    preset = os.environ.get('EPICS_HOST_ARCH')
     if ci['os'] == 'windows':
         if re.match(r'^vs', ci['compiler']):
             # there is no combined static and debug EPICS_HOST_ARCH target,
@@ -533,23 +2251,119 @@ def detect_epics_host_arch():
                 os.environ['EPICS_HOST_ARCH'] = 'windows-x64-mingw'
 
     if 'EPICS_HOST_ARCH' not in os.environ:
-        logger.debug('Running script to detect EPICS host architecture in %s', places['EPICS_BASE'])
-        os.environ['EPICS_HOST_ARCH'] = 'unknown'
-        eha_scripts = [
-            os.path.join(places['EPICS_BASE'], 'src', 'tools', 'EpicsHostArch.pl'),
-            os.path.join(places['EPICS_BASE'], 'startup', 'EpicsHostArch.pl'),
-        ]
-        for eha in eha_scripts:
-            if os.path.exists(eha):
-                os.environ['EPICS_HOST_ARCH'] = sp.check_output(['perl', eha]).decode('ascii').strip()
-                logger.debug('%s returned: %s',
-                             eha, os.environ['EPICS_HOST_ARCH'])
-                break
+        logger.debug('Detecting EPICS host architecture for Base in %s', places['EPICS_BASE'])
+        os.environ['EPICS_HOST_ARCH'] = native_host_arch(places['EPICS_BASE']) \
+            or perl_host_arch(places['EPICS_BASE'])
+
+    if os.environ['EPICS_HOST_ARCH'] != preset:
+        detected_host_arch = os.environ['EPICS_HOST_ARCH']
 
 
+# Environment variables that setup_for_build() reads or sets
+build_env_vars = ['PATH', 'INCLUDE', 'EPICS_HOST_ARCH', 'TOP',
+                  'EXTRA', 'EXTRA1', 'EXTRA2', 'EXTRA3', 'EXTRA4', 'EXTRA5']
+
+
+# file_state(path)
+#
+# Return what the build environment depends on of the file or directory path:
+# modification time and size of a file, only the existence of a directory
+def file_state(path):
+    if os.path.isdir(path):
+        return 'dir'
+    if os.path.exists(path):
+        st = os.stat(path)
+        return [st.st_mtime, st.st_size]
+    return None
+
+
+# build_env_inputs(args)
+#
+# Return everything (apart from the files it reads) that the build environment
+# set up by setup_for_build() depends on
+def build_env_inputs(args):
+    env_vars = list(build_env_vars)
+    for path in args.paths:
+        env_vars.extend(re.findall(r'{(\w+)', path))
+    env = dict((var, os.environ.get(var)) for var in env_vars)
+    if env['EPICS_HOST_ARCH'] == detected_host_arch:
+        # set by an earlier detection (in prepare), not by the user
+        env['EPICS_HOST_ARCH'] = None
+    return {
+        'ci': dict((item, ci[item]) for item in ['service', 'os', 'platform', 'compiler', 'static', 'debug']),
+        'building_base': building_base,
+        'cwd': os.getcwd(),
+        'paths': args.paths,
+        'env': env,
+    }
+
+
+# setup_for_build(args)
+#
+# Set up the environment for building and running the main module.
+# prepare() saves the result as a snapshot in $CACHEDIR/build_envs.json (by the hash of the inputs) that the later
+# phases load instead of running all detections again, as long as the inputs and the files read are unchanged
 def setup_for_build(args):
+    global is_base314, has_test_results, is_make3
+    snapshot_file = os.path.join(cachedir, 'build_envs.json')
+    inputs = build_env_inputs(args)
+    key = input_hash(inputs)
+    snapshot = read_keyed_cache(snapshot_file).get(key)
+    if snapshot and all(file_state(path) == state for path, state in snapshot['files'].items()):
+        logger.debug('Using build environment snapshot %s', snapshot_file)
+        os.environ.update(snapshot['env'])
+        places.update(snapshot['places'])
+        is_base314 = snapshot['is_base314']
+        has_test_results = snapshot['has_test_results']
+        is_make3 = snapshot['is_make3']
+        extra_makeargs.extend(snapshot['extra_makeargs'])
+    else:
+        files = dict((path, file_state(path)) for path in resolve_build_env(args))
+        snapshot = {
+            'inputs': inputs,
+            'files': files,
+            'env': dict((var, os.environ[var]) for var in ['PATH', 'INCLUDE', 'EPICS_HOST_ARCH', 'TOP']
+                        if var in os.environ),
+            'places': {'EPICS_BASE': places['EPICS_BASE']},
+            'is_base314': is_base314,
+            'has_test_results': has_test_results,
+            'is_make3': is_make3,
+            'extra_makeargs': extra_makeargs,
+        }
+        write_keyed_cache(snapshot_file, key, snapshot)
+    if not ci['ccache']:
+        remove_ccache_launcher()
+
+
+ccache_launcher_pattern = re.compile(r'^(CCC?\s*=\s*)\S*ccache(?:\.exe)?\s+', re.MULTILINE)
+
+
+# remove_ccache_launcher()
+#
+# Remove the compiler cache launcher that an earlier prepare (with ccache available) put in front of
+# the compilers in the CONFIG_SITE of Base, so that a phase without the launcher can still compile
+def remove_ccache_launcher():
+    config = os.path.join(places['EPICS_BASE'], 'configure', 'os',
+                          'CONFIG_SITE.Common.' + os.environ['EPICS_HOST_ARCH'])
+    if not os.path.exists(config):
+        return
+    with open(config) as f:
+        text = f.read()
+    (text, count) = ccache_launcher_pattern.subn(r'\1', text)
+    if count:
+        print('{0}Removing compiler cache launcher from {1}{2}'.format(ANSI_YELLOW, config, ANSI_RESET))
+        sys.stdout.flush()
+        write_file_atomic(config, text)
+
+
+# resolve_build_env(args)
+#
+# Detect and set up the build environment (PATH, EPICS_HOST_ARCH, Base version, make version, ...)
+# Returns the list of files and directories that the result depends on
+def resolve_build_env(args):
     global is_base314, has_test_results, is_make3
     dllpaths = []
+    watched = []
 
     if ci['os'] == 'windows':
         if ci['service'] == 'appveyor':
@@ -579,6 +2393,7 @@ def setup_for_build(args):
 
     # Find BASE location
     if not building_base:
+        watched.append(os.path.join(cachedir, 'RELEASE.local'))
         with open(os.path.join(cachedir, 'RELEASE.local'), 'r') as f:
             lines = f.readlines()
             for line in lines:
@@ -597,16 +2412,22 @@ def setup_for_build(args):
                 for line in lines:
                     (mod, place) = line.strip().split('=')
                     bin_dir = os.path.join(place, 'bin', os.environ['EPICS_HOST_ARCH'])
+                    watched.append(bin_dir)
                     if os.path.isdir(bin_dir):
                         dllpaths.append(bin_dir)
         # Add DLL location to PATH
         bin_dir = os.path.join(os.getcwd(), 'bin', os.environ['EPICS_HOST_ARCH'])
+        watched.append(bin_dir)
         if os.path.isdir(bin_dir):
             dllpaths.append(bin_dir)
         os.environ['PATH'] = os.pathsep.join(dllpaths + [os.environ['PATH']])
         logger.debug('DLL paths added to PATH: %s', os.pathsep.join(dllpaths))
 
+    watched.extend([os.path.join(places['EPICS_BASE'], 'src', 'tools', 'EpicsHostArch.pl'),
+                    os.path.join(places['EPICS_BASE'], 'startup', 'EpicsHostArch.pl')])
+
     cfg_base_version = os.path.join(places['EPICS_BASE'], 'configure', 'CONFIG_BASE_VERSION')
+    watched.append(cfg_base_version)
     if os.path.exists(cfg_base_version):
         with open(cfg_base_version) as myfile:
             if 'BASE_3_14=YES' in myfile.read():
@@ -614,6 +2435,7 @@ def setup_for_build(args):
 
     if not is_base314:
         rules_build = os.path.join(places['EPICS_BASE'], 'configure', 'RULES_BUILD')
+        watched.append(rules_build)
         if os.path.exists(rules_build):
             with open(rules_build) as myfile:
                 for line in myfile:
@@ -621,7 +2443,7 @@ def setup_for_build(args):
                         has_test_results = True
 
     # Check make version
-    if re.match(r'^GNU Make 3', sp.check_output(['make', '-v']).decode('ascii')):
+    if re.match(r'^GNU Make 3', probe_result(['make', '--version'])[1]):
         is_make3 = True
 
     # apparently %CD% is handled automagically
@@ -643,6 +2465,8 @@ def setup_for_build(args):
         if tag in os.environ:
             extra_makeargs.append(os.environ[tag])
 
+    return watched
+
 
 def fix_etc_hosts():
     # Several travis-ci images throw us a curveball in /etc/hosts
@@ -655,7 +2479,7 @@ def fix_etc_hosts():
 
     logger.debug("EXEC sudo sed -ie '/^127\.0\.1\.1/ s|localhost\s*||g' /etc/hosts")
     sys.stdout.flush()
-    exitcode = sp.call(['sudo', 'sed', '-ie', '/^127\.0\.1\.1/ s|localhost\s*||g', '/etc/hosts'])
+    exitcode = run(['sudo', 'sed', '-ie', '/^127\.0\.1\.1/ s|localhost\s*||g', '/etc/hosts'])[0]
     logger.debug('EXEC DONE')
 
 
@@ -664,11 +2488,7 @@ def prepare(args):
 
     fold_start('load.setup', 'Loading setup files')
 
-    if 'SET' in os.environ:
-        source_set(os.environ['SET'])
-    source_set('defaults')
-
-    [complete_setup(mod) for mod in modlist()]
+    load_setup()
 
     fold_end('load.setup', 'Loading setup files')
 
@@ -685,16 +2505,23 @@ def prepare(args):
     # we're working with tags (detached heads) a lot: suppress advice
     call_git(['config', '--global', 'advice.detachedHead', 'false'])
 
+    # query the tool versions while the dependencies are checked out
+    start_probes(toolchain_probes())
+
     fold_start('check.out.dependencies', 'Checking/cloning dependencies')
 
-    [add_dependency(mod) for mod in modlist()]
+    lock_dependencies(modlist())
+    add_dependencies(modlist())
+    check_build_keys(modlist())
 
     if not building_base:
+        release_local = write_release_local(modlist())
         if os.path.isdir('configure'):
             targetdir = 'configure'
         else:
             targetdir = '.'
-        shutil.copy(os.path.join(cachedir, 'RELEASE.local'), targetdir)
+        if not write_if_changed(os.path.join(targetdir, 'RELEASE.local'), release_local):
+            print('{0}/RELEASE.local is up-to-date'.format(targetdir))
 
     fold_end('check.out.dependencies', 'Checking/cloning dependencies')
 
@@ -793,6 +2620,10 @@ CROSS_COMPILER_TARGET_ARCHS += RTEMS-pc386{0}'''.format(qemu_suffix))
         host_ccmplr_name = re.sub(r'^([a-zA-Z][^-]*(-[a-zA-Z][^-]*)*)+(-[0-9.]|)$', r'\1', ci['compiler'])
         host_cmplr_ver_suffix = re.sub(r'^([a-zA-Z][^-]*(-[a-zA-Z][^-]*)*)+(-[0-9.]|)$', r'\3', ci['compiler'])
         host_cmpl_ver = host_cmplr_ver_suffix[1:]
+        launcher = ''
+        if ci['ccache']:
+            print('Using compiler cache {0}'.format(ci['ccache']))
+            launcher = ci['ccache'] + ' '
 
         if host_ccmplr_name == 'clang':
             print('Host compiler clang')
@@ -802,8 +2633,8 @@ CROSS_COMPILER_TARGET_ARCHS += RTEMS-pc386{0}'''.format(qemu_suffix))
                 f.write('''
 GNU         = NO
 CMPLR_CLASS = clang
-CC          = {0}{2}
-CCC         = {1}{2}'''.format(host_ccmplr_name, host_cppcmplr_name, host_cmplr_ver_suffix))
+CC          = {3}{0}{2}
+CCC         = {3}{1}{2}'''.format(host_ccmplr_name, host_cppcmplr_name, host_cmplr_ver_suffix, launcher))
 
             # hack
             with open(os.path.join(places['EPICS_BASE'], 'configure', 'CONFIG.gnuCommon'), 'a') as f:
@@ -816,8 +2647,8 @@ CMPLR_CLASS = clang''')
             with open(os.path.join(places['EPICS_BASE'], 'configure', 'os',
                                    'CONFIG_SITE.Common.' + os.environ['EPICS_HOST_ARCH']), 'a') as f:
                 f.write('''
-CC          = {0}{2}
-CCC         = {1}{2}'''.format(host_ccmplr_name, host_cppcmplr_name, host_cmplr_ver_suffix))
+CC          = {3}{0}{2}
+CCC         = {3}{1}{2}'''.format(host_ccmplr_name, host_cppcmplr_name, host_cmplr_ver_suffix, launcher))
 
         # Add additional flags to CONFIG_SITE
         flags_text = ''
@@ -841,12 +2672,12 @@ USR_CXXFLAGS += {0}'''.format(os.environ['USR_CXXFLAGS'])
 
     if ci['os'] == 'windows' and ci['choco']:
         fold_start('install.choco', 'Installing CHOCO packages')
-        sp.check_call(['choco', 'install'] + ci['choco'])
+        run(['choco', 'install'] + ci['choco'], check=True)
         fold_end('install.choco', 'Installing CHOCO packages')
 
     if ci['os'] == 'linux' and ci['apt']:
         fold_start('install.apt', 'Installing APT packages')
-        sp.check_call(['sudo', 'apt-get', '-y', 'install'] + ci['apt'])
+        run(['sudo', 'apt-get', '-y', 'install'] + ci['apt'], check=True)
         fold_end('install.apt', 'Installing APT packages')
 
     if ci['os'] == 'linux' and 'RTEMS' in os.environ:
@@ -854,53 +2685,48 @@ USR_CXXFLAGS += {0}'''.format(os.environ['USR_CXXFLAGS'])
         print('Downloading RTEMS {0} cross compiler: {1}'
               .format(os.environ['RTEMS'], tar_name))
         sys.stdout.flush()
-        sp.check_call(['curl', '-fsSL', '--retry', '3', '-o', tar_name,
-                       'https://github.com/mdavidsaver/rsb/releases/download/20171203-{0}/{1}'
-                      .format(os.environ['RTEMS'], tar_name)],
-                      cwd=toolsdir)
-        sp.check_call(['tar', '-C', '/', '-xmj', '-f', os.path.join(toolsdir, tar_name)])
+        run(['curl', '-fsSL', '--retry', '3', '-o', tar_name,
+             'https://github.com/mdavidsaver/rsb/releases/download/20171203-{0}/{1}'
+             .format(os.environ['RTEMS'], tar_name)],
+            cwd=toolsdir, check=True, retries=ci['net_retries'], timeout=ci['net_timeout'])
+        run(['tar', '-C', '/', '-xmj', '-f', os.path.join(toolsdir, tar_name)], check=True)
         os.remove(os.path.join(toolsdir, tar_name))
 
     setup_for_build(args)
 
     print('{0}EPICS_HOST_ARCH = {1}{2}'.format(ANSI_CYAN, os.environ['EPICS_HOST_ARCH'], ANSI_RESET))
-    print('{0}$ make --version{1}'.format(ANSI_CYAN, ANSI_RESET))
-    sys.stdout.flush()
-    call_make(['--version'], parallel=0)
-    print('{0}$ perl --version{1}'.format(ANSI_CYAN, ANSI_RESET))
-    sys.stdout.flush()
-    sp.check_call(['perl', '--version'])
-
-    if re.match(r'^vs', ci['compiler']):
-        print('{0}$ cl{1}'.format(ANSI_CYAN, ANSI_RESET))
-        sys.stdout.flush()
-        sp.check_call(['cl'])
+    if ci['make_load']:
+        print('{0}PARALLEL_MAKE = {1} (auto: {2} CPUs, {3} memory){4}'
+              .format(ANSI_CYAN, ci['parallel_make'], ci['make_load'],
+                      '{0:.1f} GiB'.format(ci['memory'] / 1073741824.) if ci['memory'] else 'unknown', ANSI_RESET))
     else:
-        cc = ci['compiler']
-        print('{0}$ {1} --version{2}'.format(ANSI_CYAN, cc, ANSI_RESET))
+        print('{0}PARALLEL_MAKE = {1}{2}'.format(ANSI_CYAN, ci['parallel_make'], ANSI_RESET))
+    for cmd in toolchain_probes():
+        print('{0}$ {1}{2}'.format(ANSI_CYAN, ' '.join(cmd), ANSI_RESET))
+        (exitcode, output) = probe_result(cmd)
+        print(output.rstrip())
         sys.stdout.flush()
-        sp.check_call([cc, '--version'])
+        if exitcode:
+            raise sp.CalledProcessError(exitcode, cmd)
 
     if not building_base:
         fold_start('build.dependencies', 'Build missing/outdated dependencies')
-        for mod in modules_to_compile:
-            place = places[setup[mod + "_VARNAME"]]
-            print('{0}Building dependency {1} in {2}{3}'.format(ANSI_YELLOW, mod, place, ANSI_RESET))
-            call_make(cwd=place, silent=silent_dep_builds)
-            if ci['clean_deps']:
-                call_make(args=['clean'], cwd=place, silent=silent_dep_builds)
+        build_dependencies(modules_to_compile)
         fold_end('build.dependencies', 'Build missing/outdated dependencies')
 
         print('{0}Dependency module information{1}'.format(ANSI_CYAN, ANSI_RESET))
         print('Module     Tag          Binaries    Commit')
         print(100 * '-')
         for mod in modlist():
-            if mod in modules_to_compile:
+            if mod in restored_modules:
+                stat = 'restored'
+            elif mod in modules_to_compile:
                 stat = 'rebuilt'
             else:
                 stat = 'from cache'
-            commit = sp.check_output(['git', 'log', '-n1', '--oneline'], cwd=places[setup[mod + "_VARNAME"]])\
-                .decode('ascii').strip()
+                record_history('dependency', mod, time.time(), 'cached')
+            commit = run(['git', 'log', '-n1', '--oneline'], cwd=places[setup[mod + "_VARNAME"]],
+                         capture=True, check=True)[1].strip()
             print("%-10s %-12s %-11s %s" % (mod, setup[mod], stat, commit))
 
         print('{0}Contents of RELEASE.local{1}'.format(ANSI_CYAN, ANSI_RESET))
@@ -915,30 +2741,519 @@ def build(args):
     fold_end('build.module', 'Build the main module')
 
 
+# find_tests(top, arch)
+#
+# Return the test scripts (*.t) in all O.<arch> directories below top (relative to top)
+def find_tests(top, arch):
+    tests = []
+    for root, dirs, files in os.walk(top):
+        if os.path.basename(root) == 'O.' + arch:
+            tests.extend(os.path.relpath(os.path.join(root, name), top)
+                         for name in sorted(files) if name.endswith('.t'))
+        # skip VCS metadata and the build directories of other architectures
+        dirs[:] = sorted(name for name in dirs
+                         if not name.startswith('.') and (not name.startswith('O.') or name == 'O.' + arch))
+    return tests
+
+
+# test_key(top, test)
+#
+# Return the name of the test script test (relative to top) in the test durations: <module dir>/<test>
+def test_key(top, test):
+    return '{0}/{1}'.format(os.path.basename(os.path.abspath(top)), test.replace(os.sep, '/'))
+
+
+# read_test_durations(durations_file=None)
+#
+# Return the durations (by test_key()) of earlier test runs from durations_file
+# [default: $CACHEDIR/test_durations.json]
+def read_test_durations(durations_file=None):
+    if not durations_file:
+        durations_file = os.path.join(cachedir, 'test_durations.json')
+    if os.path.exists(durations_file):
+        try:
+            with open(durations_file) as f:
+                return json.load(f)
+        except ValueError:
+            logger.debug('Ignoring corrupt test durations %s', durations_file)
+    return {}
+
+
+# run_test(script)
+#
+# Run the test script like the tapfiles target does, writing its output into the .tap file next to it
+# (stderr goes to the log), killing it after ci['test_timeout'] seconds or ci['test_idle_timeout'] seconds
+# without output
+# Returns the status ('ok', 'failed' or 'killed'), the exit code and the duration
+def run_test(script):
+    tapfile = script[:-2] + '.tap'
+    start = time.time()
+    killed = []
+    with io.open(tapfile, 'w', encoding='utf-8', errors='replace') as tap:
+        exitcode = run(['perl', os.path.basename(script), '-tap'], cwd=os.path.dirname(script), on_line=tap.write,
+                       timeout=ci['test_timeout'] or None, idle_timeout=ci['test_idle_timeout'] or None,
+                       on_kill=killed.append)[0]
+        end = time.time()
+        if killed:
+            tap.write(u'Bail out! Killed by the test runner {0}\n'.format(killed[0]))
+            return 'killed', exitcode, end - start
+    return ('failed' if exitcode else 'ok'), exitcode, end - start
+
+
+# parse_shard(text)
+#
+# Return the test shard (index, count) for text 'index/count' (index counting from 1)
+def parse_shard(text):
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', text)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError("Invalid test shard '{0}' (expected <index>/<count>, e.g. 1/4)".format(text))
+    return int(match.group(1)), int(match.group(2))
+
+
+# select_shard(top, tests, shard)
+#
+# Return the tests (relative to top) that belong to shard (index, count)
+# All shards have to make the same split: with ci['test_durations'] (a file that all shards share),
+# the tests are distributed by duration (longest first, each to the shard with the least total time),
+# otherwise by a hash of their name
+def select_shard(top, tests, shard):
+    (index, count) = shard
+    if ci['test_durations']:
+        durations = read_test_durations(ci['test_durations'])
+        known = sorted(durations[test_key(top, test)] for test in tests if test_key(top, test) in durations)
+        # tests without a recorded duration count as average ones
+        default = known[len(known) // 2] if known else 1.
+        totals = [0.] * count
+        selected = []
+        for test in sorted(tests, key=lambda test: (-durations.get(test_key(top, test), default), test)):
+            least = totals.index(min(totals))
+            totals[least] += durations.get(test_key(top, test), default)
+            if least == index - 1:
+                selected.append(test)
+        selected = set(selected)
+        return [test for test in tests if test in selected]
+    return [test for test in tests
+            if int(hashlib.sha1(test_key(top, test).encode('utf-8')).hexdigest(), 16) % count == index - 1]
+
+
+# shard_tests_file(top, shard)
+#
+# Return the name of the file listing the tests that the test phase ran for shard (index, count)
+def shard_tests_file(top, shard):
+    return os.path.join(ci['test_report_dir'] or top, 'test-shard-{0}of{1}.json'.format(*shard))
+
+
+# write_shard_tests(top, shard, tests)
+#
+# Record the tests (relative to top) of shard, for report_test_results()
+def write_shard_tests(top, shard, tests):
+    filename = shard_tests_file(top, shard)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        write_file_atomic(filename, json.dumps([test.replace(os.sep, '/') for test in tests], indent=1))
+    except (IOError, OSError) as e:
+        print('{0}Cannot write list of shard tests {1} ({2}){3}'.format(ANSI_RED, filename, e, ANSI_RESET))
+        sys.stdout.flush()
+
+
+# run_tests(top, shard=None)
+#
+# Run the test scripts in the O.<EPICS_HOST_ARCH> directories below top, ci['test_jobs'] (default: all cores)
+# at a time, starting with the ones that took longest in earlier runs
+# With shard (index, count), only run the tests of that shard (see select_shard())
+# Failed tests are run again up to ci['test_retries'] times (keeping the output of a failed run
+# in <test>.tap.<attempt>), tests that pass on retry are listed as flaky in test-flaky.json
+# (for a shard: test-flaky-<index>of<count>.json) in ci['test_report_dir'] (default: top)
+# Returns the number of failed tests, or None if there are no test scripts
+def run_tests(top, shard=None):
+    tests = find_tests(top, os.environ['EPICS_HOST_ARCH'])
+    if not tests:
+        return None
+    if shard:
+        total = len(tests)
+        tests = select_shard(top, tests, shard)
+        print('{0}Test shard {1} of {2}: {3} of {4} tests{5}'
+              .format(ANSI_YELLOW, shard[0], shard[1], len(tests), total, ANSI_RESET))
+        write_shard_tests(top, shard, tests)
+        if not tests:
+            return 0
+    durations = read_test_durations()
+    scripts = dict((test, os.path.abspath(os.path.join(top, test))) for test in tests)
+    # tests without a recorded duration first, they might be long
+    tests.sort(key=lambda test: -durations.get(test_key(top, test), 1e9))
+    jobs = min(ci['test_jobs'] or usable_cpus(), len(tests))
+    print('{0}Running {1} tests using {2} parallel jobs{3}'.format(ANSI_YELLOW, len(tests), jobs, ANSI_RESET))
+    sys.stdout.flush()
+
+    print_lock = threading.Lock()
+    colors = {'ok': ANSI_GREEN, 'failed': ANSI_RED, 'killed': ANSI_RED}
+
+    def run_one(test):
+        start = time.time()
+        (status, exitcode, duration) = run_test(scripts[test])
+        record_history('test', test_key(top, test), start, status)
+        with print_lock:
+            print('{0}{1:6} {2:8.1f}s  {3}{4}{5}'
+                  .format(colors[status], status.upper(), duration, test,
+                          ' (exit code {0})'.format(exitcode) if exitcode else '', ANSI_RESET))
+            sys.stdout.flush()
+        return status, duration
+
+    pool = ThreadPool(jobs)
+    try:
+        results = dict(zip(tests, pool.map(run_one, tests, chunksize=1)))
+        attempts = dict((test, [results[test][0]]) for test in tests)
+        for attempt in range(1, ci['test_retries'] + 1):
+            retry = [test for test in tests if results[test][0] != 'ok']
+            if not retry:
+                break
+            print('{0}Running {1} failed tests again (retry {2} of {3}){4}'
+                  .format(ANSI_YELLOW, len(retry), attempt, ci['test_retries'], ANSI_RESET))
+            sys.stdout.flush()
+            for test in retry:
+                tapfile = scripts[test][:-2] + '.tap'
+                if os.path.exists(tapfile):
+                    replace_file(tapfile, '{0}.{1}'.format(tapfile, attempt))
+            results.update(zip(retry, pool.map(run_one, retry, chunksize=1)))
+            for test in retry:
+                attempts[test].append(results[test][0])
+    except BaseException:
+        # do not start the remaining tests
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [test for test in tests if results[test][0] != 'ok']
+    flaky = [test for test in tests if len(attempts[test]) > 1 and results[test][0] == 'ok']
+    durations.update((test_key(top, test), round(results[test][1], 3)) for test in tests)
+    durations_file = os.path.join(cachedir, 'test_durations.json')
+    if shard and ci['test_durations'] and os.path.realpath(ci['test_durations']) == os.path.realpath(durations_file):
+        # other shards may still be splitting the tests by this file
+        logger.debug('Not updating %s, it is used for splitting the test shards', durations_file)
+    else:
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            write_file_atomic(durations_file, json.dumps(durations, indent=1, sort_keys=True))
+        except (IOError, OSError) as e:
+            logger.debug('Could not write test durations: %s', e)
+
+    if ci['test_retries']:
+        report = collections.OrderedDict([
+            ('flaky', [{'test': test.replace(os.sep, '/'), 'attempts': attempts[test]} for test in flaky]),
+            ('failed', [{'test': test.replace(os.sep, '/'), 'attempts': attempts[test]} for test in failed]),
+        ])
+        name = 'test-flaky-{0}of{1}.json'.format(*shard) if shard else 'test-flaky.json'
+        report_dir = ci['test_report_dir'] or top
+        try:
+            if not os.path.isdir(report_dir):
+                os.makedirs(report_dir)
+            write_file_atomic(os.path.join(report_dir, name), json.dumps(report, indent=1))
+        except (IOError, OSError) as e:
+            print('{0}Cannot write flaky test report to {1} ({2}){3}'.format(ANSI_RED, report_dir, e, ANSI_RESET))
+        if flaky:
+            print('{0}{1} tests passed only on retry (flaky):{2}'.format(ANSI_YELLOW, len(flaky), ANSI_RESET))
+            for test in flaky:
+                print('    {0} ({1})'.format(test, ', '.join(attempts[test])))
+
+    print('{0}{1} of {2} tests failed{3}'.format(ANSI_RED if failed else ANSI_GREEN, len(failed), len(tests),
+                                                 ANSI_RESET))
+    for test in failed:
+        print('    {0}'.format(test))
+    sys.stdout.flush()
+    return len(failed)
+
+
 def test(args):
     if ci['test']:
         setup_for_build(args)
         fold_start('test.module', 'Run the main module tests')
-        if has_test_results:
-            call_make(['tapfiles'])
-        else:
-            call_make(['runtests'])
+        failed = None
+        shard = args.shard or ci['test_shard']
+        if ci['test_runner'] == 'native' or shard or ci['test_retries']:
+            if 'WINE' in os.environ or 'RTEMS' in os.environ:
+                print('{0}Native test runner does not run cross-compiled tests, using make{1}'
+                      .format(ANSI_YELLOW, ANSI_RESET))
+                if shard:
+                    print('{0}Test shard {1} of {2} runs all tests{3}'
+                          .format(ANSI_YELLOW, shard[0], shard[1], ANSI_RESET))
+            else:
+                failed = run_tests(curdir, shard)
+                if failed is None:
+                    print('{0}No test scripts found for {1}, using make{2}'
+                          .format(ANSI_YELLOW, os.environ['EPICS_HOST_ARCH'], ANSI_RESET))
+        if failed is None:
+            if has_test_results:
+                call_make(['tapfiles'])
+            else:
+                call_make(['runtests'])
         fold_end('test.module', 'Run the main module tests')
+        if failed and not ci['defer_test_failures']:
+            sys.exit(1)
     else:
         print("{0}Action 'test' skipped as per configuration{1}"
               .format(ANSI_YELLOW, ANSI_RESET))
 
 
+tap_plan_pattern = re.compile(r'^1\.\.(\d+)')
+tap_result_pattern = re.compile(r'^(not )?ok\b\s*(\d*)\s*(?:-\s*)?(.*)$')
+tap_directive_pattern = re.compile(r'^\s*(skip|todo)\S*\s*(.*?)\s*$', re.IGNORECASE)
+xml_invalid_chars = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+# parse_tap(filename)
+#
+# Read the TAP output in filename (line by line)
+# Returns a dict with the plan ('planned', None if missing), counts of test points ('run', 'passed', 'failed',
+# 'skipped', 'todo'), the 'points' as (number, description, result, directive reason) tuples with result
+# 'ok', 'not ok', 'skip' or 'todo', the 'bailout' message and the list of 'problems' (empty if the file passed)
+def parse_tap(filename):
+    result = {'planned': None, 'run': 0, 'passed': 0, 'failed': 0, 'skipped': 0, 'todo': 0,
+              'points': [], 'bailout': None, 'problems': []}
+    with io.open(filename, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('ok') or line.startswith('not ok'):
+                match = tap_result_pattern.match(line)
+                if match:
+                    (failed, number, text) = (bool(match.group(1)), match.group(2), match.group(3).strip())
+                elif line.startswith('not ok'):
+                    (failed, number, text) = (True, '', line[6:].strip())
+                else:
+                    continue
+                result['run'] += 1
+                number = int(number) if number else result['run']
+                # a directive follows the last '#' (that starts the text or follows whitespace)
+                (description, directive, reason) = (text, '', '')
+                (head, hash, tail) = text.rpartition('#')
+                if hash and (not head or head[-1].isspace()):
+                    directive_match = tap_directive_pattern.match(tail)
+                    if directive_match:
+                        description = head.strip()
+                        directive = directive_match.group(1).lower()
+                        reason = directive_match.group(2)
+                if directive == 'skip':
+                    kind = 'skip'
+                    result['skipped'] += 1
+                elif directive == 'todo':
+                    kind = 'todo'
+                    result['todo'] += 1
+                elif failed:
+                    kind = 'not ok'
+                    result['failed'] += 1
+                    result['problems'].append('not ok {0} - {1}'.format(number, description))
+                else:
+                    kind = 'ok'
+                    result['passed'] += 1
+                result['points'].append((number, description, kind, reason))
+            elif line.startswith('1..'):
+                match = tap_plan_pattern.match(line)
+                if match:
+                    result['planned'] = int(match.group(1))
+            elif line.startswith('Bail out!'):
+                result['bailout'] = line[9:].strip()
+                result['problems'].append(line.strip())
+    if result['planned'] is None:
+        result['problems'].append('No plan')
+    elif result['planned'] != result['run']:
+        result['problems'].append('Planned {0} tests but ran {1}'.format(result['planned'], result['run']))
+    return result
+
+
+# find_tap_files(top)
+#
+# Return the TAP files (*.tap) in the O.* directories below top (relative to top)
+def find_tap_files(top):
+    tapfiles = []
+    for root, dirs, files in os.walk(top):
+        if os.path.basename(root).startswith('O.'):
+            tapfiles.extend(os.path.relpath(os.path.join(root, name), top)
+                            for name in sorted(files) if name.endswith('.tap'))
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+    return tapfiles
+
+
+# junit_xml(results)
+#
+# Return the JUnit XML report (the root element) for results (a list of (TAP file, parse_tap() result) tuples)
+def junit_xml(results):
+    def clean(text):
+        return xml_invalid_chars.sub(u'?', text)
+
+    root = ET.Element('testsuites')
+    for (tapfile, result) in results:
+        name = tapfile[:-4].replace(os.sep, '/')
+        # plan and bail out problems are not attached to a test point
+        others = [problem for problem in result['problems'] if not problem.startswith('not ok')]
+        suite = ET.SubElement(root, 'testsuite', name=name, tests=str(len(result['points']) + len(others)),
+                              failures=str(len(result['problems'])), skipped=str(result['skipped']))
+        for (number, description, kind, reason) in result['points']:
+            case = ET.SubElement(suite, 'testcase', classname=name,
+                                 name=clean(u'{0} - {1}'.format(number, description) if description else str(number)))
+            if kind == 'not ok':
+                ET.SubElement(case, 'failure', message='not ok')
+            elif kind == 'skip':
+                ET.SubElement(case, 'skipped', message=clean(reason))
+        for problem in others:
+            case = ET.SubElement(suite, 'testcase', classname=name, name='TAP')
+            ET.SubElement(case, 'failure', message=clean(problem))
+    return root
+
+
+test_counts = ['files', 'failed_files', 'run', 'passed', 'failed', 'skipped', 'todo']
+
+
+# new_test_summary()
+#
+# Return an empty test results summary
+def new_test_summary():
+    return collections.OrderedDict([('totals', dict((count, 0) for count in test_counts)),
+                                    ('directories', collections.OrderedDict()),
+                                    ('failed', collections.OrderedDict())])
+
+
+# add_test_totals(summary, directory, totals)
+#
+# Add the test counts in totals for directory to summary
+def add_test_totals(summary, directory, totals):
+    if directory not in summary['directories']:
+        summary['directories'][directory] = dict((count, 0) for count in test_counts)
+    for target in [summary['totals'], summary['directories'][directory]]:
+        for count in test_counts:
+            target[count] += totals[count]
+
+
+# print_test_summary(summary)
+#
+# Print the totals per directory and the problems of the failed TAP files in summary
+def print_test_summary(summary):
+    print('   Files   Tests  Failed Skipped  Directory')
+    for (directory, totals) in summary['directories'].items():
+        print('{0}{1:8d}{2:8d}{3:8d}{4:8d}  {5}{6}'
+              .format(ANSI_RED if totals['failed_files'] else '', totals['files'], totals['run'],
+                      totals['failed'], totals['skipped'], directory, ANSI_RESET))
+    for (tapfile, problems) in summary['failed'].items():
+        print('{0}FAILED {1}{2}'.format(ANSI_RED, tapfile, ANSI_RESET))
+        for problem in problems:
+            print('    {0}'.format(problem))
+    totals = summary['totals']
+    print('{0}{1} tests in {2} files: {3} passed, {4} failed, {5} skipped, {6} todo; {7} files failed{8}'
+          .format(ANSI_RED if totals['failed_files'] else ANSI_GREEN, totals['run'], totals['files'],
+                  totals['passed'], totals['failed'], totals['skipped'], totals['todo'], totals['failed_files'],
+                  ANSI_RESET))
+    sys.stdout.flush()
+
+
+# write_test_reports(report_dir, name, summary, junit)
+#
+# Write the test results summary into <name>.json and the JUnit XML report junit into <name>.xml in report_dir
+def write_test_reports(report_dir, name, summary, junit):
+    try:
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        write_file_atomic(os.path.join(report_dir, name + '.xml'),
+                          ET.tostring(junit, encoding='us-ascii').decode('ascii'))
+        write_file_atomic(os.path.join(report_dir, name + '.json'), json.dumps(summary, indent=1))
+    except (IOError, OSError) as e:
+        print('{0}Cannot write test reports to {1} ({2}){3}'.format(ANSI_RED, report_dir, e, ANSI_RESET))
+        sys.stdout.flush()
+
+
+# report_test_results(top, shard=None)
+#
+# Sum up the results of all TAP files below top, per directory
+# Prints a summary and writes test-results.xml (JUnit) and test-results.json
+# (for a shard: only its tests, into test-results-<index>of<count>.*) into ci['test_report_dir'] (default: top)
+# The tests of a shard are the ones that the test phase recorded (see write_shard_tests()); without that
+# list (tests run by make), the .tap files are split like select_shard() splits the tests
+# Returns the number of failed TAP files, or None if there are none
+def report_test_results(top, shard=None):
+    tapfiles = find_tap_files(top)
+    if shard:
+        # only the results of the tests in this shard (other .tap files may be left over)
+        if os.path.exists(shard_tests_file(top, shard)):
+            with open(shard_tests_file(top, shard)) as f:
+                tests = [test.replace('/', os.sep) for test in json.load(f)]
+        else:
+            tests = select_shard(top, [tapfile[:-4] + '.t' for tapfile in tapfiles], shard)
+        tapfiles = [test[:-2] + '.tap' for test in tests if test[:-2] + '.tap' in tapfiles]
+    if not tapfiles:
+        return None
+    results = [(tapfile, parse_tap(os.path.join(top, tapfile))) for tapfile in tapfiles]
+
+    summary = new_test_summary()
+    for (tapfile, result) in results:
+        totals = dict((count, result[count]) for count in test_counts if count in result)
+        totals.update(files=1, failed_files=1 if result['problems'] else 0)
+        add_test_totals(summary, os.path.dirname(tapfile).replace(os.sep, '/'), totals)
+        if result['problems']:
+            summary['failed'][tapfile.replace(os.sep, '/')] = result['problems']
+    name = 'test-results'
+    if shard:
+        summary['shard'] = list(shard)
+        name += '-{0}of{1}'.format(*shard)
+
+    print_test_summary(summary)
+    write_test_reports(ci['test_report_dir'] or top, name, summary, junit_xml(results))
+    return summary['totals']['failed_files']
+
+
+# merge_test_results(directory)
+#
+# Merge the test reports of all shards (test-results-<index>of<count>.json/.xml) in directory
+# Prints the summary and writes test-results.xml and test-results.json into ci['test_report_dir']
+# (default: directory)
+# Returns the number of failed TAP files (plus missing shards), or None if there are no shard reports
+def merge_test_results(directory):
+    shard_pattern = re.compile(r'^test-results-(\d+)of(\d+)\.json$')
+    shards = sorted((int(match.group(1)), int(match.group(2)), match.group(0)[:-5])
+                    for match in [shard_pattern.match(name) for name in os.listdir(directory)] if match)
+    if not shards:
+        return None
+    summary = new_test_summary()
+    junit = ET.Element('testsuites')
+    for (index, count, name) in shards:
+        with open(os.path.join(directory, name + '.json')) as f:
+            part = json.load(f, object_pairs_hook=collections.OrderedDict)
+        for (subdir, totals) in part['directories'].items():
+            add_test_totals(summary, subdir, totals)
+        summary['failed'].update(part['failed'])
+        if os.path.exists(os.path.join(directory, name + '.xml')):
+            junit.extend(list(ET.parse(os.path.join(directory, name + '.xml')).getroot()))
+
+    print('{0}Merged results of {1} test shards from {2}{3}'.format(ANSI_CYAN, len(shards), directory, ANSI_RESET))
+    print_test_summary(summary)
+    write_test_reports(ci['test_report_dir'] or directory, 'test-results', summary, junit)
+    missing = [index for index in range(1, max(shard[1] for shard in shards) + 1)
+               if index not in [shard[0] for shard in shards]]
+    if missing or len(set(shard[1] for shard in shards)) > 1:
+        print('{0}Incomplete set of test shards: missing {1}, found {2}{3}'
+              .format(ANSI_RED, ', '.join(str(index) for index in missing) or 'none',
+                      ', '.join('{0}/{1}'.format(*shard[:2]) for shard in shards), ANSI_RESET))
+        sys.stdout.flush()
+        return summary['totals']['failed_files'] + max(1, len(missing))
+    return summary['totals']['failed_files']
+
+
 def test_results(args):
     if ci['test']:
-        setup_for_build(args)
-        fold_start('test.results', 'Sum up main module test results')
-        if has_test_results:
-            call_make(['test-results'], parallel=0, silent=True)
+        if args.merge:
+            fold_start('test.results', 'Merge test results of all shards')
+            failed = merge_test_results(os.path.abspath(args.merge))
+            if failed is None:
+                print('{0}No test shard results found in {1}{2}'.format(ANSI_YELLOW, args.merge, ANSI_RESET))
+            fold_end('test.results', 'Merge test results of all shards')
         else:
-            print("{0}Base in {1} does not implement 'test-results' target{2}"
-                  .format(ANSI_YELLOW, places['EPICS_BASE'], ANSI_RESET))
-        fold_end('test.results', 'Sum up main module test results')
+            setup_for_build(args)
+            fold_start('test.results', 'Sum up main module test results')
+            failed = report_test_results(curdir, args.shard or ci['test_shard'])
+            if failed is None:
+                print('{0}No test results (.tap files) found in {1}{2}'.format(ANSI_YELLOW, curdir, ANSI_RESET))
+            fold_end('test.results', 'Sum up main module test results')
+        if failed:
+            sys.exit(1)
     else:
         print("{0}Action 'test-results' skipped as per configuration{1}"
               .format(ANSI_YELLOW, ANSI_RESET))
@@ -949,10 +3264,173 @@ def doExec(args):
     setup_for_build(args)
     os.environ['MAKE'] = 'make'
     fold_start('exec.command', 'Execute command {}'.format(args.cmd))
-    sp.check_call(' '.join(args.cmd), shell=True)
+    run(' '.join(args.cmd), shell=True, check=True)
     fold_end('exec.command', 'Execute command {}'.format(args.cmd))
 
 
+# percentile(values, fraction)
+#
+# Return the value at fraction (0..1) of the sorted list values
+def percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def history(args):
+    'show trends of the recorded build history'
+    filename = os.path.join(cachedir, 'history.db')
+    if not sqlite3 or not os.path.exists(filename):
+        print('{0}No history database {1} (set HISTORY=YES to record one){2}'
+              .format(ANSI_YELLOW, filename, ANSI_RESET))
+        return
+    db = open_history(filename)
+    query = 'SELECT kind, name, duration, outcome, runner FROM history WHERE time >= ?'
+    params = [time.time() - args.days * 86400 if args.days else 0]
+    if args.kind:
+        query += ' AND kind = ?'
+        params.append(args.kind)
+    groups = collections.OrderedDict()
+    for (kind, name, duration, outcome, runner) in db.execute(query + ' ORDER BY time', params):
+        if args.name and not re.search(args.name, name):
+            continue
+        groups.setdefault((kind, name), []).append((duration, outcome, runner))
+    db.close()
+
+    kinds = ['phase', 'clone', 'dependency', 'test']
+    regressions = []
+    print('{0}Durations [s] from {1}{2}'.format(ANSI_CYAN, filename, ANSI_RESET))
+    print('Kind          Runs  Median     P90    Last   Trend  Cached  Name')
+    print(100 * '-')
+    for ((kind, name), runs) in sorted(groups.items(), key=lambda item: (
+            kinds.index(item[0][0]) if item[0][0] in kinds else len(kinds),
+            -percentile(sorted(run[0] for run in item[1]), 0.5))):
+        durations = sorted(run[0] for run in runs)
+        trend = '-'
+        color = ''
+        if len(runs) >= 2 * args.window:
+            recent = percentile(sorted(run[0] for run in runs[-args.window:]), 0.5)
+            earlier = percentile(sorted(run[0] for run in runs[:-args.window]), 0.5)
+            if earlier > 0:
+                change = 100. * (recent - earlier) / earlier
+                trend = '{0:+.0f}%'.format(change)
+                if change > args.threshold and recent - earlier > 1.:
+                    color = ANSI_RED
+                    regressions.append((kind, name, earlier, recent))
+        cached = '-'
+        if kind in ['clone', 'dependency']:
+            cached = '{0:.0f}%'.format(100. * len([run for run in runs if run[1] in ['cached', 'restored']])
+                                       / len(runs))
+        print('{0}{1:12}{2:6d}{3:8.1f}{4:8.1f}{5:8.1f}{6:>8}{7:>8}  {8}{9}'
+              .format(color, kind, len(runs), percentile(durations, 0.5), percentile(durations, 0.9),
+                      runs[-1][0], trend, cached, name, ANSI_RESET))
+
+    if regressions:
+        print('{0}Slower in the last {1} runs:{2}'.format(ANSI_RED, args.window, ANSI_RESET))
+        for (kind, name, earlier, recent) in regressions:
+            print('    {0} {1}: {2:.1f}s -> {3:.1f}s'.format(kind, name, earlier, recent))
+
+    # runners: phase durations relative to the median of all runners
+    ratios = {}
+    for ((kind, name), runs) in groups.items():
+        if kind != 'phase':
+            continue
+        median = percentile(sorted(run[0] for run in runs), 0.5)
+        for (duration, outcome, runner) in runs:
+            if median > 0:
+                ratios.setdefault(runner, []).append(duration / median)
+    if len(ratios) > 1:
+        print('{0}Phase durations per runner, relative to the median of all runners{1}'
+              .format(ANSI_CYAN, ANSI_RESET))
+        for (runner, values) in sorted(ratios.items(), key=lambda item: -percentile(sorted(item[1]), 0.5)):
+            print('{0:8.2f}  {1:6d}  {2}'.format(percentile(sorted(values), 0.5), len(values), runner))
+    sys.stdout.flush()
+
+
+# history_estimates()
+#
+# Return a dict (kind, name, outcome) -> median duration of the steps in the history database
+# (phases only for this project), without changing the database
+def history_estimates():
+    filename = os.path.join(cachedir, 'history.db')
+    if not sqlite3 or not os.path.exists(filename):
+        return {}
+    durations = {}
+    db = sqlite3.connect(filename)
+    try:
+        for (kind, name, duration, outcome) in db.execute(
+                "SELECT kind, name, duration, outcome FROM history WHERE kind != 'phase' OR project = ?",
+                [os.path.basename(curdir)]):
+            durations.setdefault((kind, name, outcome), []).append(duration)
+    except sqlite3.Error as e:
+        logger.debug('Cannot read history database %s: %s', filename, e)
+    db.close()
+    return dict((item, percentile(sorted(values), 0.5)) for (item, values) in durations.items())
+
+
+# format_estimate(seconds)
+#
+# Return a duration for the plan ('?' if unknown)
+def format_estimate(seconds):
+    if seconds is None:
+        return '?'
+    return '{0}m{1:02d}s'.format(int(seconds) // 60, int(seconds) % 60)
+
+
+def plan(args):
+    '''show what prepare would clone and build, and how long it would take,
+    without changing the cache, RELEASE.local or CONFIG_SITE
+    '''
+    load_setup(save=False)
+    estimates = history_estimates()
+
+    total = 0.
+    unknown = 0
+    print('{0}Plan for {1} with cache in {2}{3}'.format(ANSI_CYAN, os.path.basename(curdir), cachedir, ANSI_RESET))
+    print('Module     Tag          Checkout                    Build       Estimate  Reasons')
+    print(100 * '-')
+    for (mod, outcome, checkout, reason, changes) in dependency_status(modlist(), save=False):
+        reasons = [reason] if reason else []
+        if ci['artifact_store'] and outcome == 'cached' and changes and os.path.exists(artifact_file(mod)):
+            changes = ['restore'] + changes
+        steps = []
+        if outcome != 'cached':
+            steps.append(('clone', outcome))
+        if changes:
+            steps.append(('dependency', 'restored' if changes[0] == 'restore' else 'built'))
+            reasons.extend(change for change in changes if change != 'restore')
+        estimate = 0.
+        for (kind, result) in steps:
+            if (kind, mod, result) in estimates:
+                estimate += estimates[(kind, mod, result)]
+            else:
+                estimate = None
+                break
+        if estimate is None:
+            unknown += 1
+        else:
+            total += estimate
+        build = ('restore' if changes[0] == 'restore' else 'rebuild') if changes else 'current'
+        print('{0:10} {1:12} {2:27} {3:11} {4:>8}  {5}'
+              .format(mod, setup[mod], checkout, build, format_estimate(estimate), ', '.join(reasons)))
+
+    print('{0}Estimated time for the dependencies: {1}{2}{3}'
+          .format(ANSI_CYAN, format_estimate(total),
+                  ' (no history for {0} of them)'.format(unknown) if unknown else '', ANSI_RESET))
+    phases = []
+    for phase in ['prepare', 'build', 'test']:
+        if ('phase', phase, 'ok') in estimates:
+            phases.append('{0} {1}'.format(phase, format_estimate(estimates[('phase', phase, 'ok')])))
+    if ('phase', 'test', 'ok') not in estimates:
+        durations = read_test_durations()
+        prefix = test_key(curdir, '')
+        tests = [duration for (test, duration) in durations.items() if test.startswith(prefix)]
+        if tests:
+            phases.append('test {0} (sum of {1} tests)'.format(format_estimate(sum(tests)), len(tests)))
+    if phases:
+        print('{0}Earlier runs of {1}: {2}{3}'
+              .format(ANSI_CYAN, os.path.basename(curdir), ', '.join(phases), ANSI_RESET))
+    sys.stdout.flush()
+
+
 def with_vcvars(cmd):
     '''re-exec main script with a (hopefully different) command
     '''
@@ -991,7 +3469,7 @@ call "{vcvars}" {arch}
     with open('vcvars-trampoline.bat', 'w') as F:
         F.write(script)
 
-    returncode = sp.call('vcvars-trampoline.bat', shell=True)
+    returncode = run('vcvars-trampoline.bat', shell=True, pipe=False)[0]
     if returncode != 0:
         sys.exit(returncode)
 
@@ -1008,20 +3486,40 @@ def getargs():
     cmd = subp.add_parser('prepare')
     cmd.set_defaults(func=prepare)
 
+    cmd = subp.add_parser('plan')
+    cmd.set_defaults(func=plan)
+
     cmd = subp.add_parser('build')
     cmd.add_argument('makeargs', nargs=REMAINDER)
     cmd.set_defaults(func=build)
 
     cmd = subp.add_parser('test')
+    cmd.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT',
+                     help='Only run the tests of this shard (uses the native test runner)')
     cmd.set_defaults(func=test)
 
     cmd = subp.add_parser('test-results')
+    cmd.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT',
+                     help='Write the reports of this shard')
+    cmd.add_argument('--merge', metavar='DIR',
+                     help='Merge the reports of all shards in DIR')
     cmd.set_defaults(func=test_results)
 
     cmd = subp.add_parser('exec')
     cmd.add_argument('cmd', nargs=REMAINDER)
     cmd.set_defaults(func=doExec)
 
+    cmd = subp.add_parser('history')
+    cmd.add_argument('--kind', choices=['phase', 'clone', 'dependency', 'test'],
+                     help='Only show steps of this kind')
+    cmd.add_argument('--name', help='Only show steps with names matching this regular expression')
+    cmd.add_argument('--days', type=float, default=0, help='Only use the runs of the last DAYS days')
+    cmd.add_argument('--window', type=int, default=5,
+                     help='Compare the last WINDOW runs with the ones before [default: 5]')
+    cmd.add_argument('--threshold', type=float, default=20,
+                     help='Report steps that got slower by more than THRESHOLD percent [default: 20]')
+    cmd.set_defaults(func=history)
+
     return p
 
 
@@ -1034,11 +3532,39 @@ def main(raw):
 
     detect_context()
 
-    if args.vcvars and ci['compiler'].startswith('vs'):
-        # re-exec with MSVC in PATH
-        with_vcvars(' '.join(['--no-vcvars'] + raw))
-    else:
+    if args.func in [history, plan]:
+        # read-only commands: no trace or history records
         args.func(args)
+        return
+
+    compiling = ci['ccache'] and args.func in [prepare, build, test, doExec]
+    if compiling:
+        setup_ccache()
+    if args.func in [build, test, test_results, doExec]:
+        lock_used_dependencies()
+
+    start = time.time()
+    outcome = 'failed'
+    try:
+        if args.vcvars and ci['compiler'].startswith('vs'):
+            # re-exec with MSVC in PATH (which records its own history)
+            outcome = None
+            with_vcvars(' '.join(['--no-vcvars'] + raw))
+        else:
+            args.func(args)
+            outcome = 'ok'
+    except SystemExit as e:
+        if outcome and not e.code:
+            outcome = 'ok'
+        raise
+    finally:
+        write_lease()
+        if compiling and ci['ccache']:
+            print_ccache_stats()
+        write_trace(args.func.__name__)
+        if outcome:
+            record_history('phase', args.func.__name__, start, outcome)
+            write_history(args.func.__name__)
 
 
 if __name__ == '__main__':